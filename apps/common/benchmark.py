@@ -0,0 +1,38 @@
+import time
+
+
+def measure(func, repeat=5, warmup=1):
+    """
+    time `repeat` calls of func() after `warmup` calls that are not timed (caches, query plans, lazy builds)
+    :return: (timings in milliseconds sorted, result of the last call)
+    """
+    result = None
+    for _ in range(warmup):
+        result = func()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return sorted(timings), result
+
+
+def percentile(timings, value):
+    """
+    nearest rank percentile of sorted timings
+    """
+    return timings[min(len(timings) - 1, int(len(timings) * value / 100))]
+
+
+def format_duration(ms) -> str:
+    if ms < 1:
+        return '{:.1f}us'.format(ms * 1000)
+    return '{:.1f}ms'.format(ms)
+
+
+def format_timings(timings) -> str:
+    """
+    'best 1.2ms p50 1.4ms p95 2.0ms' of sorted timings
+    """
+    return 'best {} p50 {} p95 {}'.format(format_duration(timings[0]), format_duration(percentile(timings, 50)),
+                                          format_duration(percentile(timings, 95)))
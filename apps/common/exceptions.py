@@ -40,3 +40,21 @@ class InvalidFilterException(GenericException):
         if not message:
             message = 'invalid filter'
         super(InvalidFilterException, self).__init__(message)
+
+
+class ConflictException(GenericException):
+    code = 1006
+
+    def __init__(self, message=None):
+        if not message:
+            message = 'the resource has been modified by another request'
+        super(ConflictException, self).__init__(message, status_code=status.HTTP_409_CONFLICT)
+
+
+class IdempotencyKeyReusedException(GenericException):
+    code = 1007
+
+    def __init__(self, message=None):
+        if not message:
+            message = 'the idempotency key has already been used for a different request'
+        super(IdempotencyKeyReusedException, self).__init__(message, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
@@ -1,5 +1,113 @@
-from rest_framework.pagination import PageNumberPagination
+from uuid import UUID
+
+from django.db import connection
+from django.db.models import BooleanField, DateTimeField
+from django.db.models.expressions import RawSQL
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, CursorPagination, Cursor
+
+from apps.common.exceptions import InvalidFilterException
+
+KEYSET_PAGINATION_PARAM = 'pagination'
+KEYSET_PAGINATION_VALUE = 'cursor'
+# breaks the ties of the keyset field, rows created in the same microsecond keep a stable order
+KEYSET_TIE_BREAKER = 'id'
+KEYSET_POSITION_SEPARATOR = '|'
 
 
 class BasePagination(PageNumberPagination):
     page_size_query_param = 'limit'
+
+
+def is_keyset_pagination(query_params) -> bool:
+    return (query_params.get(KEYSET_PAGINATION_PARAM) == KEYSET_PAGINATION_VALUE
+            or bool(query_params.get(KeysetPagination.cursor_query_param)))
+
+
+class KeysetPagination(CursorPagination):
+    """
+    keyset pagination on (field, id), `field` being the ordering of the listing ('-created', 'modified', ...): a page
+    is read from the index after the last row of the previous page,
+        WHERE (created, id) < (%s, %s) ORDER BY created DESC, id DESC LIMIT n + 1
+    without COUNT(*) nor OFFSET, deep pages cost as much as the first one. The response has the next / previous
+    links (cursor query param) and the results, there is no count.
+    """
+    page_size_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        field = self.ordering[0]
+        descending = field.startswith('-') != reverse
+        field = field.lstrip('-')
+        direction = '-' if descending else ''
+        queryset = queryset.order_by('{}{}'.format(direction, field), '{}{}'.format(direction, KEYSET_TIE_BREAKER))
+        if self.cursor is not None:
+            value, pk = self.decode_position(self.cursor.position)
+            queryset = queryset.filter(self.__build_keyset_condition(queryset.model, field, descending, value, pk))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def get_ordering(self, request, queryset, view):
+        """
+        the ordering of the listing, which must be a single date time field (and the tie breaker), a ranked search
+        or a custom sort cannot be paginated by key
+        """
+        ordering = tuple(queryset.query.order_by)
+        field_names = [field.name for field in queryset.model._meta.concrete_fields
+                       if isinstance(field, DateTimeField)]
+        if not ordering or ordering[0].lstrip('-') not in field_names or ordering[1:] not in [
+                (), ('-' + KEYSET_TIE_BREAKER,), (KEYSET_TIE_BREAKER,)]:
+            raise InvalidFilterException('cursor pagination is not available for this ordering, use page numbers')
+        return ordering
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.encode_position(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.encode_position(self.page[0])))
+
+    def encode_position(self, instance):
+        field = self.ordering[0].lstrip('-')
+        return '{}{}{}'.format(getattr(instance, field).isoformat(), KEYSET_POSITION_SEPARATOR,
+                               getattr(instance, KEYSET_TIE_BREAKER))
+
+    def decode_position(self, position):
+        try:
+            value, pk = (position or '').split(KEYSET_POSITION_SEPARATOR)
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError(position)
+            return value, UUID(pk)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def __build_keyset_condition(model, field, descending, value, pk):
+        # a row comparison, answered by a range scan of an index on (..., field, id)
+        qn = connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        sql = '({table}.{field}, {table}.{pk}) {operator} (%s, %s)'.format(
+            table=table, field=qn(model._meta.get_field(field).column),
+            pk=qn(model._meta.get_field(KEYSET_TIE_BREAKER).column), operator='<' if descending else '>')
+        return RawSQL(sql, [value, pk], output_field=BooleanField())
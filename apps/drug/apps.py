@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DrugConfig(AppConfig):
     name = 'apps.drug'
+
+    def ready(self):
+        import apps.drug.signals  # noqa
+        import apps.drug.services.unaccent  # noqa
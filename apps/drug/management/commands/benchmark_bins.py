@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from apps.common.benchmark import measure, format_timings
+from apps.drug.services.calc_bins_from_range_time import (
+    CalculateBinsFromRangeTimeService, BIN_CHOICES, BIN_HOURS, get_time_zone)
+
+
+def walk_days(handler, from_date, to_date):
+    """
+    the bins computed one day at a time with a list membership test, as before the calendar arithmetic
+    """
+    res = []
+    current_dt = from_date
+    while current_dt <= to_date:
+        val = handler.extract_bin_from_date(current_dt)
+        if val not in res:
+            res.append(val)
+        current_dt += timedelta(days=1)
+    return res
+
+
+class Command(BaseCommand):
+    help = 'micro-benchmark of the bin labels of a date range for every bin type, against the day by day walk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', default='2010-01-01', help='first day, %%Y-%%m-%%d')
+        parser.add_argument('--to', dest='to_date', default='2026-10-01', help='last day, %%Y-%%m-%%d')
+        parser.add_argument('--time-zone', dest='time_zone', default='Asia/Ho_Chi_Minh')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=100)
+
+    def handle(self, *args, **options):
+        tz = get_time_zone(options['time_zone'])
+        from_date = tz.localize(datetime.strptime(options['from_date'], '%Y-%m-%d'))
+        to_date = tz.localize(datetime.strptime(options['to_date'], '%Y-%m-%d'))
+        print('bins of {} .. {} ({}), {} runs'.format(options['from_date'], options['to_date'], tz, options['repeat']))
+
+        for choice in BIN_CHOICES:
+            handler = CalculateBinsFromRangeTimeService(choice, tz)
+            # one label per hour of the range, a few runs are enough
+            repeat = min(options['repeat'], 3) if choice == BIN_HOURS else options['repeat']
+            timings, bins = measure(lambda: handler.calc_bins_from_range_time(from_date, to_date), repeat=repeat)
+            line = '{:9s} {:6d} bins  {}'.format(choice, len(bins), format_timings(timings))
+            # a day by day walk cannot see the hours
+            if choice != BIN_HOURS:
+                old_timings, old_bins = measure(lambda: walk_days(handler, from_date, to_date), repeat=3)
+                assert old_bins == bins, 'the day by day walk gives other {} bins'.format(choice)
+                line += '  | day by day {}'.format(format_timings(old_timings))
+            print(line)
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Now
+
+from apps.common.benchmark import measure, percentile, format_duration, format_timings
+from apps.drug.models import Drug
+from apps.drug.services.drug_autocomplete import DrugAutocompleteIndex, AUTOCOMPLETE_DEFAULT_LIMIT
+
+DEFAULT_KEYWORDS = ['p', 'para', 'paracetamol 5', 'ibu', 'k1234', 'forte', 'giảm', 'zzz']
+
+
+class Command(BaseCommand):
+    help = 'benchmark of the in process drug autocomplete index: build, prefix searches and delta refresh'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keywords', dest='keywords', nargs='+', default=DEFAULT_KEYWORDS)
+        parser.add_argument('--repeat', dest='repeat', type=int, default=2000, help='searches per keyword')
+        parser.add_argument('--builds', dest='builds', type=int, default=3)
+        parser.add_argument('--delta', dest='delta', type=int, default=100,
+                            help='drugs renamed before the refresh, rolled back at the end')
+
+    def handle(self, *args, **options):
+        # search('') only makes sure the index is built
+        timings, _ = measure(lambda: DrugAutocompleteIndex().search(''), repeat=options['builds'], warmup=0)
+        index = DrugAutocompleteIndex()
+        index.search('')
+        terms, _, by_id = index._state
+        print('build of {} terms, {} drugs  {}'.format(len(terms), len(by_id), format_timings(timings)))
+
+        for keyword in options['keywords']:
+            timings, res = measure(lambda: index.search(keyword, AUTOCOMPLETE_DEFAULT_LIMIT),
+                                   repeat=options['repeat'], warmup=10)
+            print('{:16s} {:3d} drugs  p50 {}  p99 {}  first: {}'.format(
+                repr(keyword), len(res), format_duration(percentile(timings, 50)),
+                format_duration(percentile(timings, 99)), res[0][1] if res else None))
+
+        with transaction.atomic():
+            drug_ids = list(Drug.objects.order_by('-modified').values_list('id', flat=True)[:options['delta'] * 2])
+            # the first delta after a build reads back MODIFIED_OVERLAP before the newest drug, after a bulk import
+            # that is the whole import and the index is built again, the second one is a plain delta
+            for step in range(2):
+                self.refresh(index, drug_ids[step::2], step)
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def refresh(index, drug_ids, step):
+        Drug.objects.filter(id__in=drug_ids).update(name=Concat('name', Value(' benchmark {}'.format(step))),
+                                                    modified=Now())
+        # refresh now instead of after the check interval
+        index.invalidate()
+        built_at = index._built_at
+        timings, _ = measure(lambda: index.search(''), repeat=1, warmup=0)
+        found = len(index.search(Drug.objects.get(id=drug_ids[0]).name))
+        print('refresh of {} renamed drugs ({})  {}  found by the new name: {}'.format(
+            len(drug_ids), 'build' if index._built_at != built_at else 'delta', format_timings(timings), found))
@@ -0,0 +1,90 @@
+import threading
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Q
+
+from apps.common.benchmark import percentile, format_duration
+from apps.drug.models import Drug, WorkSpace, Pharmacy, Prescription, PrescriptionDetail
+from apps.drug.services.custom_bulk_sync import custom_bulk_sync
+from apps.drug.services.prescription_detail_upsert import PrescriptionDetailUpsertService
+
+
+def build_details(prescription, drugs, edit):
+    """
+    desired details of an edit: every drug but one, one quantity changed, so each edit inserts, updates and removes
+    """
+    changed, removed = edit % len(drugs), (edit + 7) % len(drugs)
+    return [PrescriptionDetail(prescription=prescription, drug=drug,
+                               quantity=1 + index + (edit if index == changed else 0),
+                               price_at_the_time=drug.price or 0, is_removed=False)
+            for index, drug in enumerate(drugs) if index != removed]
+
+
+def bulk_sync(prescription, drugs, edit):
+    custom_bulk_sync(new_models=build_details(prescription, drugs, edit), filters=Q(prescription=prescription),
+                     fields=['drug', 'prescription', 'quantity', 'price_at_the_time', 'is_removed'],
+                     key_fields=['drug_id', 'prescription_id'])
+
+
+def upsert(prescription, drugs, edit):
+    PrescriptionDetailUpsertService(prescription.id).sync(build_details(prescription, drugs, edit))
+
+
+class Command(BaseCommand):
+    help = 'benchmark of concurrent prescription detail edits, custom_bulk_sync against the upsert service. ' \
+           'Writes to a temporary user and work space, removed at the end'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', dest='threads', type=int, default=8)
+        parser.add_argument('--rounds', dest='rounds', type=int, default=40, help='edits per thread')
+        parser.add_argument('--drugs', dest='drugs', type=int, default=40, help='details per prescription')
+
+    def handle(self, *args, **options):
+        drugs = list(Drug.objects.order_by('id')[:options['drugs']])
+        if len(drugs) < options['drugs']:
+            raise CommandError('{} drugs are needed, found {}'.format(options['drugs'], len(drugs)))
+
+        user = User.objects.create(username='benchmark-{}'.format(uuid.uuid4().hex))
+        try:
+            work_space = WorkSpace.objects.create(name='benchmark', owner=user)
+            pharmacy = Pharmacy.objects.create(work_space=work_space, name='benchmark', address='', phone='')
+            prescriptions = [Prescription.objects.create(work_space=work_space, pharmacy=pharmacy)
+                             for _ in range(options['threads'])]
+            print('{} threads x {} edits of {} details'.format(options['threads'], options['rounds'], len(drugs)))
+            # twice each, the first runs warm the tables and the connections
+            for name, func in [('custom_bulk_sync', bulk_sync), ('upsert', upsert)] * 2:
+                self.run(name, func, prescriptions, drugs, options['rounds'])
+        finally:
+            # the user cascades to the work space, its pharmacy, prescriptions and details
+            WorkSpace.all_objects.filter(owner=user).delete()
+            user.delete()
+
+    @staticmethod
+    def run(name, func, prescriptions, drugs, rounds):
+        timings = []
+
+        def work(prescription):
+            try:
+                for edit in range(rounds):
+                    started = time.perf_counter()
+                    with transaction.atomic():
+                        func(prescription, drugs, edit)
+                    timings.append((time.perf_counter() - started) * 1000)
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=work, args=(item,)) for item in prescriptions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total = time.perf_counter() - started
+        timings.sort()
+        print('{:17s} {:6.0f} edits/s  p50 {}  p95 {}'.format(
+            name, len(timings) / total, format_duration(percentile(timings, 50)),
+            format_duration(percentile(timings, 95))))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework import serializers
+
+from apps.common.benchmark import measure, format_timings
+from apps.drug.models import Drug
+from apps.drug.serializers import PrescriptionDrugSerializer
+
+
+class PerLinePrescriptionDrugSerializer(PrescriptionDrugSerializer):
+    """
+    the detail serializer without the batched drugs, one drug lookup per line
+    """
+    serializer_related_field = serializers.PrimaryKeyRelatedField
+
+    class Meta(PrescriptionDrugSerializer.Meta):
+        list_serializer_class = serializers.ListSerializer
+
+
+class Command(BaseCommand):
+    help = 'benchmark of the validation of the detail lines of a large prescription, batched drug lookup ' \
+           'against one lookup per line'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', dest='lines', type=int, default=100)
+        parser.add_argument('--repeat', dest='repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        drugs = list(Drug.objects.order_by('id')[:options['lines']])
+        if len(drugs) < options['lines']:
+            raise CommandError('{} drugs are needed, found {}'.format(options['lines'], len(drugs)))
+        lines = [{'drug': str(drug.id), 'quantity': 1 + index % 3} for index, drug in enumerate(drugs)]
+        print('{} detail lines, {} runs'.format(len(lines), options['repeat']))
+
+        for name, serializer_class in [('batched drugs', PrescriptionDrugSerializer),
+                                       ('per line drug lookup', PerLinePrescriptionDrugSerializer)]:
+            def validate():
+                serializer = serializer_class(many=True, data=lines)
+                serializer.is_valid(raise_exception=True)
+                return serializer.validated_data
+
+            with CaptureQueriesContext(connection) as queries:
+                validated_data = validate()
+            assert [item['price_at_the_time'] for item in validated_data] == [drug.price for drug in drugs]
+            timings, _ = measure(validate, repeat=options['repeat'])
+            print('{:21s} {:4d} queries  {}'.format(name, len(queries.captured_queries), format_timings(timings)))
@@ -0,0 +1,57 @@
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+from django.core.management.base import BaseCommand
+
+from apps.common.benchmark import measure, format_timings
+from apps.drug.services.calc_bins_from_range_time import CalculateBinsFromRangeTimeService, BIN_DAYS
+from apps.drug.services.revenue_analytics import RevenueAnalyticsService, DEFAULT_MOVING_AVERAGE_WINDOWS
+
+
+def python_loops(matrix, windows):
+    """
+    the same derived series computed with Python loops per pharmacy and per bin
+    """
+    for row in matrix:
+        for window in windows:
+            [sum(row[max(0, index + 1 - window):index + 1]) / min(index + 1, window) for index in range(len(row))]
+        [(row[index] - row[index - 1]) / row[index - 1] if row[index - 1] else None for index in range(1, len(row))]
+    for column in zip(*matrix):
+        sorted(column)
+
+
+class Command(BaseCommand):
+    help = 'benchmark of the revenue analytics on a synthetic (pharmacy x day) revenue matrix, no database needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pharmacies', dest='pharmacies', type=int, default=500)
+        parser.add_argument('--days', dest='days', type=int, default=365)
+        parser.add_argument('--density', dest='density', type=float, default=0.9,
+                            help='share of the (pharmacy, day) cells with sales')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        to_date = datetime(2025, 12, 31, tzinfo=pytz.utc)
+        bins = CalculateBinsFromRangeTimeService(BIN_DAYS).calc_bins_from_range_time(
+            to_date - timedelta(days=options['days'] - 1), to_date)
+        rnd = random.Random(0)
+        # rows of CalculatePriceByTimeUnitForPharmacies, ordered by pharmacy
+        res_stats = [(uuid.UUID(int=pharmacy), 'pharmacy {}'.format(pharmacy), label, rnd.random() * 1000)
+                     for pharmacy in range(options['pharmacies']) for label in bins
+                     if rnd.random() < options['density']]
+        print('{} pharmacies x {} bins, {} rows, {} runs'.format(
+            options['pharmacies'], len(bins), len(res_stats), options['repeat']))
+
+        repeat = options['repeat']
+        timings, service = measure(lambda: RevenueAnalyticsService(res_stats, bins), repeat=repeat)
+        print('{:28s} {}'.format('matrix build', format_timings(timings)))
+        timings, _ = measure(lambda: [service.moving_average(window) for window in DEFAULT_MOVING_AVERAGE_WINDOWS]
+                             + [service.growth_rate(), service.percentile_bands()], repeat=repeat)
+        print('{:28s} {}'.format('vector ops', format_timings(timings)))
+        timings, _ = measure(service.run, repeat=repeat)
+        print('{:28s} {}'.format('vector ops + JSON ready rows', format_timings(timings)))
+        matrix = service.matrix.tolist()
+        timings, _ = measure(lambda: python_loops(matrix, DEFAULT_MOVING_AVERAGE_WINDOWS), repeat=repeat)
+        print('{:28s} {}'.format('python loops', format_timings(timings)))
@@ -0,0 +1,80 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from apps.common.benchmark import measure, format_timings
+from apps.drug.config import CANCELLED_KEY
+from apps.drug.services.calc_bins_from_range_time import (
+    BIN_DAYS, BIN_MONTHS, BIN_YEARS, SQL_DATE_FORMATS, SQL_DATE_TRUNC_UNITS)
+from apps.drug.services.drug_sales_cube import (
+    DrugSalesCubeService, DIMENSION_CATEGORY, DIMENSION_PHARMACY, DIMENSION_DRUG)
+
+# the same aggregation read from the detail rows, as the drug sales stats did before the cube
+LIVE_QUERY = '''
+    SELECT {columns}to_char(date_trunc(%(date_unit)s, pres.created AT TIME ZONE 'UTC'), %(date_fmt)s) AS bucket,
+        SUM(detail.quantity), SUM(detail.price_at_the_time * detail.quantity)
+    FROM drug_prescriptiondetail AS detail
+    JOIN drug_prescription AS pres ON pres.id = detail.prescription_id
+    JOIN drug_drug ON drug_drug.id = detail.drug_id
+    WHERE pres.work_space_id = %(work_space_id)s AND pres.created BETWEEN %(from_date)s AND %(to_date)s
+        AND pres.is_removed = FALSE AND pres.status <> %(cancelled)s AND detail.is_removed = FALSE
+    GROUP BY {columns}bucket
+'''
+
+LIVE_COLUMNS = {
+    DIMENSION_PHARMACY: 'pres.pharmacy_id',
+    DIMENSION_CATEGORY: 'drug_drug.category_id',
+    DIMENSION_DRUG: 'detail.drug_id',
+}
+
+# name, dimensions, bin, days back from now
+CASES = [
+    ('category x MONTHS, 1 year', [DIMENSION_CATEGORY], BIN_MONTHS, 365),
+    ('pharmacy x drug x DAYS, 30 days', [DIMENSION_PHARMACY, DIMENSION_DRUG], BIN_DAYS, 30),
+    ('total x YEARS, 1 year', [], BIN_YEARS, 365),
+]
+
+
+def run_live(work_space_id, dimensions, choice, from_date, to_date):
+    columns = ''.join('{}, '.format(LIVE_COLUMNS[item]) for item in dimensions)
+    params = {
+        'work_space_id': str(work_space_id),
+        'date_unit': SQL_DATE_TRUNC_UNITS[choice],
+        'date_fmt': SQL_DATE_FORMATS[choice],
+        'from_date': from_date,
+        'to_date': to_date,
+        'cancelled': CANCELLED_KEY,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(LIVE_QUERY.format(columns=columns), params)
+        return cursor.fetchall()
+
+
+class Command(BaseCommand):
+    help = 'benchmark of the drug sales stats read from the cube against the live GROUP BY of the details'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--work-space', dest='work_space_id', required=True)
+        parser.add_argument('--repeat', dest='repeat', type=int, default=5)
+        parser.add_argument('--rebuild', dest='rebuild', action='store_true', default=False,
+                            help='rebuild the cube of the work space first')
+
+    def handle(self, *args, **options):
+        work_space_id = options['work_space_id']
+        if options['rebuild']:
+            timings, count = measure(lambda: DrugSalesCubeService.rebuild(work_space_id), repeat=1, warmup=0)
+            print('rebuilt {} cube rows in {}'.format(count, format_timings(timings)))
+
+        to_date = timezone.now()
+        for name, dimensions, choice, days in CASES:
+            from_date = to_date - timedelta(days=days)
+            live_timings, live_rows = measure(
+                lambda: run_live(work_space_id, dimensions, choice, from_date, to_date), repeat=options['repeat'])
+            cube_timings, cube_rows = measure(
+                lambda: DrugSalesCubeService(work_space_id, choice, from_date, to_date, dimensions=dimensions).run(),
+                repeat=options['repeat'])
+            print(name)
+            print('    live  {:6d} rows  {}'.format(len(live_rows), format_timings(live_timings)))
+            print('    cube  {:6d} rows  {}'.format(len(cube_rows), format_timings(cube_timings)))
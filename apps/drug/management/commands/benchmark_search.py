@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from apps.common.benchmark import measure, format_timings
+from apps.drug.models import Category, Drug
+from apps.drug.services.search import PostgresFulltextSearch, CONFIG_DRUG_RANK, SEARCH_VECTOR_FIELD
+
+BENCHMARK_CATEGORY = 'benchmark search'
+
+DEFAULT_KEYWORDS = ['paracetamol', 'para', 'ibuprofen forte', 'cetamol', 'K12345', 'zzznomatch']
+
+# synthetic drug names, '<active ingredient> <form> <suffix>', the search vector is filled by the trigger
+SEED_QUERY = '''
+    INSERT INTO drug_drug (id, created, modified, is_removed, name, category_id, rate, price, key)
+    SELECT md5(%(category_id)s || i::text)::uuid, now(), now(), FALSE,
+        (ARRAY['paracetamol', 'ibuprofen', 'amoxicillin', 'omeprazole', 'metformin', 'cetirizine', 'loratadine',
+               'vitamin', 'aspirin', 'diclofenac'])[1 + i %% 10]
+            || ' ' || (ARRAY['500mg', '250mg', '10mg', 'forte', 'plus', 'extra'])[1 + (i / 10) %% 6]
+            || ' ' || substr(md5(i::text), 1, 6),
+        %(category_id)s, 0, 1 + i %% 100, 'K' || i
+    FROM generate_series(1, %(number)s) AS i
+    ON CONFLICT DO NOTHING;
+'''
+
+
+class Command(BaseCommand):
+    help = 'benchmark of the drug keyword search, the vector computed per row against the stored search vector'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keywords', dest='keywords', nargs='+', default=DEFAULT_KEYWORDS)
+        parser.add_argument('--limit', dest='limit', type=int, default=20, help='rows of the first page')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=5)
+        parser.add_argument('--seed', dest='seed', type=int, default=0,
+                            help='insert this many synthetic drugs in the "{}" category first'.format(
+                                BENCHMARK_CATEGORY))
+        parser.add_argument('--cleanup', dest='cleanup', action='store_true', default=False,
+                            help='delete the synthetic drugs at the end')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.seed(options['seed'])
+        print('{} drugs, first {} rows, {} runs'.format(Drug.objects.count(), options['limit'], options['repeat']))
+
+        for keyword in options['keywords']:
+            # the conditions of ListCreateDrugView
+            q_list = [Q(key__f_unaccent__icontains=keyword), Q(name__f_unaccent__icontains=keyword)]
+            print(keyword)
+            for name, vector_field in [('computed', None), ('stored', SEARCH_VECTOR_FIELD)]:
+                query_set = PostgresFulltextSearch(Drug.objects.all(), CONFIG_DRUG_RANK,
+                                                   vector_field=vector_field).search(keyword, q_list)
+                # the computed path ranks every row, a few runs are enough
+                repeat = min(options['repeat'], 2) if vector_field is None else options['repeat']
+                timings, rows = measure(lambda: list(query_set[:options['limit']]), repeat=repeat)
+                print('    {:8s} {:7d} matches  {}  first: {}'.format(
+                    name, query_set.count(), format_timings(timings), rows[0].name if rows else None))
+
+        if options['cleanup']:
+            self.cleanup()
+
+    @staticmethod
+    def seed(number):
+        category, _ = Category.objects.get_or_create(name=BENCHMARK_CATEGORY)
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(SEED_QUERY, {'category_id': str(category.id), 'number': number})
+                print('seeded {} drugs'.format(cursor.rowcount))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE drug_drug;')
+
+    @staticmethod
+    def cleanup():
+        # the synthetic drugs are in no prescription, a plain DELETE instead of the collector of 500k objects
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('''
+                    DELETE FROM drug_drug WHERE category_id IN (SELECT id FROM drug_category WHERE name = %s);
+                ''', [BENCHMARK_CATEGORY])
+                print('deleted {} drugs'.format(cursor.rowcount))
+            Category.all_objects.filter(name=BENCHMARK_CATEGORY).delete()
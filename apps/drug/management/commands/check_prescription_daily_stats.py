@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from apps.drug.services.prescription_daily_stats import PrescriptionDailyStatsService
+from apps.drug.services.stats_cache import bump_pharmacy_version, bump_work_space_version
+
+
+class Command(BaseCommand):
+    help = 'compare the prescription daily stats with drug_prescription, rebuild the drifted work spaces with --repair'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--work-space', dest='work_space_id', default=None,
+                            help='only check the stats of this work space id')
+        parser.add_argument('--repair', action='store_true', default=False,
+                            help='rebuild the stats of every work space with a mismatch')
+
+    def handle(self, *args, **options):
+        mismatches = PrescriptionDailyStatsService.check(options.get('work_space_id'))
+        for row in mismatches:
+            print('work space {} pharmacy {} day {} status {}: expected {} prescriptions / {} money, '
+                  'found {} / {}'.format(*row[:4], row[4], row[6], row[5], row[7]))
+        print('{} mismatched prescription daily stats rows'.format(len(mismatches)))
+
+        if options.get('repair'):
+            work_space_ids = {row[0] for row in mismatches}
+            for work_space_id in work_space_ids:
+                PrescriptionDailyStatsService.rebuild(work_space_id)
+                bump_work_space_version(work_space_id)
+            for pharmacy_id in {row[1] for row in mismatches}:
+                bump_pharmacy_version(pharmacy_id)
+            print('rebuilt the stats of {} work spaces'.format(len(work_space_ids)))
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.drug.models import WorkSpace
+from apps.drug.serializers import BulkPrescriptionSerializer, PRESCRIPTION_BULK_MAX_SIZE
+
+
+class Command(BaseCommand):
+    help = 'bulk load prescriptions of a work space from a JSON file, same payload as prescription/bulk/'
+
+    def add_arguments(self, parser):
+        parser.add_argument('work_space_id', help='work space of the prescriptions')
+        parser.add_argument('file_path', help='JSON file, a list of prescriptions or {"list_prescription": [...]}')
+
+    def handle(self, *args, **options):
+        try:
+            work_space = WorkSpace.objects.get(id=options['work_space_id'])
+        except WorkSpace.DoesNotExist:
+            raise CommandError('work space {} does not exist'.format(options['work_space_id']))
+
+        with open(options['file_path']) as json_file:
+            data = json.load(json_file)
+        if isinstance(data, dict):
+            data = data.get('list_prescription', [])
+
+        number_prescription, number_detail = 0, 0
+        # the endpoint limit also bounds the size of one transaction here
+        for start in range(0, len(data), PRESCRIPTION_BULK_MAX_SIZE):
+            batch = data[start:start + PRESCRIPTION_BULK_MAX_SIZE]
+            serializer = BulkPrescriptionSerializer(data={'list_prescription': batch},
+                                                    context={'work_space': work_space})
+            if not serializer.is_valid():
+                raise CommandError('batch starting at {}: {}'.format(start, serializer.errors))
+            res = serializer.ingest()
+            number_prescription += len(res['ids'])
+            number_detail += res['number_detail']
+        print('ingested {} prescriptions, {} details'.format(number_prescription, number_detail))
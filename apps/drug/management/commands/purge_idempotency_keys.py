@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.drug.services.idempotency import IdempotencyService
+
+
+class Command(BaseCommand):
+    help = 'delete the expired idempotency keys in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                            help='number of keys deleted per transaction')
+
+    def handle(self, *args, **options):
+        count = IdempotencyService.purge(options.get('batch_size'))
+        print('purged {} expired idempotency keys'.format(count))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.drug.services.drug_sales_cube import DrugSalesCubeService
+
+
+class Command(BaseCommand):
+    help = 'backfill or rebuild the drug sales cube from drug_prescriptiondetail'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--work-space', dest='work_space_id', default=None,
+                            help='only rebuild the cube of this work space id')
+
+    def handle(self, *args, **options):
+        count = DrugSalesCubeService.rebuild(options.get('work_space_id'))
+        print('rebuilt {} drug sales cube rows'.format(count))
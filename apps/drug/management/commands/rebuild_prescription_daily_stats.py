@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.drug.services.prescription_daily_stats import PrescriptionDailyStatsService
+
+
+class Command(BaseCommand):
+    help = 'backfill or rebuild the pre-aggregated prescription daily stats from drug_prescription'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--work-space', dest='work_space_id', default=None,
+                            help='only rebuild the stats of this work space id')
+
+    def handle(self, *args, **options):
+        count = PrescriptionDailyStatsService.rebuild(options.get('work_space_id'))
+        print('rebuilt {} prescription daily stats rows'.format(count))
@@ -0,0 +1,35 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.drug.serializers import BulkDrugPriceSerializer
+
+
+class Command(BaseCommand):
+    help = 'bulk update drug prices, by a percentage on a category or from a key,price CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', dest='category', default=None, help='category id of the percentage rule')
+        parser.add_argument('--percent', dest='percent', type=float, default=None,
+                            help='price change in percent, e.g. 7 or -5')
+        parser.add_argument('--file', dest='file_path', default=None,
+                            help='CSV file with a header, the columns key and price')
+
+    def handle(self, *args, **options):
+        data = {}
+        if options['category'] is not None:
+            data['category'] = options['category']
+        if options['percent'] is not None:
+            data['percent'] = options['percent']
+        if options['file_path']:
+            with open(options['file_path'], newline='') as csv_file:
+                data['prices'] = [{'key': row.get('key'), 'price': row.get('price')}
+                                  for row in csv.DictReader(csv_file)]
+
+        serializer = BulkDrugPriceSerializer(data=data)
+        if not serializer.is_valid():
+            raise CommandError(serializer.errors)
+        res = serializer.apply()
+        print('updated the price of {} drugs'.format(res['updated']))
+        if res.get('not_found'):
+            print('{} keys without a drug: {}'.format(len(res['not_found']), ', '.join(res['not_found'])))
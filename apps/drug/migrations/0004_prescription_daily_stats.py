@@ -0,0 +1,41 @@
+# Generated by Django 3.1.2 on 2026-10-18 08:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drug', '0003_auto_20201031_1216'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrescriptionDailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('IN_PROGRESS', 'In Progress'), ('DONE', 'Done'), ('CANCELLED', 'Cancelled')], max_length=11)),
+                ('number_prescription', models.IntegerField(default=0)),
+                ('total_price', models.FloatField(default=0)),
+                ('pharmacy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='drug.pharmacy')),
+                ('work_space', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='drug.workspace')),
+            ],
+            options={
+                'unique_together': {('work_space', 'pharmacy', 'day', 'status')},
+            },
+        ),
+        migrations.RunSQL(
+            sql='''
+                INSERT INTO drug_prescriptiondailystats
+                    (work_space_id, pharmacy_id, day, status, number_prescription, total_price)
+                SELECT work_space_id, pharmacy_id, (created AT TIME ZONE 'UTC')::date AS day, status,
+                    COUNT(*), COALESCE(SUM(total_price), 0)
+                FROM drug_prescription
+                WHERE is_removed = FALSE
+                GROUP BY work_space_id, pharmacy_id, day, status;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
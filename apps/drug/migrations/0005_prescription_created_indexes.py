@@ -0,0 +1,28 @@
+# Generated by Django 3.1.2 on 2026-10-18 08:55
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('drug', '0004_prescription_daily_stats'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='prescription',
+            index=models.Index(fields=['work_space', 'created'], name='drug_pres_ws_created_idx'),
+        ),
+        migrations.RunSQL(
+            sql='''
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS drug_pres_pharmacy_created_idx
+                ON drug_prescription (pharmacy_id, created) INCLUDE (total_price, is_removed);
+            ''',
+            reverse_sql='''
+                DROP INDEX CONCURRENTLY IF EXISTS drug_pres_pharmacy_created_idx;
+            ''',
+        ),
+    ]
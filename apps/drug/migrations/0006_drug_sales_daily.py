@@ -0,0 +1,49 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drug', '0005_prescription_created_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DrugSalesDaily',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('category', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='drug.category')),
+                ('drug', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='drug.drug')),
+                ('pharmacy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='drug.pharmacy')),
+                ('work_space', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='drug.workspace')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='drugsalesdaily',
+            index=models.Index(fields=['work_space', 'day'], name='drug_sales_ws_day_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='drugsalesdaily',
+            unique_together={('pharmacy', 'drug', 'day')},
+        ),
+        migrations.RunSQL(
+            sql='''
+                INSERT INTO drug_drugsalesdaily (work_space_id, pharmacy_id, category_id, drug_id, day, quantity, revenue)
+                SELECT pres.work_space_id, pres.pharmacy_id, drug_drug.category_id, detail.drug_id,
+                    (pres.created AT TIME ZONE 'UTC')::date AS day, SUM(detail.quantity),
+                    SUM(detail.price_at_the_time * detail.quantity)
+                FROM drug_prescriptiondetail AS detail
+                JOIN drug_prescription AS pres ON pres.id = detail.prescription_id
+                JOIN drug_drug ON drug_drug.id = detail.drug_id
+                WHERE pres.is_removed = FALSE AND pres.status <> 'CANCELLED' AND detail.is_removed = FALSE
+                GROUP BY pres.work_space_id, pres.pharmacy_id, drug_drug.category_id, detail.drug_id, day;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
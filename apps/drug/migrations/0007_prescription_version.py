@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drug', '0006_drug_sales_daily'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prescription',
+            name='version',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:26
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drug', '0009_audit_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='drug',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='prescription',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        # weights of CONFIG_DRUG_RANK and CONFIG_PRESCRIPTION_RANK, backfilled before the GIN indexes are built
+        migrations.RunSQL(
+            sql='''
+                CREATE FUNCTION drug_drug_search_vector_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := setweight(to_tsvector(COALESCE(NEW.key, '')), 'A')
+                        || setweight(to_tsvector(COALESCE(NEW.name, '')), 'B');
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER drug_drug_search_vector_trigger
+                BEFORE INSERT OR UPDATE OF key, name ON drug_drug
+                FOR EACH ROW EXECUTE PROCEDURE drug_drug_search_vector_update();
+
+                CREATE FUNCTION drug_prescription_search_vector_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := setweight(to_tsvector(COALESCE(NEW.name, '')), 'A')
+                        || setweight(to_tsvector(COALESCE(NEW.status, '')), 'B');
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER drug_prescription_search_vector_trigger
+                BEFORE INSERT OR UPDATE OF name, status ON drug_prescription
+                FOR EACH ROW EXECUTE PROCEDURE drug_prescription_search_vector_update();
+
+                UPDATE drug_drug SET search_vector = setweight(to_tsvector(COALESCE(key, '')), 'A')
+                    || setweight(to_tsvector(COALESCE(name, '')), 'B');
+                UPDATE drug_prescription SET search_vector = setweight(to_tsvector(COALESCE(name, '')), 'A')
+                    || setweight(to_tsvector(COALESCE(status, '')), 'B');
+            ''',
+            reverse_sql='''
+                DROP TRIGGER drug_drug_search_vector_trigger ON drug_drug;
+                DROP FUNCTION drug_drug_search_vector_update();
+                DROP TRIGGER drug_prescription_search_vector_trigger ON drug_prescription;
+                DROP FUNCTION drug_prescription_search_vector_update();
+            ''',
+        ),
+        migrations.AddIndex(
+            model_name='drug',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='drug_search_vector_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='prescription',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'],
+                                                           name='drug_pres_search_vector_gin'),
+        ),
+    ]
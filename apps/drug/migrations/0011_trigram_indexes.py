@@ -0,0 +1,52 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('drug', '0010_search_vector'),
+    ]
+
+    # on UPPER(column::text), the expression django compares for icontains, trigrams are case insensitive anyway
+    # so the same indexes serve the similarity search, see TrigramSearch
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            sql='''
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS drug_drug_name_trgm
+                ON drug_drug USING gin (UPPER(name::text) gin_trgm_ops);
+            ''',
+            reverse_sql='''
+                DROP INDEX CONCURRENTLY IF EXISTS drug_drug_name_trgm;
+            ''',
+        ),
+        migrations.RunSQL(
+            sql='''
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS drug_drug_key_trgm
+                ON drug_drug USING gin (UPPER(key::text) gin_trgm_ops);
+            ''',
+            reverse_sql='''
+                DROP INDEX CONCURRENTLY IF EXISTS drug_drug_key_trgm;
+            ''',
+        ),
+        migrations.RunSQL(
+            sql='''
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS drug_category_name_trgm
+                ON drug_category USING gin (UPPER(name::text) gin_trgm_ops);
+            ''',
+            reverse_sql='''
+                DROP INDEX CONCURRENTLY IF EXISTS drug_category_name_trgm;
+            ''',
+        ),
+        migrations.RunSQL(
+            sql='''
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS drug_pharmacy_name_trgm
+                ON drug_pharmacy USING gin (UPPER(name::text) gin_trgm_ops);
+            ''',
+            reverse_sql='''
+                DROP INDEX CONCURRENTLY IF EXISTS drug_pharmacy_name_trgm;
+            ''',
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:37
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('drug', '0011_trigram_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='drug',
+            index=models.Index(fields=['modified'], name='drug_drug_modified_idx'),
+        ),
+    ]
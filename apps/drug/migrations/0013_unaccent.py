@@ -0,0 +1,100 @@
+from django.contrib.postgres.operations import UnaccentExtension
+from django.db import migrations
+
+DRUG_SEARCH_VECTOR = '''
+    setweight(to_tsvector(f_unaccent(COALESCE({row}key, ''))), 'A')
+    || setweight(to_tsvector(f_unaccent(COALESCE({row}name, ''))), 'B')
+'''
+PRESCRIPTION_SEARCH_VECTOR = '''
+    setweight(to_tsvector(f_unaccent(COALESCE({row}name, ''))), 'A')
+    || setweight(to_tsvector(f_unaccent(COALESCE({row}status, ''))), 'B')
+'''
+
+
+def replace_trigram_index(old_name, name, table, column):
+    # built before the index of 0011 is dropped, searches stay index backed during the migration
+    return migrations.RunSQL(
+        sql='''
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}
+            ON {table} USING gin (UPPER(f_unaccent({column}::text)) gin_trgm_ops);
+            DROP INDEX CONCURRENTLY IF EXISTS {old_name};
+        '''.format(old_name=old_name, name=name, table=table, column=column),
+        reverse_sql='''
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS {old_name}
+            ON {table} USING gin (UPPER({column}::text) gin_trgm_ops);
+            DROP INDEX CONCURRENTLY IF EXISTS {name};
+        '''.format(old_name=old_name, name=name, table=table, column=column),
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('drug', '0012_drug_modified_index'),
+    ]
+
+    # unaccent() is only STABLE, it depends on the search_path to find its dictionary, so it cannot be indexed.
+    # f_unaccent pins the schema of both and is declared IMMUTABLE, see apps.drug.services.unaccent
+    operations = [
+        UnaccentExtension(),
+        migrations.RunSQL(
+            sql='''
+                CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS $$
+                    SELECT public.unaccent('public.unaccent'::regdictionary, $1)
+                $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT;
+            ''',
+            reverse_sql='''
+                DROP FUNCTION IF EXISTS f_unaccent(text);
+            ''',
+        ),
+        replace_trigram_index('drug_drug_name_trgm', 'drug_drug_name_unaccent_trgm', 'drug_drug', 'name'),
+        replace_trigram_index('drug_drug_key_trgm', 'drug_drug_key_unaccent_trgm', 'drug_drug', 'key'),
+        replace_trigram_index('drug_category_name_trgm', 'drug_category_name_unaccent_trgm', 'drug_category', 'name'),
+        replace_trigram_index('drug_pharmacy_name_trgm', 'drug_pharmacy_name_unaccent_trgm', 'drug_pharmacy', 'name'),
+        # the stored vectors are folded too, PostgresFulltextSearch folds the keyword the same way
+        migrations.RunSQL(
+            sql='''
+                CREATE OR REPLACE FUNCTION drug_drug_search_vector_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := {drug_new};
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION drug_prescription_search_vector_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := {prescription_new};
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+
+                UPDATE drug_drug SET search_vector = {drug};
+                UPDATE drug_prescription SET search_vector = {prescription};
+            '''.format(drug_new=DRUG_SEARCH_VECTOR.format(row='NEW.'), drug=DRUG_SEARCH_VECTOR.format(row=''),
+                       prescription_new=PRESCRIPTION_SEARCH_VECTOR.format(row='NEW.'),
+                       prescription=PRESCRIPTION_SEARCH_VECTOR.format(row='')),
+            reverse_sql='''
+                CREATE OR REPLACE FUNCTION drug_drug_search_vector_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := setweight(to_tsvector(COALESCE(NEW.key, '')), 'A')
+                        || setweight(to_tsvector(COALESCE(NEW.name, '')), 'B');
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION drug_prescription_search_vector_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := setweight(to_tsvector(COALESCE(NEW.name, '')), 'A')
+                        || setweight(to_tsvector(COALESCE(NEW.status, '')), 'B');
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+
+                UPDATE drug_drug SET search_vector = setweight(to_tsvector(COALESCE(key, '')), 'A')
+                    || setweight(to_tsvector(COALESCE(name, '')), 'B');
+                UPDATE drug_prescription SET search_vector = setweight(to_tsvector(COALESCE(name, '')), 'A')
+                    || setweight(to_tsvector(COALESCE(status, '')), 'B');
+            ''',
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.1.2 on 2026-10-18 09:45
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('drug', '0013_unaccent'),
+    ]
+
+    # the (..., id) indexes are built before the ones they replace are dropped
+    operations = [
+        AddIndexConcurrently(
+            model_name='drug',
+            index=models.Index(fields=['modified', 'id'], name='drug_drug_modified_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='prescription',
+            index=models.Index(fields=['work_space', 'created', 'id'], name='drug_pres_ws_created_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='prescriptiondetail',
+            index=models.Index(fields=['prescription', 'created', 'id'], name='drug_detail_pres_created_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='drug',
+            name='drug_drug_modified_idx',
+        ),
+        RemoveIndexConcurrently(
+            model_name='prescription',
+            name='drug_pres_ws_created_idx',
+        ),
+    ]
@@ -1,11 +1,19 @@
 import uuid
 
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from model_utils import FieldTracker
+from model_utils.managers import SoftDeletableManager, SoftDeletableQuerySet
 from model_utils.models import TimeStampedModel, SoftDeletableModel
 
 from apps.drug.config import STATUS, IN_PROGRESS_KEY
+from apps.drug.services.drug_sales_cube import DrugSalesCubeService
+from apps.drug.services.prescription_daily_stats import PrescriptionDailyStatsService
+from apps.drug.services.stats_cache import bump_work_space_version, bump_pharmacy_version
 
 
 # Create your models here.
@@ -20,6 +28,7 @@ class Category(TimeStampedModel, SoftDeletableModel):
         return name
 
     class Meta:
+        # GIN trigram index on UPPER(f_unaccent(name)) is created in raw SQL, see migration 0013
         verbose_name = 'Category'
         verbose_name_plural = 'Categories'
 
@@ -36,11 +45,22 @@ class Drug(TimeStampedModel, SoftDeletableModel):
         MinValueValidator(0)
     ])
     key = models.CharField(max_length=50, null=True, blank=True)
+    # key (A) and name (B), see CONFIG_DRUG_RANK, set by a trigger on insert and on update of key or name
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         name = self.name if self.name else ''
         return name
 
+    class Meta:
+        # GIN trigram indexes on UPPER(f_unaccent(name)) and UPPER(f_unaccent(key)) are created in raw SQL, see
+        # migration 0013
+        indexes = [
+            GinIndex(fields=['search_vector'], name='drug_search_vector_gin'),
+            # deltas of the autocomplete index and keyset pages, see DrugAutocompleteIndex and KeysetPagination
+            models.Index(fields=['modified', 'id'], name='drug_drug_modified_id_idx'),
+        ]
+
 
 class WorkSpace(TimeStampedModel, SoftDeletableModel):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
@@ -75,6 +95,7 @@ class Pharmacy(TimeStampedModel, SoftDeletableModel):
     email = models.EmailField(null=True, blank=True, default=None)
 
     class Meta:
+        # GIN trigram index on UPPER(f_unaccent(name)) is created in raw SQL, see migration 0013
         verbose_name = 'Pharmacy'
         verbose_name_plural = 'Pharmacies'
 
@@ -83,6 +104,47 @@ class Pharmacy(TimeStampedModel, SoftDeletableModel):
         return name
 
 
+class PrescriptionQuerySet(SoftDeletableQuerySet):
+
+    def delete(self):
+        """
+        soft delete the prescriptions and take them out of PrescriptionDailyStats and DrugSalesDaily
+        in the same transaction
+        :return: number of prescriptions removed, the ones already removed are not counted
+        """
+        with transaction.atomic():
+            rows = list(self.filter(is_removed=False).select_for_update().values_list(
+                'id', 'work_space_id', 'pharmacy_id', 'created', 'status', 'total_price'))
+            if not rows:
+                return 0
+            Prescription.all_objects.filter(pk__in=[row[0] for row in rows]).update(is_removed=True)
+            PrescriptionDailyStatsService.remove_prescriptions([row[1:] for row in rows])
+            DrugSalesCubeService.remove_prescriptions(
+                [row[0] for row in rows if DrugSalesCubeService.is_counted(row[4], False)])
+
+            work_space_ids = {row[1] for row in rows}
+            pharmacy_ids = {row[2] for row in rows}
+
+            def bump():
+                for work_space_id in work_space_ids:
+                    bump_work_space_version(work_space_id)
+                for pharmacy_id in pharmacy_ids:
+                    bump_pharmacy_version(pharmacy_id)
+
+            transaction.on_commit(bump)
+        return len(rows)
+
+
+class PrescriptionManager(SoftDeletableManager):
+    """
+    save(), delete() and PrescriptionQuerySet.delete() keep PrescriptionDailyStats and DrugSalesDaily current. A
+    queryset .update() of is_removed, status, pharmacy, created or total_price and a hard delete (delete(soft=False),
+    raw SQL, the cascade of a work space or a pharmacy) bypass them, run PrescriptionDailyStatsService.rebuild and
+    DrugSalesCubeService.rebuild afterwards.
+    """
+    _queryset_class = PrescriptionQuerySet
+
+
 class Prescription(TimeStampedModel, SoftDeletableModel):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     work_space = models.ForeignKey(WorkSpace, on_delete=models.CASCADE)
@@ -94,6 +156,29 @@ class Prescription(TimeStampedModel, SoftDeletableModel):
     total_price = models.FloatField(default=0, validators=[
         MinValueValidator(0)
     ])
+    # bumped on every edit of the details, compared and swapped instead of locking the rows
+    version = models.IntegerField(default=1)
+    # name (A) and status (B), see CONFIG_PRESCRIPTION_RANK, set by a trigger on insert and on update of name or status
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    tracker = FieldTracker(fields=['pharmacy', 'status', 'total_price', 'is_removed'])
+
+    objects = PrescriptionManager()
+    # the removed prescriptions too, its delete() is the one of PrescriptionQuerySet as well
+    all_objects = models.Manager.from_queryset(PrescriptionQuerySet)()
+
+    class Meta:
+        # (pharmacy_id, created) INCLUDE (total_price, is_removed) is created in raw SQL, see migration 0005
+        indexes = [
+            # id breaks the ties of the keyset pages, see KeysetPagination
+            models.Index(fields=['work_space', 'created', 'id'], name='drug_pres_ws_created_id_idx'),
+            GinIndex(fields=['search_vector'], name='drug_pres_search_vector_gin'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # post_save receivers maintain PrescriptionDailyStats, keep them in the same transaction as the row
+        with transaction.atomic():
+            super(Prescription, self).save(*args, **kwargs)
 
 
 class PrescriptionDetail(TimeStampedModel, SoftDeletableModel):
@@ -109,3 +194,80 @@ class PrescriptionDetail(TimeStampedModel, SoftDeletableModel):
 
     class Meta:
         unique_together = ('prescription', 'drug')
+        indexes = [
+            # details of a prescription in order, by page number or by keyset
+            models.Index(fields=['prescription', 'created', 'id'], name='drug_detail_pres_created_idx'),
+        ]
+
+
+class PrescriptionDailyStats(models.Model):
+    """
+    pre-aggregated prescriptions per (work space, pharmacy, day, status), maintained on every prescription write
+    """
+    work_space = models.ForeignKey(WorkSpace, on_delete=models.CASCADE)
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE)
+    day = models.DateField()
+    status = models.CharField(max_length=11, choices=STATUS)
+    number_prescription = models.IntegerField(default=0)
+    total_price = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('work_space', 'pharmacy', 'day', 'status')
+
+
+class DrugSalesDaily(models.Model):
+    """
+    sales cube, quantity and revenue per (pharmacy, drug, day) with the work space and the drug category
+    denormalized, kept current by the deltas of every prescription write, see DrugSalesCubeService
+    """
+    work_space = models.ForeignKey(WorkSpace, on_delete=models.CASCADE)
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, null=True, on_delete=models.SET_NULL)
+    drug = models.ForeignKey(Drug, on_delete=models.CASCADE)
+    day = models.DateField()
+    quantity = models.IntegerField(default=0)
+    revenue = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('pharmacy', 'drug', 'day')
+        indexes = [
+            models.Index(fields=['work_space', 'day'], name='drug_sales_ws_day_idx'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """
+    response of a create request sent with an Idempotency-Key header, replayed to the retries of that request
+    until it expires
+    """
+    work_space = models.ForeignKey(WorkSpace, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    response_body = models.JSONField(encoder=DjangoJSONEncoder, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('work_space', 'key')
+
+
+class AuditLog(models.Model):
+    """
+    append only trail of the changes of prescriptions, their details and drugs, written in batches by
+    AuditLogBuffer, or set based by PrescriptionBulkIngestService
+    """
+    id = models.BigAutoField(primary_key=True)
+    # time of the change, not of the write
+    created = models.DateTimeField()
+    actor = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, db_constraint=False)
+    # prescription, prescription_detail or drug, see apps.drug.services.audit_log
+    entity = models.CharField(max_length=20)
+    entity_id = models.UUIDField()
+    action = models.CharField(max_length=10)
+    changes = models.JSONField(encoder=DjangoJSONEncoder, default=dict)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['entity', 'entity_id'], name='audit_log_entity_idx'),
+        ]
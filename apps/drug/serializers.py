@@ -1,10 +1,26 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
 from django.db.models import Q
 from rest_framework import serializers
 
+from apps.common.exceptions import ConflictException
+from apps.drug.config import STATUS, IN_PROGRESS_KEY
 from apps.drug.models import Drug, Category, Pharmacy, Prescription, PrescriptionDetail, WorkSpace
+from apps.drug.services.audit_log import (
+    audit_log_buffer, audit_event, audit_changes, audit_sync_events, ENTITY_PRESCRIPTION, ENTITY_DRUG,
+    ACTION_CREATED, ACTION_UPDATED)
 from apps.drug.services.custom_bulk_sync import custom_bulk_sync
+from apps.drug.services.drug_bulk_price import DrugBulkPriceService
+from apps.drug.services.drug_sales_cube import DrugSalesCubeService
+from apps.drug.services.prescription_bulk_ingest import PrescriptionBulkIngestService
+from apps.drug.services.prescription_detail_upsert import PrescriptionDetailUpsertService
+from apps.drug.services.stats_cache import bump_catalog_version
 from apps.drug.signals import signal_update_or_create_prescription
 
+PRESCRIPTION_BULK_MAX_SIZE = 10000
+DRUG_PRICE_LIST_MAX_SIZE = 50000
+
 
 # Serializers
 
@@ -16,11 +32,31 @@ class CategorySerializer(serializers.ModelSerializer):
         exclude = ['is_removed']
 
 
-class DrugSerializer(serializers.ModelSerializer):
+class AuditedSerializerMixin:
+
+    def get_actor(self):
+        request = self.context.get('request')  # noqa
+        return request.user if request else None
+
+
+class DrugSerializer(AuditedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Drug
         read_only_fields = ['created', 'updated', 'id']
-        exclude = ['is_removed']
+        exclude = ['is_removed', 'search_vector']
+
+    def create(self, validated_data):
+        drug = super(DrugSerializer, self).create(validated_data)
+        audit_log_buffer.record([audit_event(ENTITY_DRUG, drug.id, ACTION_CREATED, {
+            'name': drug.name, 'category': drug.category_id, 'price': drug.price}, self.get_actor())])
+        return drug
+
+    def update(self, instance, validated_data):
+        changes = audit_changes(instance, validated_data)
+        drug = super(DrugSerializer, self).update(instance, validated_data)
+        if changes:
+            audit_log_buffer.record([audit_event(ENTITY_DRUG, drug.id, ACTION_UPDATED, changes, self.get_actor())])
+        return drug
 
 
 class DrugDetailSerializer(DrugSerializer):
@@ -77,59 +113,184 @@ class PrescriptionDrugContentDetailSerializer(serializers.ModelSerializer):
         exclude = ['is_removed', 'created', 'modified']
 
 
+class BatchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    resolves its pk from the objects loaded by the parent BatchedRelatedListSerializer, when there is one
+    """
+    resolved = None
+
+    def to_internal_value(self, data):
+        if self.resolved is None:
+            return super(BatchedPrimaryKeyRelatedField, self).to_internal_value(data)
+        if self.pk_field is not None:
+            data = self.pk_field.to_internal_value(data)
+        try:
+            # an invalid uuid raises a django ValidationError, reported like the queryset lookup would
+            pk = self.get_queryset().model._meta.pk.to_python(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in self.resolved:
+            self.fail('does_not_exist', pk_value=data)
+        return self.resolved[pk]
+
+
+class BatchedRelatedListSerializer(serializers.ListSerializer):
+    """
+    loads the objects of every BatchedPrimaryKeyRelatedField of the items with one `filter(pk__in=...)` per field,
+    instead of one query per item
+    """
+
+    def to_internal_value(self, data):
+        fields = {name: field for name, field in self.child.fields.items()
+                  if isinstance(field, BatchedPrimaryKeyRelatedField) and not field.read_only}
+        if isinstance(data, list):
+            for name, field in fields.items():
+                queryset = field.get_queryset()
+                pks = set()
+                for item in data:
+                    try:
+                        pks.add(queryset.model._meta.pk.to_python(item.get(name)))
+                    except (AttributeError, TypeError, ValueError, DjangoValidationError):
+                        # reported by the field itself
+                        continue
+                pks.discard(None)
+                field.resolved = queryset.in_bulk(pks)
+        try:
+            return super(BatchedRelatedListSerializer, self).to_internal_value(data)
+        finally:
+            for field in fields.values():
+                field.resolved = None
+
+
+def validate_unique_drugs(value):
+    """
+    the details of a prescription are unique per drug, a repeated drug would be written twice by the same upsert
+    """
+    drug_ids = [item['drug'] for item in value]
+    if len(drug_ids) != len(set(drug_ids)):
+        raise serializers.ValidationError('a drug can only appear once in a prescription')
+    return value
+
+
 class PrescriptionDrugSerializer(serializers.ModelSerializer):
+    serializer_related_field = BatchedPrimaryKeyRelatedField
+
     class Meta:
         model = PrescriptionDetail
         read_only_fields = ['id', 'prescription']
         exclude = ['is_removed', 'created', 'modified']
+        list_serializer_class = BatchedRelatedListSerializer
+        # the column is nullable for the drugs deleted later, a new detail always has one
+        extra_kwargs = {'drug': {'required': True, 'allow_null': False}}
 
+    def validate(self, attrs):
+        # snapshot of the current drug price when the client does not send one, the drug is already loaded
+        if 'price_at_the_time' not in attrs and attrs.get('drug') is not None:
+            attrs['price_at_the_time'] = attrs['drug'].price
+        return attrs
 
-class PrescriptionDrugContentSerializer(serializers.ModelSerializer):
+
+class PrescriptionDrugContentSerializer(AuditedSerializerMixin, serializers.ModelSerializer):
     list_prescription_detail = PrescriptionDrugSerializer(many=True, write_only=True)
+    # on update, the version the client has read (or the If-Match header), the current one in the response
+    version = serializers.IntegerField(required=False)
 
     class Meta:
         model = Prescription
-        read_only_fields = ['id', 'work_space']
-        exclude = ['is_removed']
+        # computed from the prescription details
+        read_only_fields = ['id', 'work_space', 'total_price']
+        exclude = ['is_removed', 'search_vector']
+
+    @classmethod
+    def validate_list_prescription_detail(cls, value):
+        return validate_unique_drugs(value)
 
     def create(self, validated_data):
         view = self.context.get('view')
         ws = view.get_work_space(view.kwargs.get('work_space_id'))
         validated_data.update({"work_space": ws})
         list_prescription_detail_data = validated_data.pop('list_prescription_detail')
-        prescription = Prescription.objects.create(**validated_data)
-        list_prescription_detail_models = []
-        for item in list_prescription_detail_data:
-            list_prescription_detail_models.append(PrescriptionDetail(prescription=prescription, is_removed=False,
-                                                                      **item))
-
-        filters = Q(prescription=prescription)
-        self._bulk_sync(filters, list_prescription_detail_models)
+        validated_data.pop('version', None)
+        with transaction.atomic():
+            prescription = Prescription.objects.create(**validated_data)
+            list_prescription_detail_models = []
+            for item in list_prescription_detail_data:
+                list_prescription_detail_models.append(PrescriptionDetail(prescription=prescription,
+                                                                          is_removed=False, **item))
+
+            sync_result = self._bulk_sync(prescription.id, list_prescription_detail_models)
+            DrugSalesCubeService.apply_detail_changes(prescription, {}, list_prescription_detail_models)
+            prescription.total_price = self._calc_total_price(list_prescription_detail_models)
+            prescription.save(update_fields=['total_price', 'modified'])
+
+            actor = self.get_actor()
+            events = [audit_event(ENTITY_PRESCRIPTION, prescription.id, ACTION_CREATED, {
+                'pharmacy': prescription.pharmacy_id, 'status': prescription.status,
+                'total_price': prescription.total_price}, actor)]
+            events += audit_sync_events(prescription.id, sync_result, list_prescription_detail_models, actor)
+            audit_log_buffer.record(events)
         signal_update_or_create_prescription.send(self.__class__, prescription_id=prescription.id)
         return prescription
 
     def update(self, instance, validated_data):
-        list_prescription_detail_data = validated_data.get('list_prescription_detail', None)
-        if list_prescription_detail_data:
-            list_prescription_detail_data = validated_data.pop('list_prescription_detail')
-            list_prescription_detail_models = []
-            for item in list_prescription_detail_data:
-                list_prescription_detail_models.append(PrescriptionDetail(prescription=instance, is_removed=False,
-                                                                          **item))
-            filters = Q(prescription=instance)
-            self._bulk_sync(filters, list_prescription_detail_models)
-
-        res = super(PrescriptionDrugContentSerializer, self).update(instance, validated_data)
+        list_prescription_detail_data = validated_data.pop('list_prescription_detail', None)
+        expected_version = validated_data.pop('version', self.context.get('expected_version'))
+        if expected_version is None:
+            # at least nobody wrote since the prescription was read by this request
+            expected_version = instance.version
+        with transaction.atomic():
+            # compare and swap, the only lock taken is the one of the UPDATE on the prescription row
+            swapped = Prescription.objects.filter(pk=instance.pk, version=expected_version).update(
+                version=expected_version + 1)
+            if not swapped:
+                raise ConflictException(f'prescription {instance.pk} has been modified, version {expected_version} '
+                                        f'is outdated')
+            instance.version = expected_version + 1
+            actor = self.get_actor()
+            events = []
+
+            if list_prescription_detail_data:
+                list_prescription_detail_models = []
+                for item in list_prescription_detail_data:
+                    list_prescription_detail_models.append(PrescriptionDetail(prescription=instance,
+                                                                              is_removed=False, **item))
+                old_sales = DrugSalesCubeService.get_detail_sales(instance.id)
+                sync_result = self._bulk_sync(instance.id, list_prescription_detail_models)
+                DrugSalesCubeService.apply_detail_changes(instance, old_sales, list_prescription_detail_models)
+                events += audit_sync_events(instance.id, sync_result, list_prescription_detail_models, actor)
+                # saved with the other fields by the update below
+                validated_data['total_price'] = self._calc_total_price(list_prescription_detail_models)
+
+            changes = audit_changes(instance, validated_data)
+            if changes:
+                events.insert(0, audit_event(ENTITY_PRESCRIPTION, instance.id, ACTION_UPDATED, changes, actor))
+            for field, value in validated_data.items():
+                setattr(instance, field, value)
+            # the changed columns only (total_price among them when the details changed it), not a full row save
+            instance.save(update_fields=list(changes) + ['version', 'modified'])
+            # only queued if the transaction commits, never written by this request
+            audit_log_buffer.record(events)
         signal_update_or_create_prescription.send(self.__class__, prescription_id=instance.id)
-        return res
+        return instance
 
     @classmethod
-    def _bulk_sync(cls, filters, new_models: [PrescriptionDetail]):
-        custom_bulk_sync(
+    def _bulk_sync(cls, prescription_id, new_models: [PrescriptionDetail]):
+        # a new prescription is not visible to anybody else yet, an edited one is guarded by its version
+        if settings.PRESCRIPTION_DETAIL_UPSERT:
+            return PrescriptionDetailUpsertService(prescription_id).sync(new_models, lock=False)
+        return custom_bulk_sync(
             new_models=new_models,
-            filters=filters,
+            filters=Q(prescription_id=prescription_id),
+            lock=False,
             fields=['drug', 'prescription', 'quantity', 'price_at_the_time', 'is_removed'],
-            key_fields=['drug', 'prescription'])
+            key_fields=['drug_id', 'prescription_id'])
+
+    @classmethod
+    def _calc_total_price(cls, details: [PrescriptionDetail]) -> float:
+        """
+        total price of a prescription from its synced details, the stale ones have just been removed
+        """
+        return sum(item.price_at_the_time * item.quantity for item in details)
 
 
 class PrescriptionDetailSerializer(serializers.ModelSerializer):
@@ -138,15 +299,15 @@ class PrescriptionDetailSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Prescription
-        read_only_fields = ['id']
-        exclude = ['is_removed']
+        read_only_fields = ['id', 'version']
+        exclude = ['is_removed', 'search_vector']
 
 
 class PrescriptionUpdateDetailSerializer(serializers.ModelSerializer):
     class Meta:
         model = Prescription
-        read_only_fields = ['id']
-        exclude = ['is_removed', 'pharmacy', 'work_space']
+        read_only_fields = ['id', 'version']
+        exclude = ['is_removed', 'search_vector', 'pharmacy', 'work_space']
 
 
 class BulkCreateDrugSerializer(serializers.Serializer):
@@ -172,9 +333,139 @@ class BulkCreateDrugSerializer(serializers.Serializer):
         for name in self.validated_data:
             bucket.append(Drug(name=name, category=first_category, price=1))
         res = Drug.objects.bulk_create(bucket)
+        # bulk_create sends no post_save
+        transaction.on_commit(bump_catalog_version)
         return DrugSerializer(res, many=True).data
 
 
+class DrugPriceSerializer(serializers.Serializer):
+    key = serializers.CharField(max_length=50)
+    price = serializers.FloatField(min_value=0)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
+class BulkDrugPriceSerializer(AuditedSerializerMixin, serializers.Serializer):
+    """
+    either a percentage rule on a category or a price list by drug key
+    """
+    category = serializers.PrimaryKeyRelatedField(queryset=Category.objects.all(), required=False)
+    # 7 -> +7%, -5 -> -5%
+    percent = serializers.FloatField(min_value=-99, required=False)
+    prices = DrugPriceSerializer(many=True, required=False)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+    @classmethod
+    def validate_prices(cls, value):
+        if len(value) > DRUG_PRICE_LIST_MAX_SIZE:
+            raise serializers.ValidationError(f'at most {DRUG_PRICE_LIST_MAX_SIZE} prices per request')
+        return value
+
+    def validate(self, attrs):
+        is_rule = 'category' in attrs or 'percent' in attrs
+        if is_rule == ('prices' in attrs):
+            raise serializers.ValidationError('send either category and percent or prices')
+        if is_rule and ('category' not in attrs or 'percent' not in attrs):
+            raise serializers.ValidationError('a percentage rule needs both category and percent')
+        return attrs
+
+    def apply(self):
+        handler = DrugBulkPriceService(actor=self.get_actor())
+        if 'prices' in self.validated_data:
+            return handler.apply_price_list([(item['key'], item['price']) for item in self.validated_data['prices']])
+        return handler.apply_percentage(self.validated_data['category'].id, self.validated_data['percent'])
+
+
+class BulkPrescriptionDetailSerializer(serializers.Serializer):
+    drug = serializers.UUIDField()
+    quantity = serializers.IntegerField(min_value=1)
+    # defaults to the current price of the drug
+    price_at_the_time = serializers.FloatField(min_value=0, required=False, allow_null=True)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+
+class BulkPrescriptionItemSerializer(serializers.Serializer):
+    pharmacy = serializers.UUIDField()
+    status = serializers.ChoiceField(choices=STATUS, default=IN_PROGRESS_KEY)
+    note = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    name = serializers.CharField(required=False, allow_null=True, max_length=20)
+    # time of the sale on the POS, the upload time by default
+    created = serializers.DateTimeField(required=False)
+    list_prescription_detail = BulkPrescriptionDetailSerializer(many=True)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+    @classmethod
+    def validate_list_prescription_detail(cls, value):
+        return validate_unique_drugs(value)
+
+
+class BulkPrescriptionSerializer(AuditedSerializerMixin, serializers.Serializer):
+    """
+    batch of prescriptions validated in memory, the pharmacies and the drugs are resolved with one query each
+    """
+    list_prescription = BulkPrescriptionItemSerializer(many=True)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+    @classmethod
+    def validate_list_prescription(cls, value):
+        if not value:
+            raise serializers.ValidationError('list_prescription must not be empty')
+        if len(value) > PRESCRIPTION_BULK_MAX_SIZE:
+            raise serializers.ValidationError(f'at most {PRESCRIPTION_BULK_MAX_SIZE} prescriptions per batch')
+        return value
+
+    def validate(self, attrs):
+        work_space = self.context['work_space']
+        list_prescription = attrs.get('list_prescription')
+
+        pharmacy_ids = {item['pharmacy'] for item in list_prescription}
+        found_pharmacy_ids = set(Pharmacy.objects.filter(work_space=work_space, id__in=pharmacy_ids)
+                                 .values_list('id', flat=True))
+        if pharmacy_ids - found_pharmacy_ids:
+            raise serializers.ValidationError('pharmacies {} do not exist in the work space'.format(
+                ', '.join(str(item) for item in pharmacy_ids - found_pharmacy_ids)))
+
+        drug_ids = {detail['drug'] for item in list_prescription for detail in item['list_prescription_detail']}
+        drug_prices = dict(Drug.objects.filter(id__in=drug_ids).values_list('id', 'price'))
+        if drug_ids - set(drug_prices):
+            raise serializers.ValidationError('drugs {} do not exist'.format(
+                ', '.join(str(item) for item in drug_ids - set(drug_prices))))
+
+        for item in list_prescription:
+            for detail in item['list_prescription_detail']:
+                if detail.get('price_at_the_time') is None:
+                    detail['price_at_the_time'] = drug_prices[detail['drug']]
+        return attrs
+
+    def ingest(self):
+        handler = PrescriptionBulkIngestService(self.context['work_space'].id)
+        return handler.ingest(self.validated_data['list_prescription'], self.get_actor())
+
+
 class SendMailPrescriptionSerializer(serializers.Serializer):
     prescription_id = serializers.UUIDField()
 
@@ -0,0 +1,83 @@
+
+import pytz
+from django.db.models import Max, Min
+from rest_framework import serializers
+
+from apps.drug.models import Pharmacy, Prescription, WorkSpace
+from apps.drug.serializers_statistic import RECENT_RANGE_BINS
+from apps.drug.services.calc_bins_from_range_time import BIN_CHOICES
+from apps.drug.services.calc_total_price_time_unit import CalculatePriceByTimeUnitForPharmacies
+from apps.drug.services.stats_export import EXPORT_FORMATS, EXPORT_CSV, EXPORT_CHUNK_SIZE
+
+EXPORT_PRESCRIPTION_FIELDS = ['id', 'created', 'name', 'pharmacy_id', 'pharmacy__name', 'status', 'total_price',
+                              'note']
+EXPORT_PRESCRIPTION_HEADER = ['id', 'created', 'name', 'pharmacy_id', 'pharmacy_name', 'status', 'total_price',
+                              'note']
+EXPORT_PHARMACIES_STATS_HEADER = ['pharmacy_id', 'pharmacy_name', 'label', 'total_price']
+
+
+class ExportPrescriptionSerializer(serializers.Serializer):
+    export_format = serializers.ChoiceField(required=False, choices=EXPORT_FORMATS, default=EXPORT_CSV)
+    from_date = serializers.DateTimeField(required=False)
+    to_date = serializers.DateTimeField(required=False)
+    pharmacy = serializers.UUIDField(required=False)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+    def get_rows(self, work_space: WorkSpace):
+        """
+        prescriptions of the work space ordered by creation, read through a server side cursor
+        """
+        query_set = Prescription.objects.filter(work_space=work_space)
+        if self.validated_data.get('from_date'):
+            query_set = query_set.filter(created__gte=self.validated_data.get('from_date'))
+        if self.validated_data.get('to_date'):
+            query_set = query_set.filter(created__lte=self.validated_data.get('to_date'))
+        if self.validated_data.get('pharmacy'):
+            query_set = query_set.filter(pharmacy_id=self.validated_data.get('pharmacy'))
+        return query_set.order_by('created', 'id') \
+            .values_list(*EXPORT_PRESCRIPTION_FIELDS) \
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+class ExportPharmaciesPrescriptionStatisticSerializer(serializers.Serializer):
+    export_format = serializers.ChoiceField(required=False, choices=EXPORT_FORMATS, default=EXPORT_CSV)
+    type = serializers.ChoiceField(required=True, choices=BIN_CHOICES)
+    time_zone = serializers.CharField(required=False, default=pytz.utc.zone)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+    @classmethod
+    def validate_time_zone(cls, value):
+        if value not in pytz.all_timezones_set:
+            raise serializers.ValidationError(f'{value} is not a valid time zone')
+        return value
+
+    def get_rows(self, work_space: WorkSpace):
+        """
+        one (pharmacy, bin) row per line instead of the pivot built by PharmaciesPrescriptionStatisticSerializer
+        """
+        bounds = Prescription.objects.filter(work_space=work_space).aggregate(first=Min('created'),
+                                                                              last=Max('created'))
+        if not bounds['first']:
+            return iter([])
+
+        from_date = bounds['first']
+        to_date = bounds['last']
+        if self.validated_data.get('type') in RECENT_RANGE_BINS:
+            from_date = to_date - RECENT_RANGE_BINS[self.validated_data.get('type')]
+
+        pharmacy_ids = Pharmacy.objects.filter(work_space=work_space).values_list('id', flat=True)
+        stats_handler = CalculatePriceByTimeUnitForPharmacies(list(pharmacy_ids),
+                                                              self.validated_data.get('type'),
+                                                              from_date, to_date,
+                                                              self.validated_data.get('time_zone'))
+        return stats_handler.iterate(chunk_size=EXPORT_CHUNK_SIZE)
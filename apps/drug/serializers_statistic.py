@@ -1,14 +1,30 @@
 from datetime import timedelta
 from itertools import groupby
 
+import pytz
+from django.core.cache import cache
+from django.db.models import Max, Min
 from rest_framework import serializers
 
+from apps.common.exceptions import InvalidFilterException
 from apps.common.logger import logger
 from apps.drug.models import Pharmacy, Prescription, WorkSpace
 from apps.drug.services.calc_bins_from_range_time import (
-    BIN_DAYS, BIN_MONTHS, BIN_YEARS, CalculateBinsFromRangeTimeService)
+    BIN_CHOICES, BIN_DAYS, BIN_HOURS, CalculateBinsFromRangeTimeService)
 from apps.drug.services.calc_total_price_time_unit import (
     CalculatePriceByTimeUnitForPharmacy, CalculatePriceByTimeUnitForPharmacies)
+from apps.drug.services.drug_sales_cube import CUBE_BIN_CHOICES, DIMENSIONS, DrugSalesCubeService
+from apps.drug.services.drug_sales_stats import DrugSalesStatsService
+from apps.drug.services.revenue_analytics import RevenueAnalyticsService, DEFAULT_MOVING_AVERAGE_WINDOWS
+from apps.drug.services.stats_cache import get_pharmacy_version, get_stats_cache_timeout
+
+PHARMACY_STATS_CACHE_KEY = 'stats:pharmacy:{pharmacy_id}:{version}:{type}:{time_zone}'
+
+# fine grained bins only cover the most recent period instead of the whole history
+RECENT_RANGE_BINS = {
+    BIN_HOURS: timedelta(hours=48),
+    BIN_DAYS: timedelta(days=15),
+}
 
 
 class PharmacyPrescriptionStatisticSerializer(serializers.ModelSerializer):
@@ -19,53 +35,69 @@ class PharmacyPrescriptionStatisticSerializer(serializers.ModelSerializer):
         fields = ['stats']
 
     def get_stats(self, obj):
+        time_zone = self.context['request'].query_params.get('time_zone') or pytz.utc.zone
+        if time_zone not in pytz.all_timezones_set:
+            raise InvalidFilterException(f'{time_zone} is not a valid time zone')
         try:
             type_date_bin = self.context['request'].query_params.get('type', None)
-            if not type_date_bin or type_date_bin.upper() not in [BIN_DAYS, BIN_MONTHS, BIN_YEARS]:
+            if not type_date_bin or type_date_bin.upper() not in BIN_CHOICES:
                 type_date_bin = BIN_DAYS
+            type_date_bin = type_date_bin.upper()
+
+            key = PHARMACY_STATS_CACHE_KEY.format(pharmacy_id=obj.id, version=get_pharmacy_version(obj.id),
+                                                  type=type_date_bin, time_zone=time_zone)
+            res = cache.get(key)
+            if res is None:
+                res = self.__calc_stats(obj, type_date_bin, time_zone)
+                cache.set(key, res, timeout=get_stats_cache_timeout())
+            return res
+        except Exception as err:
+            logger.error('[PharmacyPrescriptionStatisticSerializer] %s' % err)
+            return {
+                'labels': [],
+                'data': []
+            }
 
-            ins_first = Prescription.objects.all().order_by('created').first()
-            ins_last = Prescription.objects.all().order_by('-created').first()
-
-            from_date = ins_first.created
-            to_date = ins_last.created
+    @classmethod
+    def __calc_stats(cls, obj, type_date_bin, time_zone):
+        bounds = Prescription.objects.filter(pharmacy=obj).aggregate(first=Min('created'), last=Max('created'))
+        if not bounds['first']:
+            return {
+                'labels': [],
+                'data': []
+            }
 
-            if type_date_bin.upper() == BIN_DAYS:
-                from_date = to_date - timedelta(days=15)
+        from_date = bounds['first']
+        to_date = bounds['last']
 
-            stats_handler = CalculatePriceByTimeUnitForPharmacy(obj.id, type_date_bin, from_date, to_date)
-            res_stats = stats_handler.run()
+        if type_date_bin in RECENT_RANGE_BINS:
+            from_date = to_date - RECENT_RANGE_BINS[type_date_bin]
 
-            bin_handler = CalculateBinsFromRangeTimeService(type_date_bin)
-            bins = bin_handler.calc_bins_from_range_time(from_date, to_date)
+        stats_handler = CalculatePriceByTimeUnitForPharmacy(obj.id, type_date_bin, from_date, to_date, time_zone)
+        res_stats = stats_handler.run()
 
-            assert len(bins) >= len(res_stats), """bin errors"""
+        bin_handler = CalculateBinsFromRangeTimeService(type_date_bin, time_zone)
+        bins = bin_handler.calc_bins_from_range_time(from_date, to_date)
 
-            res_dict = {}
-            for ele in res_stats:
-                res_dict[ele[0]] = ele[1]
+        assert len(bins) >= len(res_stats), """bin errors"""
 
-            a = Pharmacy.objects.all().values('id')
+        res_dict = {}
+        for ele in res_stats:
+            res_dict[ele[0]] = ele[1]
 
-            a_ids = (str(item['id']) for item in a)
-
-            abc = CalculatePriceByTimeUnitForPharmacies(a_ids, type_date_bin, from_date, to_date)
-            abc.run()
-
-            return {
-                'labels': bins,
-                'data': [res_dict.get(item, 0) for item in bins]
-            }
-        except Exception as err:
-            logger.error('[PharmacyPrescriptionStatisticSerializer] %s' % err)
-            return {
-                'labels': [],
-                'data': []
-            }
+        return {
+            'labels': bins,
+            'data': [res_dict.get(item, 0) for item in bins]
+        }
 
 
 class PharmaciesPrescriptionStatisticSerializer(serializers.Serializer):
-    type = serializers.ChoiceField(required=True, choices=[BIN_DAYS, BIN_MONTHS, BIN_YEARS])
+    type = serializers.ChoiceField(required=True, choices=BIN_CHOICES)
+    time_zone = serializers.CharField(required=False, default=pytz.utc.zone)
+    analytics = serializers.BooleanField(required=False, default=False)
+    moving_average_windows = serializers.ListField(child=serializers.IntegerField(min_value=2, max_value=365),
+                                                   required=False, max_length=5,
+                                                   default=DEFAULT_MOVING_AVERAGE_WINDOWS)
 
     def update(self, instance, validated_data):
         pass
@@ -73,6 +105,12 @@ class PharmaciesPrescriptionStatisticSerializer(serializers.Serializer):
     def create(self, validated_data):
         pass
 
+    @classmethod
+    def validate_time_zone(cls, value):
+        if value not in pytz.all_timezones_set:
+            raise serializers.ValidationError(f'{value} is not a valid time zone')
+        return value
+
     def get_stats(self, work_space: WorkSpace):
         try:
             ins_first = Prescription.objects.filter(work_space=work_space).order_by('created').first()
@@ -81,20 +119,26 @@ class PharmaciesPrescriptionStatisticSerializer(serializers.Serializer):
             from_date = ins_first.created
             to_date = ins_last.created
 
-            if self.validated_data.get('type') == BIN_DAYS:
-                from_date = to_date - timedelta(days=15)
+            if self.validated_data.get('type') in RECENT_RANGE_BINS:
+                from_date = to_date - RECENT_RANGE_BINS[self.validated_data.get('type')]
 
             pharmacy_ids = Pharmacy.objects.filter(work_space=work_space).values_list('id', flat=True)
             pharmacy_ids = [str(item) for item in pharmacy_ids]
 
             stats_handler = CalculatePriceByTimeUnitForPharmacies(pharmacy_ids,
                                                                   self.validated_data.get('type'),
-                                                                  from_date, to_date)
+                                                                  from_date, to_date,
+                                                                  self.validated_data.get('time_zone'))
             res_stats = stats_handler.run()
 
-            bin_handler = CalculateBinsFromRangeTimeService(self.validated_data.get('type'))
+            bin_handler = CalculateBinsFromRangeTimeService(self.validated_data.get('type'),
+                                                            self.validated_data.get('time_zone'))
             bins = bin_handler.calc_bins_from_range_time(from_date, to_date)
 
+            if self.validated_data.get('analytics'):
+                analytics_handler = RevenueAnalyticsService(res_stats, bins)
+                return analytics_handler.run(self.validated_data.get('moving_average_windows'))
+
             rows = []
 
             for group_key, group_value in groupby(res_stats, lambda x: x[0]):
@@ -124,3 +168,130 @@ class PharmaciesPrescriptionStatisticSerializer(serializers.Serializer):
                 'labels': [],
                 'rows': []
             }
+
+
+class DrugSalesStatisticSerializer(serializers.Serializer):
+    type = serializers.ChoiceField(required=True, choices=BIN_CHOICES)
+    time_zone = serializers.CharField(required=False, default=pytz.utc.zone)
+    from_date = serializers.DateTimeField(required=False)
+    to_date = serializers.DateTimeField(required=False)
+    pharmacy = serializers.UUIDField(required=False)
+    limit = serializers.IntegerField(required=False, default=10, min_value=1, max_value=100)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+    @classmethod
+    def validate_time_zone(cls, value):
+        if value not in pytz.all_timezones_set:
+            raise serializers.ValidationError(f'{value} is not a valid time zone')
+        return value
+
+    def validate(self, attrs):
+        from_date = attrs.get('from_date')
+        to_date = attrs.get('to_date')
+        if from_date and to_date and from_date > to_date:
+            raise serializers.ValidationError('from_date must be before to_date')
+        return attrs
+
+    def get_stats(self, work_space: WorkSpace):
+        type_date_bin = self.validated_data.get('type')
+        time_zone = self.validated_data.get('time_zone')
+        from_date = self.validated_data.get('from_date')
+        to_date = self.validated_data.get('to_date')
+
+        if not from_date or not to_date:
+            bounds = Prescription.objects.filter(work_space=work_space).aggregate(first=Min('created'),
+                                                                                  last=Max('created'))
+            if not bounds['first']:
+                return {'labels': [], 'top_quantity': [], 'top_revenue': [], 'rows': [], 'categories': []}
+            to_date = to_date or bounds['last']
+            if not from_date:
+                from_date = bounds['first']
+                if type_date_bin in RECENT_RANGE_BINS:
+                    from_date = to_date - RECENT_RANGE_BINS[type_date_bin]
+
+        stats_handler = DrugSalesStatsService(work_space.id, type_date_bin, from_date, to_date,
+                                              pharmacy_id=self.validated_data.get('pharmacy'),
+                                              limit=self.validated_data.get('limit'),
+                                              tz=time_zone)
+        top_quantity, top_revenue = stats_handler.get_top_drugs()
+        categories = stats_handler.get_category_revenue()
+        res_series = stats_handler.get_drug_series([item['id'] for item in top_revenue])
+
+        bin_handler = CalculateBinsFromRangeTimeService(type_date_bin, time_zone)
+        bins = bin_handler.calc_bins_from_range_time(from_date, to_date)
+
+        series = {}
+        for group_key, group_value in groupby(res_series, lambda x: x[0]):
+            # 1, 2 -> index of bin name and value
+            series[group_key] = {ele[1]: ele[2] for ele in group_value}
+
+        rows = [{
+            'id': item['id'],
+            'name': item['name'],
+            'data': [series.get(item['id'], {}).get(label, 0) for label in bins]
+        } for item in top_revenue]
+
+        return {
+            'labels': bins,
+            'top_quantity': top_quantity,
+            'top_revenue': top_revenue,
+            'rows': rows,
+            'categories': categories
+        }
+
+
+class DrugSalesCubeSerializer(serializers.Serializer):
+    type = serializers.ChoiceField(required=True, choices=CUBE_BIN_CHOICES)
+    dimensions = serializers.ListField(child=serializers.ChoiceField(choices=list(DIMENSIONS)), required=False,
+                                       default=list)
+    from_date = serializers.DateTimeField(required=False)
+    to_date = serializers.DateTimeField(required=False)
+    pharmacies = serializers.ListField(child=serializers.UUIDField(), required=False)
+    categories = serializers.ListField(child=serializers.UUIDField(), required=False)
+    drugs = serializers.ListField(child=serializers.UUIDField(), required=False)
+
+    def update(self, instance, validated_data):
+        pass
+
+    def create(self, validated_data):
+        pass
+
+    def validate(self, attrs):
+        from_date = attrs.get('from_date')
+        to_date = attrs.get('to_date')
+        if from_date and to_date and from_date > to_date:
+            raise serializers.ValidationError('from_date must be before to_date')
+        return attrs
+
+    def get_stats(self, work_space: WorkSpace):
+        type_date_bin = self.validated_data.get('type')
+        from_date = self.validated_data.get('from_date')
+        to_date = self.validated_data.get('to_date')
+
+        if not from_date or not to_date:
+            bounds = Prescription.objects.filter(work_space=work_space).aggregate(first=Min('created'),
+                                                                                  last=Max('created'))
+            if not bounds['first']:
+                return {'labels': [], 'dimensions': self.validated_data.get('dimensions'), 'rows': []}
+            from_date = from_date or bounds['first']
+            to_date = to_date or bounds['last']
+
+        stats_handler = DrugSalesCubeService(work_space.id, type_date_bin, from_date, to_date,
+                                             dimensions=self.validated_data.get('dimensions'),
+                                             pharmacy_ids=self.validated_data.get('pharmacies'),
+                                             category_ids=self.validated_data.get('categories'),
+                                             drug_ids=self.validated_data.get('drugs'))
+        rows = stats_handler.run()
+
+        # the cube is bucketed by UTC day
+        bin_handler = CalculateBinsFromRangeTimeService(type_date_bin)
+        return {
+            'labels': bin_handler.calc_bins_from_range_time(from_date, to_date),
+            'dimensions': stats_handler.dimensions,
+            'rows': rows
+        }
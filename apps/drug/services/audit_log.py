@@ -0,0 +1,195 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from apps.common.logger import logger
+
+ENTITY_PRESCRIPTION = 'prescription'
+ENTITY_PRESCRIPTION_DETAIL = 'prescription_detail'
+ENTITY_DRUG = 'drug'
+
+ACTION_CREATED = 'created'
+ACTION_UPDATED = 'updated'
+ACTION_DELETED = 'deleted'
+
+
+def audit_actor_id(actor):
+    """
+    :param actor: user who made the change, None for the system
+    :return: id of the user, None for the system or an anonymous user
+    """
+    return actor.id if actor and actor.is_authenticated else None
+
+
+def audit_event(entity, entity_id, action, changes=None, actor=None):
+    """
+    :param changes: {field: new value} or {field: [old value, new value]}, json serializable
+    :param actor: user who made the change, None for the system
+    """
+    return {
+        'created': timezone.now(),
+        'actor_id': audit_actor_id(actor),
+        'entity': entity,
+        'entity_id': entity_id,
+        'action': action,
+        'changes': changes or {},
+    }
+
+
+def audit_changes(instance, validated_data) -> dict:
+    """
+    {field: [old value, new value]} of the validated data of a serializer update that differ from the instance,
+    related objects are compared and logged by primary key
+    """
+    changes = {}
+    for field, value in validated_data.items():
+        old_value = getattr(instance, field, None)
+        if isinstance(old_value, models.Model):
+            old_value = old_value.pk
+        if isinstance(value, models.Model):
+            value = value.pk
+        if old_value != value:
+            changes[field] = [old_value, value]
+    return changes
+
+
+def audit_sync_events(prescription_id, sync_result, details, actor=None):
+    """
+    one event per prescription detail written by a sync, see custom_bulk_sync and PrescriptionDetailUpsertService
+    :param details: the PrescriptionDetail objects synced, with the id of their row
+    """
+    by_id = {item.pk: item for item in details}
+    events = []
+    for action in [ACTION_CREATED, ACTION_UPDATED]:
+        for detail_id in sync_result['ids'][action]:
+            item = by_id.get(detail_id)
+            changes = {'prescription': prescription_id}
+            if item is not None:
+                changes.update({'drug': item.drug_id, 'quantity': item.quantity,
+                                'price_at_the_time': item.price_at_the_time})
+            events.append(audit_event(ENTITY_PRESCRIPTION_DETAIL, detail_id, action, changes, actor))
+    for detail_id in sync_result['ids'][ACTION_DELETED]:
+        events.append(audit_event(ENTITY_PRESCRIPTION_DETAIL, detail_id, ACTION_DELETED,
+                                  {'prescription': prescription_id}, actor))
+    return events
+
+
+class AuditLogBuffer:
+    """
+    in process buffer of audit events, written to drug_auditlog in batches by a background thread so the request
+    never waits for the audit INSERTs. The queue is bounded, events are dropped (and counted) when it is full.
+    """
+
+    def __init__(self, max_size, batch_size, flush_interval):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self._reported_dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def record(self, events):
+        """
+        queue events once the current transaction commits, nothing is logged for a rolled back change
+        """
+        if not settings.AUDIT_LOG_ENABLED or not events:
+            return
+        transaction.on_commit(lambda: self.put(events))
+
+    def put(self, events):
+        self.__ensure_worker()
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+
+    def flush(self):
+        """
+        write every queued event from the calling thread, e.g. before the process exits
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self.__write(batch)
+                batch = []
+        if batch:
+            self.__write(batch)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'dropped': self.dropped,
+            'flushed': self.flushed,
+            'failed': self.failed,
+        }
+
+    def __ensure_worker(self):
+        # a forked worker process does not inherit the thread
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.__run, name='audit-log-buffer', daemon=True)
+            self._thread.start()
+
+    def __run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.__write(batch)
+
+    def __write(self, batch):
+        audit_log_model = apps.get_model('drug', 'AuditLog')
+        try:
+            audit_log_model.objects.bulk_create([audit_log_model(**event) for event in batch])
+            with self._lock:
+                self.flushed += len(batch)
+        except Exception as err:
+            with self._lock:
+                self.failed += len(batch)
+            logger.error('[AuditLogBuffer] {} events lost: {}'.format(len(batch), err))
+            # the connection may be broken, e.g. the server restarted, the next batch opens a new one
+            connection.close()
+        else:
+            # do not keep an idle connection open in the background thread
+            if self.queue.empty() and threading.current_thread() is self._thread:
+                connection.close()
+
+        stats = self.stats()
+        logger.debug('[AuditLogBuffer] wrote {} events, queue depth {}'.format(len(batch), stats['queue_depth']))
+        if stats['dropped'] > self._reported_dropped:
+            logger.warning('[AuditLogBuffer] queue full, {} events dropped ({} in total), queue depth {}'.format(
+                stats['dropped'] - self._reported_dropped, stats['dropped'], stats['queue_depth']))
+            self._reported_dropped = stats['dropped']
+
+
+audit_log_buffer = AuditLogBuffer(max_size=settings.AUDIT_LOG_QUEUE_SIZE, batch_size=settings.AUDIT_LOG_BATCH_SIZE,
+                                  flush_interval=settings.AUDIT_LOG_FLUSH_INTERVAL)
+atexit.register(audit_log_buffer.flush)
@@ -1,34 +1,115 @@
 from datetime import timedelta, datetime
 
-BIN_MONTHS = 'MONTHS'
+import pytz
+
+BIN_HOURS = 'HOURS'
 BIN_DAYS = 'DAYS'
+BIN_WEEKS = 'WEEKS'
+BIN_MONTHS = 'MONTHS'
+BIN_QUARTERS = 'QUARTERS'
 BIN_YEARS = 'YEARS'
 
+BIN_CHOICES = [BIN_HOURS, BIN_DAYS, BIN_WEEKS, BIN_MONTHS, BIN_QUARTERS, BIN_YEARS]
+
+# postgres to_char formats, labels built here must be identical to the ones built in SQL
+SQL_DATE_FORMATS = {
+    BIN_HOURS: 'YYYY-MM-DD HH24:00',
+    BIN_DAYS: 'YYYY-MM-DD',
+    BIN_WEEKS: 'IYYY-"W"IW',
+    BIN_MONTHS: 'YYYY-MM',
+    BIN_QUARTERS: 'YYYY-"Q"Q',
+    BIN_YEARS: 'YYYY',
+}
+
+# postgres date_trunc units, rows are grouped on the truncated timestamp and only the groups are formatted
+SQL_DATE_TRUNC_UNITS = {
+    BIN_HOURS: 'hour',
+    BIN_DAYS: 'day',
+    BIN_WEEKS: 'week',
+    BIN_MONTHS: 'month',
+    BIN_QUARTERS: 'quarter',
+    BIN_YEARS: 'year',
+}
+
+
+def get_time_zone(tz=None):
+    """
+    pytz time zone from a name or a tzinfo, UTC by default
+    """
+    if not tz:
+        return pytz.utc
+    if isinstance(tz, str):
+        return pytz.timezone(tz)
+    return tz
+
 
 class CalculateBinsFromRangeTimeService:
 
-    def __init__(self, choice):
-        assert choice in [BIN_MONTHS, BIN_DAYS, BIN_YEARS], 'choice must be in [MONTHS, DAYS, YEARS]'
+    def __init__(self, choice, tz=None):
+        assert choice in BIN_CHOICES, 'choice must be in [{}]'.format(', '.join(BIN_CHOICES))
         self.choice = choice
+        self.tz = get_time_zone(tz)
 
     def extract_bin_from_date(self, dt):
+        dt = dt.astimezone(self.tz)
+        if self.choice == BIN_HOURS:
+            return dt.strftime('%Y-%m-%d %H:00')
         if self.choice == BIN_DAYS:
             return dt.strftime('%Y-%m-%d')
+        if self.choice == BIN_WEEKS:
+            iso_year, iso_week, _ = dt.isocalendar()
+            return '{}-W{:02d}'.format(iso_year, iso_week)
         if self.choice == BIN_MONTHS:
             return dt.strftime('%Y-%m')
+        if self.choice == BIN_QUARTERS:
+            return '{}-Q{}'.format(dt.year, (dt.month - 1) // 3 + 1)
         if self.choice == BIN_YEARS:
             return dt.strftime('%Y')
 
-    def increase_dt_by_unit(self, dt):
-        return dt + timedelta(days=1)
-
     def calc_bins_from_range_time(self, from_date: datetime, to_date: datetime):
-        res = []
+        return list(self.iter_bins(from_date, to_date))
+
+    def iter_bins(self, from_date: datetime, to_date: datetime):
+        """
+        yield the bin labels covering [from_date, to_date], jumping from one bin to the next one
+        so the cost only depends on the number of bins
+        """
+        if from_date > to_date:
+            return
+
+        if self.choice == BIN_HOURS:
+            yield from self.__iter_hours(from_date, to_date)
+            return
+
+        start = from_date.astimezone(self.tz).date()
+        end = to_date.astimezone(self.tz).date()
+
+        if self.choice == BIN_DAYS:
+            for offset in range((end - start).days + 1):
+                yield (start + timedelta(days=offset)).isoformat()
+        elif self.choice == BIN_WEEKS:
+            monday = start - timedelta(days=start.weekday())
+            for offset in range(0, (end - monday).days + 1, 7):
+                iso_year, iso_week, _ = (monday + timedelta(days=offset)).isocalendar()
+                yield '{}-W{:02d}'.format(iso_year, iso_week)
+        elif self.choice == BIN_MONTHS:
+            for index in range(start.year * 12 + start.month - 1, end.year * 12 + end.month):
+                yield '{}-{:02d}'.format(index // 12, index % 12 + 1)
+        elif self.choice == BIN_QUARTERS:
+            for index in range(start.year * 4 + (start.month - 1) // 3, end.year * 4 + (end.month - 1) // 3 + 1):
+                yield '{}-Q{}'.format(index // 4, index % 4 + 1)
+        elif self.choice == BIN_YEARS:
+            for year in range(start.year, end.year + 1):
+                yield str(year)
 
-        current_dt = from_date
+    def __iter_hours(self, from_date: datetime, to_date: datetime):
+        # step in UTC so DST transitions neither skip nor loop, labels are taken in local time
+        local_start = from_date.astimezone(self.tz).replace(minute=0, second=0, microsecond=0)
+        current_dt = self.tz.normalize(local_start).astimezone(pytz.utc)
+        last = None
         while current_dt <= to_date:
             val = self.extract_bin_from_date(current_dt)
-            if val not in res:
-                res.append(val)
-            current_dt = self.increase_dt_by_unit(current_dt)
-        return res
+            if val != last:
+                yield val
+                last = val
+            current_dt += timedelta(hours=1)
@@ -1,15 +1,26 @@
+import pytz
 from django.db import connection
 
 from apps.common.logger import logger
-from apps.drug.services.calc_bins_from_range_time import BIN_MONTHS, BIN_DAYS, BIN_YEARS
+from apps.drug.services.calc_bins_from_range_time import (
+    BIN_CHOICES, BIN_HOURS, SQL_DATE_FORMATS, SQL_DATE_TRUNC_UNITS, get_time_zone)
+from apps.drug.services.prescription_daily_stats import TABLE_DAILY_STATS, PrescriptionDailyStatsService
+
+
+def can_use_daily_stats(choice, tz) -> bool:
+    """
+    the daily stats are bucketed by UTC day, they can answer any bin at least one day wide in UTC
+    """
+    return choice != BIN_HOURS and tz.zone == pytz.utc.zone
 
 
 class CalculatePriceByTimeUnitForPharmacy:
 
-    def __init__(self, pharmacy_id, choice, from_date, to_date):
-        assert choice in [BIN_MONTHS, BIN_DAYS, BIN_YEARS], 'choice must be in [MONTHS, DAYS, YEARS]'
+    def __init__(self, pharmacy_id, choice, from_date, to_date, tz=None):
+        assert choice in BIN_CHOICES, 'choice must be in [{}]'.format(', '.join(BIN_CHOICES))
         self.choice = choice
         self.pharmacy_id = pharmacy_id
+        self.tz = get_time_zone(tz)
 
         self.from_date = from_date
         self.to_date = to_date
@@ -17,49 +28,53 @@ class CalculatePriceByTimeUnitForPharmacy:
     @property
     def __build_main_query(self):
         query = '''
-                SELECT sub.date_fmt, SUM(sub.total_price) as total_price
+                SELECT to_char(sub.bucket, %(date_fmt)s) AS date_fmt, sub.total_price
                 FROM (
                     {sub_query}
-                ) as sub
-                GROUP BY sub.date_fmt;
+                ) AS sub
+                ORDER BY sub.bucket;
                 '''.format(sub_query=self.__build_sub_query)
         return query
 
     @property
     def __build_sub_query(self):
-        query = '''
-                SELECT id, total_price, lateral_date_unit.date_fmt as date_fmt
-                FROM drug_prescription
-                
-                LEFT JOIN LATERAL (
-                    SELECT to_char(created, '{date_fmt}') as date_fmt
-                ) AS lateral_date_unit ON TRUE
-                
-                WHERE pharmacy_id = '{pharmacy_id}' AND created BETWEEN '{from_date}' AND '{to_date}'
-                ORDER BY date_fmt
-                '''.format(date_fmt=self.__get_date_fmt,
-                           pharmacy_id=self.pharmacy_id,
-                           from_date=self.from_date,
-                           to_date=self.to_date)
+        if can_use_daily_stats(self.choice, self.tz):
+            query = '''
+                    SELECT date_trunc(%(date_unit)s, day::timestamp) AS bucket, SUM(total_price) AS total_price
+                    FROM {table}
+                    WHERE pharmacy_id = %(pharmacy_id)s AND day BETWEEN %(from_day)s AND %(to_day)s
+                    GROUP BY bucket
+                    '''.format(table=TABLE_DAILY_STATS)
+        else:
+            # served by the (pharmacy_id, created) INCLUDE (total_price, is_removed) index
+            query = '''
+                    SELECT date_trunc(%(date_unit)s, created AT TIME ZONE %(tz)s) AS bucket,
+                        SUM(total_price) AS total_price
+                    FROM drug_prescription
+                    WHERE pharmacy_id = %(pharmacy_id)s AND created BETWEEN %(from_date)s AND %(to_date)s
+                        AND is_removed = FALSE
+                    GROUP BY bucket
+                    '''
         return query
 
     @property
-    def __get_date_fmt(self):
-        date_fmt = ''
-
-        if self.choice == BIN_DAYS:
-            date_fmt = 'YYYY-MM-DD'
-        if self.choice == BIN_MONTHS:
-            date_fmt = 'YYYY-MM'
-        if self.choice == BIN_YEARS:
-            date_fmt = 'YYYY'
-        return date_fmt
+    def __build_params(self):
+        return {
+            'date_fmt': SQL_DATE_FORMATS[self.choice],
+            'date_unit': SQL_DATE_TRUNC_UNITS[self.choice],
+            'tz': self.tz.zone,
+            'pharmacy_id': str(self.pharmacy_id),
+            'from_date': self.from_date,
+            'to_date': self.to_date,
+            'from_day': PrescriptionDailyStatsService.get_day(self.from_date),
+            'to_day': PrescriptionDailyStatsService.get_day(self.to_date)
+        }
 
     def run(self):
         query = self.__build_main_query
         with connection.cursor() as cursor:
             try:
-                cursor.execute(query)
+                cursor.execute(query, self.__build_params)
                 res = cursor.fetchall()
                 return res
             except Exception as err:
@@ -69,10 +84,11 @@ class CalculatePriceByTimeUnitForPharmacy:
 
 class CalculatePriceByTimeUnitForPharmacies:
 
-    def __init__(self, pharmacy_ids: [str], choice, from_date, to_date):
-        assert choice in [BIN_MONTHS, BIN_DAYS, BIN_YEARS], 'choice must be in [MONTHS, DAYS, YEARS]'
+    def __init__(self, pharmacy_ids: [str], choice, from_date, to_date, tz=None):
+        assert choice in BIN_CHOICES, 'choice must be in [{}]'.format(', '.join(BIN_CHOICES))
         self.choice = choice
         self.pharmacy_ids = pharmacy_ids
+        self.tz = get_time_zone(tz)
 
         self.from_date = from_date
         self.to_date = to_date
@@ -80,68 +96,76 @@ class CalculatePriceByTimeUnitForPharmacies:
     @property
     def __build_main_query(self):
         query = '''
-                   SELECT main_query.pharmacy_id, lateral_pharmacy.name, main_query.date_fmt, main_query.sum_total
+                   SELECT main_query.pharmacy_id, drug_pharmacy.name, to_char(main_query.bucket, %(date_fmt)s),
+                       main_query.sum_total
                    FROM (
-                       SELECT sub_query.pharmacy_id, sub_query.date_fmt, SUM(sub_query.total_price) AS sum_total
-                       FROM (
-                           {sub_query}
-                       ) AS sub_query
-                       GROUP BY sub_query.pharmacy_id, sub_query.date_fmt
-                       ORDER BY sub_query.pharmacy_id, sub_query.date_fmt
+                       {sub_query}
                    ) AS main_query
-                   LEFT JOIN 
-                    LATERAL (
-                        SELECT name
-                        FROM drug_pharmacy
-                        WHERE drug_pharmacy.id = main_query.pharmacy_id
-                   ) AS lateral_pharmacy ON TRUE
-                   ;
+                   JOIN drug_pharmacy ON drug_pharmacy.id = main_query.pharmacy_id
+                   ORDER BY main_query.pharmacy_id, main_query.bucket;
                    '''.format(sub_query=self.__build_sub_query)
         return query
 
     @property
     def __build_sub_query(self):
-        query = '''
-                    SELECT total_price, lateral_date_unit.date_fmt as date_fmt, pharmacy_id
+        if can_use_daily_stats(self.choice, self.tz):
+            query = '''
+                    SELECT pharmacy_id, date_trunc(%(date_unit)s, day::timestamp) AS bucket,
+                        SUM(total_price) AS sum_total
+                    FROM {table}
+                    WHERE pharmacy_id = ANY(%(pharmacy_ids)s::uuid[])
+                        AND day BETWEEN %(from_day)s AND %(to_day)s
+                    GROUP BY pharmacy_id, bucket
+                    '''.format(table=TABLE_DAILY_STATS)
+        else:
+            # served by the (pharmacy_id, created) INCLUDE (total_price, is_removed) index
+            query = '''
+                    SELECT pharmacy_id, date_trunc(%(date_unit)s, created AT TIME ZONE %(tz)s) AS bucket,
+                        SUM(total_price) AS sum_total
                     FROM drug_prescription
-
-                    LEFT JOIN LATERAL (
-                        SELECT to_char(created, '{date_fmt}') as date_fmt
-                    ) AS lateral_date_unit ON TRUE
-
-                    WHERE pharmacy_id IN {list_pharmacy_ids} AND created BETWEEN '{from_date}' AND '{to_date}'
-                    ORDER BY date_fmt
-                    '''.format(date_fmt=self.__get_date_fmt,
-                               list_pharmacy_ids=self.__get_list_pharmacy_ids,
-                               from_date=self.from_date,
-                               to_date=self.to_date)
+                    WHERE pharmacy_id = ANY(%(pharmacy_ids)s::uuid[])
+                        AND created BETWEEN %(from_date)s AND %(to_date)s AND is_removed = FALSE
+                    GROUP BY pharmacy_id, bucket
+                    '''
         return query
 
     @property
-    def __get_list_pharmacy_ids(self):
-        res = ["'{}'".format(item) for item in self.pharmacy_ids]
-        res = ", ".join(res)
-        return '''({})'''.format(res)
-
-    @property
-    def __get_date_fmt(self):
-        date_fmt = ''
-
-        if self.choice == BIN_DAYS:
-            date_fmt = 'YYYY-MM-DD'
-        if self.choice == BIN_MONTHS:
-            date_fmt = 'YYYY-MM'
-        if self.choice == BIN_YEARS:
-            date_fmt = 'YYYY'
-        return date_fmt
+    def __build_params(self):
+        return {
+            'date_fmt': SQL_DATE_FORMATS[self.choice],
+            'date_unit': SQL_DATE_TRUNC_UNITS[self.choice],
+            'tz': self.tz.zone,
+            'pharmacy_ids': [str(item) for item in self.pharmacy_ids],
+            'from_date': self.from_date,
+            'to_date': self.to_date,
+            'from_day': PrescriptionDailyStatsService.get_day(self.from_date),
+            'to_day': PrescriptionDailyStatsService.get_day(self.to_date)
+        }
 
     def run(self):
         query = self.__build_main_query
         with connection.cursor() as cursor:
             try:
-                cursor.execute(query)
+                cursor.execute(query, self.__build_params)
                 res = cursor.fetchall()
                 return res
             except Exception as err:
                 logger.error('[CalculatePriceByTimeUnitForPharmacies] {}'.format(err))
                 raise err
+
+    def iterate(self, chunk_size=2000):
+        """
+        same rows as run() read through a server side cursor, chunk_size rows at a time
+        """
+        query = self.__build_main_query
+        with connection.chunked_cursor() as cursor:
+            try:
+                cursor.execute(query, self.__build_params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+            except Exception as err:
+                logger.error('[CalculatePriceByTimeUnitForPharmacies] {}'.format(err))
+                raise err
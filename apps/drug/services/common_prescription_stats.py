@@ -1,43 +1,65 @@
-from datetime import datetime
+from datetime import datetime, time, timedelta, timezone
 
-from django.db.models import Sum
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
 
 from apps.drug.config import CANCELLED_KEY, DONE_KEY, IN_PROGRESS_KEY
-from apps.drug.models import Prescription, WorkSpace
+from apps.drug.models import Prescription, PrescriptionDailyStats, WorkSpace
+from apps.drug.services.stats_cache import get_work_space_version, get_stats_cache_timeout
+
+COMMON_STATS_CACHE_KEY = 'stats:common:{work_space_id}:{version}:{date}'
+MONEY_STATUSES = [DONE_KEY, IN_PROGRESS_KEY]
 
 
 class CommonPrescriptionStatsService:
 
-    def __init__(self, work_space: WorkSpace, date):
+    def __init__(self, work_space: WorkSpace, date, use_cache=False):
         self.date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f%z")
         self.work_space = work_space
+        self.use_cache = use_cache
 
-    def get_total_number_prescription(self):
+    def compute(self):
         """
-        get number of total prescription
+        number of prescriptions (total, cancelled, done) and money since date, in one aggregate query
         """
-        return Prescription.objects.filter(work_space=self.work_space, created__gte=self.date).count()
+        if not self.use_cache:
+            return self.__aggregate()
 
-    def get_total_number_prescription_cancelled(self):
-        """
-        CANCELLED
-        """
-        return Prescription.objects.filter(work_space=self.work_space,
-                                           created__gte=self.date,
-                                           status=CANCELLED_KEY).count()
+        key = COMMON_STATS_CACHE_KEY.format(work_space_id=self.work_space.id,
+                                            version=get_work_space_version(self.work_space.id),
+                                            date=self.date.isoformat())
+        res = cache.get(key)
+        if res is None:
+            res = self.__aggregate()
+            cache.set(key, res, timeout=get_stats_cache_timeout())
+        return res
 
-    def get_total_number_prescription_done(self):
+    def __aggregate(self):
         """
-        DONE
+        whole UTC days since date are summed from PrescriptionDailyStats, only the partial first day
+        (when date is not a UTC midnight) is read from drug_prescription
         """
-        return Prescription.objects.filter(work_space=self.work_space,
-                                           created__gte=self.date,
-                                           status=DONE_KEY).count()
-
-    def get_total_money_prescription(self):
-        res = Prescription.objects.filter(work_space=self.work_space,
-                                          created__gte=self.date,
-                                          status__in=[DONE_KEY, IN_PROGRESS_KEY]
-                                          ).annotate(money=Sum('total_price')).first()
-        money = res.money if res and res.money else 0
-        return money
+        utc_date = self.date.astimezone(timezone.utc)
+        first_day = utc_date.date()
+        if utc_date.timetz() != time(tzinfo=timezone.utc):
+            first_day += timedelta(days=1)
+
+        res = PrescriptionDailyStats.objects.filter(work_space=self.work_space, day__gte=first_day).aggregate(
+            total_pres_works=Sum('number_prescription'),
+            total_pres_done=Sum('number_prescription', filter=Q(status=DONE_KEY)),
+            total_pres_cancelled=Sum('number_prescription', filter=Q(status=CANCELLED_KEY)),
+            money=Sum('total_price', filter=Q(status__in=MONEY_STATUSES))
+        )
+
+        first_day_start = datetime.combine(first_day, time(), tzinfo=timezone.utc)
+        if utc_date < first_day_start:
+            partial = Prescription.objects.filter(work_space=self.work_space, created__gte=self.date,
+                                                  created__lt=first_day_start).aggregate(
+                total_pres_works=Count('id'),
+                total_pres_done=Count('id', filter=Q(status=DONE_KEY)),
+                total_pres_cancelled=Count('id', filter=Q(status=CANCELLED_KEY)),
+                money=Sum('total_price', filter=Q(status__in=MONEY_STATUSES))
+            )
+            res = {key: (res[key] or 0) + (partial[key] or 0) for key in res}
+
+        return {key: value if value else 0 for key, value in res.items()}
@@ -5,7 +5,7 @@ from apps.common.logger import logger
 
 def custom_bulk_sync(new_models, key_fields, filters, batch_size=None, fields=None, skip_creates=False,
                      skip_updates=False,
-                     skip_deletes=False):
+                     skip_deletes=False, lock=True):
     """ Combine bulk create, update, and delete.  Make the DB match a set of in-memory objects.
 
     `new_models`: Django ORM objects that are the desired state.  They may or may not have `id` set.
@@ -18,6 +18,12 @@ def custom_bulk_sync(new_models, key_fields, filters, batch_size=None, fields=No
     `skip_creates`: If truthy, will not perform any object creations needed to fully sync. Defaults to not skip.
     `skip_updates`: If truthy, will not perform any object updates needed to fully sync. Defaults to not skip.
     `skip_deletes`: If truthy, will not perform any object deletions needed to fully sync. Defaults to not skip.
+    `lock`: If falsy, the existing rows are not locked with SELECT ... FOR UPDATE, for callers serializing the sync
+            themselves (e.g. with a version check on the parent row). Defaults to lock.
+
+    Existing rows are only written when one of `fields` differs from the database, rows sharing the same set of
+    changed fields are updated together.
+    Returns `{"stats": {...}, "ids": {"created": [...], "updated": [...], "deleted": [...], "unchanged": [...]}}`.
     """
     db_class = new_models[0].__class__
 
@@ -26,12 +32,16 @@ def custom_bulk_sync(new_models, key_fields, filters, batch_size=None, fields=No
         fields = [field.name
                   for field in db_class._meta.fields
                   if not field.primary_key and not field.auto_created and field.editable]
+    # compare on the column values, e.g. `drug_id` rather than a `drug` instance
+    attnames = {name: db_class._meta.get_field(name).attname for name in fields}
 
     with transaction.atomic():
         objs = db_class.all_objects.all()
         if filters:
             objs = objs.filter(filters)
-        objs = objs.only("pk", *key_fields).select_for_update()
+        objs = objs.only("pk", "is_removed", *key_fields, *fields)
+        if lock:
+            objs = objs.select_for_update()
 
         def get_key(obj):
             return tuple(getattr(obj, k) for k in key_fields)
@@ -39,7 +49,9 @@ def custom_bulk_sync(new_models, key_fields, filters, batch_size=None, fields=No
         obj_dict = {get_key(obj): obj for obj in objs}
 
         new_objs = []
-        existing_objs = []
+        # changed field names -> objects with exactly these changes, one bulk_update per group
+        changed_objs = {}
+        unchanged_objs = []
         for new_obj in new_models:
             old_obj = obj_dict.pop(get_key(new_obj), None)
             if old_obj is None:
@@ -47,32 +59,44 @@ def custom_bulk_sync(new_models, key_fields, filters, batch_size=None, fields=No
                 # Make sure the primary key field is clear.
                 new_obj.pk = None
                 new_objs.append(new_obj)
+                continue
+
+            new_obj.id = old_obj.id
+            changed_fields = tuple(name for name, attname in attnames.items()
+                                   if getattr(new_obj, attname) != getattr(old_obj, attname))
+            if changed_fields:
+                changed_objs.setdefault(changed_fields, []).append(new_obj)
             else:
-                new_obj.id = old_obj.id
-                existing_objs.append(new_obj)
+                unchanged_objs.append(new_obj)
 
         if not skip_creates:
             db_class.objects.bulk_create(new_objs, batch_size=batch_size)
 
         if not skip_updates:
-            db_class.all_objects.bulk_update(existing_objs, fields=fields, batch_size=batch_size)
+            for changed_fields, group in changed_objs.items():
+                db_class.all_objects.bulk_update(group, fields=list(changed_fields), batch_size=batch_size)
 
+        # rows already soft deleted are not deleted again
+        stale_ids = [obj.pk for obj in obj_dict.values() if not obj.is_removed]
         if not skip_deletes:
-            # delete stale objects
-            objs.filter(pk__in=[_.pk for _ in list(obj_dict.values())]).update(is_removed=True)
+            # delete stale objects, through the manager so models hooking their soft delete keep their side tables
+            db_class.objects.filter(pk__in=stale_ids).delete()
 
-        assert len(existing_objs) == len(new_models) - len(new_objs)
+        updated_objs = [obj for group in changed_objs.values() for obj in group]
+        assert len(new_objs) + len(updated_objs) + len(unchanged_objs) == len(new_models)
 
-        stats = {
-            "created": 0 if skip_creates else len(new_objs),
-            "updated": 0 if skip_updates else (len(new_models) - len(new_objs)),
-            "deleted": 0 if skip_deletes else len(obj_dict)
+        ids = {
+            "created": [] if skip_creates else [obj.pk for obj in new_objs],
+            "updated": [] if skip_updates else [obj.pk for obj in updated_objs],
+            "deleted": [] if skip_deletes else stale_ids,
+            "unchanged": [obj.pk for obj in unchanged_objs]
         }
+        stats = {key: len(value) for key, value in ids.items()}
 
         logger.debug(
-            "{}: {} created, {} updated, {} deleted.".format(
-                db_class.__name__, stats["created"], stats["updated"], stats["deleted"]
+            "{}: {} created, {} updated, {} deleted, {} unchanged.".format(
+                db_class.__name__, stats["created"], stats["updated"], stats["deleted"], stats["unchanged"]
             )
         )
 
-    return {"stats": stats}
+    return {"stats": stats, "ids": ids}
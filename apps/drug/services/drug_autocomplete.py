@@ -0,0 +1,259 @@
+import gc
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from datetime import timedelta
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import connection
+
+from apps.common.logger import logger
+
+TABLE_DRUG = 'drug_drug'
+
+AUTOCOMPLETE_DEFAULT_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# a delta reads back a little before the last seen `modified`, it is set at the start of the writing transaction
+# which may commit after a later one
+MODIFIED_OVERLAP = timedelta(seconds=60)
+# above this number of changed drugs, building the index again is cheaper than editing it; a delta copies the lists
+# once, whatever its size
+MAX_DELTA_SIZE = 5000
+
+
+def normalize(text) -> str:
+    """
+    lower case without accents and with single spaces, 'Thuốc  Đau' -> 'thuoc dau'
+    """
+    text = (text or '').casefold()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text.replace('đ', 'd'))
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(text.split())
+
+
+def get_terms(name, key) -> [str]:
+    """
+    the terms a drug is found by: the name from each of its words to the end, and the key
+    """
+    words = normalize(name).split(' ')
+    terms = {' '.join(words[index:]) for index in range(len(words))}
+    if key:
+        terms.add(normalize(key))
+    terms.discard('')
+    return sorted(terms)
+
+
+@contextmanager
+def gc_paused():
+    """
+    the index is millions of small tuples, the cyclic collector would scan them over and over while they are created
+    or copied
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+class DrugAutocompleteIndex:
+    """
+    in process prefix index of the drugs, a sorted list of terms searched with bisect, each term pointing to a compact
+    (id, name, price) tuple. Kept current from the drugs modified since the last refresh, read at most every
+    DRUG_AUTOCOMPLETE_CHECK_INTERVAL seconds: the `modified` index of the database is shared by every process, the
+    cache (locmem by default) may not be. Hard deleted drugs are only dropped by the periodic build.
+    """
+
+    def __init__(self):
+        # (terms, drugs of the terms, {drug id: (drug, terms)}), replaced as a whole so readers never need a lock
+        self._state = None
+        self._watermark = None
+        self._checked_at = 0
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    def search(self, keyword, limit=AUTOCOMPLETE_DEFAULT_LIMIT):
+        """
+        :return: up to `limit` (id, name, price) tuples of the drugs with a term starting with the keyword, ordered
+            by term
+        """
+        self.__ensure_fresh()
+        prefix = normalize(keyword)
+        if not prefix:
+            return []
+        terms, drugs, _ = self._state
+        res = []
+        seen = set()
+        index = bisect_left(terms, prefix)
+        while index < len(terms) and len(res) < limit and terms[index].startswith(prefix):
+            drug = drugs[index]
+            if drug[0] not in seen:
+                seen.add(drug[0])
+                res.append(drug)
+            index += 1
+        return res
+
+    def invalidate(self):
+        """
+        check for changes on the next search, for the drug saves of this process
+        """
+        self._checked_at = 0
+
+    def __ensure_fresh(self):
+        now = time.monotonic()
+        if self._state is not None and now - self._checked_at < settings.DRUG_AUTOCOMPLETE_CHECK_INTERVAL:
+            return
+        # only the first build is waited for, afterwards one thread checks and the others keep searching the
+        # current state until the new one replaces it
+        if not self._lock.acquire(blocking=self._state is None):
+            return
+        try:
+            if self._state is not None and now - self._checked_at < settings.DRUG_AUTOCOMPLETE_CHECK_INTERVAL:
+                return
+            if self._state is None or now - self._built_at > settings.DRUG_AUTOCOMPLETE_REBUILD_INTERVAL:
+                self.__build()
+            else:
+                self.__refresh()
+            self._checked_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def __build(self):
+        started = time.monotonic()
+        # ids as text, building a UUID per drug costs more than the rest of the build
+        with connection.cursor() as cursor:
+            # read first, a drug saved during the build is picked up by the next delta
+            cursor.execute('SELECT max(modified) FROM {table};'.format(table=TABLE_DRUG))
+            watermark = cursor.fetchone()[0]
+            # by id, the sort by term below keeps the entries of a term ordered by drug id (uuid order is the one of
+            # their text)
+            cursor.execute('SELECT id::text, name, key, price FROM {table} WHERE is_removed = FALSE ORDER BY id;'
+                           .format(table=TABLE_DRUG))
+            rows = cursor.fetchall()
+
+        entries = []
+        by_id = {}
+        with gc_paused():
+            for drug_id, name, key, price in rows:
+                drug = (drug_id, name, price)
+                terms = get_terms(name, key)
+                by_id[drug_id] = (drug, terms)
+                entries.extend((term, drug) for term in terms)
+            entries.sort(key=itemgetter(0))
+
+        self._state = ([item[0] for item in entries], [item[1] for item in entries], by_id)
+        self._watermark = watermark
+        self._built_at = time.monotonic()
+        logger.info('[DrugAutocompleteIndex] built {} terms of {} drugs in {:.0f}ms'.format(
+            len(entries), len(by_id), (time.monotonic() - started) * 1000))
+
+    def __refresh(self):
+        if self._watermark is None:
+            self.__build()
+            return
+        query = '''
+            SELECT id::text, name, key, price, is_removed, modified FROM {table}
+            WHERE modified >= %s
+            ORDER BY modified
+            LIMIT %s;
+        '''.format(table=TABLE_DRUG)
+        with connection.cursor() as cursor:
+            cursor.execute(query, [self._watermark - MODIFIED_OVERLAP, MAX_DELTA_SIZE + 1])
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        if len(rows) > MAX_DELTA_SIZE:
+            self.__build()
+            return
+
+        with gc_paused():
+            self._state = self.__apply(rows)
+        self._watermark = max([self._watermark] + [row[-1] for row in rows])
+
+    def __apply(self, rows):
+        """
+        :return: the state with the changed drugs, the searches running meanwhile keep reading the current lists.
+            by_id is edited in place, it is only read under the lock
+        """
+        terms, drugs, by_id = self._state
+        removals = []
+        insertions = []
+        swaps = []
+        for drug_id, name, key, price, is_removed, _ in rows:
+            drug = (drug_id, name, price)
+            new_terms = [] if is_removed else get_terms(name, key)
+            old_drug, old_terms = by_id.get(drug_id, (None, []))
+            if old_terms == new_terms:
+                # e.g. a new price, the drug is swapped at the place of its terms
+                if old_drug != drug and new_terms:
+                    swaps.append(drug)
+                    by_id[drug_id] = (drug, new_terms)
+                continue
+            removals += [self.__locate(terms, drugs, term, drug_id) for term in old_terms]
+            insertions += [(self.__locate(terms, drugs, term, drug_id), term, drug) for term in new_terms]
+            if is_removed:
+                by_id.pop(drug_id, None)
+            else:
+                by_id[drug_id] = (drug, new_terms)
+
+        if removals or insertions:
+            terms, drugs = self.__merge(terms, drugs, removals, insertions)
+        elif swaps:
+            drugs = list(drugs)
+        for drug in swaps:
+            for term in by_id[drug[0]][1]:
+                drugs[self.__locate(terms, drugs, term, drug[0])] = drug
+
+        logger.debug('[DrugAutocompleteIndex] {} terms removed, {} added, {} drugs swapped'.format(
+            len(removals), len(insertions), len(swaps)))
+        return terms, drugs, by_id
+
+    @staticmethod
+    def __locate(terms, drugs, term, drug_id) -> int:
+        """
+        index of the entry of the drug for the term, or the one it is inserted at; the entries of a term are ordered by
+        drug id, a common term (e.g. '500mg') is not scanned
+        """
+        low = bisect_left(terms, term)
+        high = bisect_right(terms, term, low)
+        while low < high:
+            middle = (low + high) // 2
+            if drugs[middle][0] < drug_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @staticmethod
+    def __merge(terms, drugs, removals, insertions):
+        """
+        new lists without the entries at the `removals` indexes and with the `insertions` (index in the current lists,
+        term, drug), copied slice by slice instead of shifting the lists for each change
+        """
+        changes = sorted([(index, 0, term, drug[0], drug) for index, term, drug in insertions]
+                         + [(index, 1, '', '', None) for index in removals], key=itemgetter(0, 1, 2, 3))
+        new_terms = []
+        new_drugs = []
+        start = 0
+        for index, removed, term, _, drug in changes:
+            new_terms += terms[start:index]
+            new_drugs += drugs[start:index]
+            if removed:
+                start = index + 1
+            else:
+                new_terms.append(term)
+                new_drugs.append(drug)
+                start = index
+        new_terms += terms[start:]
+        new_drugs += drugs[start:]
+        return new_terms, new_drugs
+
+
+drug_autocomplete_index = DrugAutocompleteIndex()
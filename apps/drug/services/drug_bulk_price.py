@@ -0,0 +1,106 @@
+from django.db import connection, transaction
+
+from apps.common.logger import logger
+from apps.drug.services.audit_log import audit_log_buffer, audit_event, ENTITY_DRUG, ACTION_UPDATED
+from apps.drug.services.stats_cache import bump_catalog_version
+
+TABLE_DRUG = 'drug_drug'
+
+# number of (key, price) rows joined by one UPDATE
+PRICE_LIST_CHUNK_SIZE = 1000
+
+
+class DrugBulkPriceService:
+    """
+    set based drug price updates: a percentage rule is one UPDATE per category, a price list one UPDATE joined
+    with a VALUES list per chunk. The catalog cache is invalidated once, when the transaction commits.
+    """
+
+    def __init__(self, actor=None):
+        self.actor = actor
+
+    @property
+    def __build_percentage_query(self):
+        # old.price is read from the snapshot taken before the UPDATE, the prices the rounding leaves unchanged are not
+        # rewritten
+        query = '''
+            UPDATE {table} AS drug
+            SET price = old.new_price, modified = now()
+            FROM (
+                SELECT id, price, round((price * (1 + %(percent)s / 100.0))::numeric, 2)::double precision AS new_price
+                FROM {table}
+                WHERE category_id = %(category_id)s AND is_removed = FALSE
+            ) AS old
+            WHERE old.id = drug.id AND drug.price IS DISTINCT FROM old.new_price
+            RETURNING drug.id, old.price, drug.price;
+        '''.format(table=TABLE_DRUG)
+        return query
+
+    @staticmethod
+    def __build_price_list_query(size):
+        # every drug sharing a key gets the price, unchanged prices are not rewritten
+        query = '''
+            WITH new (key, price) AS (
+                VALUES {values}
+            ), updated AS (
+                UPDATE {table} AS drug
+                SET price = new.price, modified = now()
+                FROM new, {table} AS old
+                WHERE drug.key = new.key AND old.id = drug.id AND drug.is_removed = FALSE
+                    AND drug.price IS DISTINCT FROM new.price
+                RETURNING drug.id, old.price AS old_price, drug.price
+            )
+            SELECT id, old_price, price, NULL FROM updated
+            UNION ALL
+            SELECT NULL, NULL, NULL, new.key FROM new
+            WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE key = new.key AND is_removed = FALSE);
+        '''.format(table=TABLE_DRUG, values=', '.join(['(%s, %s::double precision)'] * size))
+        return query
+
+    def apply_percentage(self, category_id, percent):
+        """
+        change the price of every drug of a category by `percent` (7 -> +7%, -5 -> -5%), rounded to 2 decimals
+        :return: {'updated': number of drugs whose price changed}
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(self.__build_percentage_query, {'category_id': str(category_id), 'percent': percent})
+                rows = cursor.fetchall()
+            self.__done(rows)
+
+        logger.info('[DrugBulkPriceService] category {} {:+}%: {} drugs'.format(category_id, percent, len(rows)))
+        return {'updated': len(rows)}
+
+    def apply_price_list(self, prices, chunk_size=PRICE_LIST_CHUNK_SIZE):
+        """
+        :param prices: [(key, price)], the last price wins when a key is repeated
+        :return: {'updated': number of drugs, 'not_found': keys without a drug}
+        """
+        items = list(dict(prices).items())
+        rows, not_found = [], []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for start in range(0, len(items), chunk_size):
+                    chunk = items[start:start + chunk_size]
+                    cursor.execute(self.__build_price_list_query(len(chunk)),
+                                   [value for item in chunk for value in item])
+                    for drug_id, old_price, price, missing_key in cursor.fetchall():
+                        if drug_id is None:
+                            not_found.append(missing_key)
+                        else:
+                            rows.append((drug_id, old_price, price))
+            self.__done(rows)
+
+        logger.info('[DrugBulkPriceService] price list of {} keys: {} drugs, {} keys not found'.format(
+            len(items), len(rows), len(not_found)))
+        return {'updated': len(rows), 'not_found': not_found}
+
+    def __done(self, rows):
+        """
+        audit the changed prices and invalidate the catalog cache once, whatever the number of drugs
+        """
+        audit_log_buffer.record([audit_event(ENTITY_DRUG, drug_id, ACTION_UPDATED, {'price': [old_price, price]},
+                                             self.actor)
+                                 for drug_id, old_price, price in rows if old_price != price])
+        if rows:
+            transaction.on_commit(bump_catalog_version)
@@ -0,0 +1,338 @@
+from django.db import connection, transaction
+
+from apps.common.logger import logger
+from apps.drug.config import CANCELLED_KEY
+from apps.drug.services.calc_bins_from_range_time import BIN_HOURS, BIN_CHOICES, SQL_DATE_FORMATS, SQL_DATE_TRUNC_UNITS
+from apps.drug.services.prescription_daily_stats import PrescriptionDailyStatsService, MONEY_TOLERANCE
+
+TABLE_DRUG_SALES_DAILY = 'drug_drugsalesdaily'
+
+# the cube is bucketed by UTC day, it answers any bin at least one day wide
+CUBE_BIN_CHOICES = [item for item in BIN_CHOICES if item != BIN_HOURS]
+
+DIMENSION_PHARMACY = 'pharmacy'
+DIMENSION_CATEGORY = 'category'
+DIMENSION_DRUG = 'drug'
+
+# dimension -> (cube column, name table)
+DIMENSIONS = {
+    DIMENSION_PHARMACY: ('pharmacy_id', 'drug_pharmacy'),
+    DIMENSION_CATEGORY: ('category_id', 'drug_category'),
+    DIMENSION_DRUG: ('drug_id', 'drug_drug'),
+}
+
+# same rows as DrugSalesStatsService: cancelled or removed prescriptions and removed details are not sales
+SALES_SELECT = '''
+    SELECT pres.work_space_id, pres.pharmacy_id, drug_drug.category_id, detail.drug_id,
+        (pres.created AT TIME ZONE 'UTC')::date AS day, SUM(detail.quantity) AS quantity,
+        SUM(detail.price_at_the_time * detail.quantity) AS revenue
+    FROM drug_prescriptiondetail AS detail
+    JOIN drug_prescription AS pres ON pres.id = detail.prescription_id
+    JOIN drug_drug ON drug_drug.id = detail.drug_id
+    WHERE pres.is_removed = FALSE AND pres.status <> %(cancelled)s AND detail.is_removed = FALSE
+        {filters}
+    GROUP BY pres.work_space_id, pres.pharmacy_id, drug_drug.category_id, detail.drug_id, day
+'''
+
+
+class DrugSalesCubeService:
+
+    def __init__(self, work_space_id, choice, from_date, to_date, dimensions: [str] = None,
+                 pharmacy_ids=None, category_ids=None, drug_ids=None):
+        assert choice in CUBE_BIN_CHOICES, 'choice must be in [{}]'.format(', '.join(CUBE_BIN_CHOICES))
+        self.work_space_id = work_space_id
+        self.choice = choice
+        self.from_date = from_date
+        self.to_date = to_date
+        # keep the declaration order so the rows are always grouped pharmacy > category > drug
+        self.dimensions = [item for item in DIMENSIONS if item in (dimensions or [])]
+        self.pharmacy_ids = pharmacy_ids
+        self.category_ids = category_ids
+        self.drug_ids = drug_ids
+
+    @staticmethod
+    def is_counted(status, is_removed) -> bool:
+        """
+        cancelled or removed prescriptions are not sales
+        """
+        return not is_removed and status != CANCELLED_KEY
+
+    @staticmethod
+    def get_detail_sales(prescription_id) -> dict:
+        """
+        :return: {drug_id: (quantity, revenue)} of the details of a prescription as stored, whatever its status
+        """
+        query = '''
+            SELECT detail.drug_id, SUM(detail.quantity), SUM(detail.price_at_the_time * detail.quantity)
+            FROM drug_prescriptiondetail AS detail
+            JOIN drug_drug ON drug_drug.id = detail.drug_id
+            WHERE detail.prescription_id = %s AND detail.is_removed = FALSE
+            GROUP BY detail.drug_id;
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(query, [str(prescription_id)])
+            return {drug_id: (quantity, revenue) for drug_id, quantity, revenue in cursor.fetchall()}
+
+    @classmethod
+    def apply_detail_changes(cls, prescription, old_sales, details):
+        """
+        apply the difference between the details of a prescription before and after a sync to the cube, in the
+        (pharmacy, day) the prescription is counted in as stored. A change of pharmacy, status or is_removed saved
+        afterwards moves the new sales, see apply_changes
+        :param old_sales: {drug_id: (quantity, revenue)} read before the sync, see get_detail_sales
+        :param details: PrescriptionDetail objects, the details after the sync
+        """
+        tracker = prescription.tracker
+        if not cls.is_counted(tracker.previous('status'), tracker.previous('is_removed')):
+            return
+        new_sales = {}
+        for item in details:
+            quantity, revenue = new_sales.get(item.drug_id, (0, 0))
+            new_sales[item.drug_id] = (quantity + item.quantity,
+                                       revenue + (item.price_at_the_time or 0) * item.quantity)
+
+        key = (prescription.work_space_id, tracker.previous('pharmacy'),
+               PrescriptionDailyStatsService.get_day(prescription.created))
+        deltas = []
+        for drug_id in set(old_sales) | set(new_sales):
+            old_quantity, old_revenue = old_sales.get(drug_id, (0, 0))
+            new_quantity, new_revenue = new_sales.get(drug_id, (0, 0))
+            if (old_quantity, old_revenue) != (new_quantity, new_revenue):
+                deltas.append(((*key, drug_id), new_quantity - old_quantity, new_revenue - old_revenue))
+        cls.apply_deltas(deltas)
+
+    @classmethod
+    def apply_changes(cls, prescription, created=False):
+        """
+        move the sales of a prescription just saved when it is counted in another pharmacy, or no longer (cancelled,
+        removed) or again counted
+        :param prescription: instance just saved, its tracker still holds the previous values
+        :param created: True when the prescription has just been inserted, its details are synced afterwards
+        """
+        if created:
+            return
+        tracker = prescription.tracker
+        old_pharmacy_id, new_pharmacy_id = None, None
+        if cls.is_counted(tracker.previous('status'), tracker.previous('is_removed')):
+            old_pharmacy_id = tracker.previous('pharmacy')
+        if cls.is_counted(prescription.status, prescription.is_removed):
+            new_pharmacy_id = prescription.pharmacy_id
+        if old_pharmacy_id == new_pharmacy_id:
+            return
+
+        day = PrescriptionDailyStatsService.get_day(prescription.created)
+        deltas = []
+        for drug_id, (quantity, revenue) in cls.get_detail_sales(prescription.id).items():
+            if old_pharmacy_id:
+                deltas.append(((prescription.work_space_id, old_pharmacy_id, day, drug_id), -quantity, -revenue))
+            if new_pharmacy_id:
+                deltas.append(((prescription.work_space_id, new_pharmacy_id, day, drug_id), quantity, revenue))
+        cls.apply_deltas(deltas)
+
+    @classmethod
+    def remove_prescriptions(cls, prescription_ids):
+        """
+        take the sales of prescriptions out of the cube, used when they are soft deleted without a save()
+        :param prescription_ids: ids of counted prescriptions, not removed nor cancelled yet
+        """
+        if not prescription_ids:
+            return
+        query = '''
+            SELECT pres.work_space_id, pres.pharmacy_id, (pres.created AT TIME ZONE 'UTC')::date AS day,
+                detail.drug_id, SUM(detail.quantity), SUM(detail.price_at_the_time * detail.quantity)
+            FROM drug_prescriptiondetail AS detail
+            JOIN drug_prescription AS pres ON pres.id = detail.prescription_id
+            JOIN drug_drug ON drug_drug.id = detail.drug_id
+            WHERE detail.prescription_id = ANY(%s::uuid[]) AND detail.is_removed = FALSE
+            GROUP BY pres.work_space_id, pres.pharmacy_id, day, detail.drug_id;
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(query, [[str(item) for item in prescription_ids]])
+            rows = cursor.fetchall()
+        cls.apply_deltas([(row[:4], -row[4], -row[5]) for row in rows])
+
+    @staticmethod
+    def apply_deltas(deltas):
+        """
+        add a list of ((work_space_id, pharmacy_id, day, drug_id), quantity, revenue) deltas to the cube rows, the
+        rows left without sales are deleted. Concurrent writers of a slice add their own deltas under the row
+        locks, none of them overwrites the others
+        """
+        if not deltas:
+            return
+        upsert_query = '''
+            INSERT INTO {table} AS cube (work_space_id, pharmacy_id, category_id, drug_id, day, quantity, revenue)
+            SELECT delta.work_space_id, delta.pharmacy_id, drug_drug.category_id, delta.drug_id, delta.day,
+                delta.quantity, delta.revenue
+            FROM unnest(%(work_space_ids)s::uuid[], %(pharmacy_ids)s::uuid[], %(days)s::date[], %(drug_ids)s::uuid[],
+                        %(quantities)s::integer[], %(revenues)s::double precision[])
+                AS delta(work_space_id, pharmacy_id, day, drug_id, quantity, revenue)
+            JOIN drug_drug ON drug_drug.id = delta.drug_id
+            -- the rows are always locked in the same order, two writers of the same slices never deadlock
+            ORDER BY delta.pharmacy_id, delta.day, delta.drug_id
+            ON CONFLICT (pharmacy_id, drug_id, day) DO UPDATE
+            SET quantity = cube.quantity + EXCLUDED.quantity, revenue = cube.revenue + EXCLUDED.revenue;
+        '''.format(table=TABLE_DRUG_SALES_DAILY)
+        # quantities are whole, no rounding noise to wait for as with the revenue
+        delete_query = '''
+            DELETE FROM {table} AS cube
+            USING unnest(%(pharmacy_ids)s::uuid[], %(days)s::date[], %(drug_ids)s::uuid[])
+                AS delta(pharmacy_id, day, drug_id)
+            WHERE cube.pharmacy_id = delta.pharmacy_id AND cube.day = delta.day AND cube.drug_id = delta.drug_id
+                AND cube.quantity <= 0;
+        '''.format(table=TABLE_DRUG_SALES_DAILY)
+        params = {
+            'work_space_ids': [str(key[0]) for key, _, _ in deltas],
+            'pharmacy_ids': [str(key[1]) for key, _, _ in deltas],
+            'days': [key[2] for key, _, _ in deltas],
+            'drug_ids': [str(key[3]) for key, _, _ in deltas],
+            'quantities': [quantity for _, quantity, _ in deltas],
+            'revenues': [revenue for _, _, revenue in deltas],
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(upsert_query, params)
+            if any(quantity < 0 for _, quantity, _ in deltas):
+                cursor.execute(delete_query, params)
+
+    @staticmethod
+    def sync_drug_category(drug_id, category_id):
+        query = '''
+            UPDATE {table} SET category_id = %s WHERE drug_id = %s AND category_id IS DISTINCT FROM %s;
+        '''.format(table=TABLE_DRUG_SALES_DAILY)
+        category_id = str(category_id) if category_id else None
+        with connection.cursor() as cursor:
+            cursor.execute(query, [category_id, str(drug_id), category_id])
+
+    @staticmethod
+    def rebuild(work_space_id=None) -> int:
+        """
+        recompute the cube from drug_prescriptiondetail, for one work space or for all of them
+        :return: number of cube rows written
+        """
+        ws_filter, sales_filter = '', ''
+        params = {'cancelled': CANCELLED_KEY}
+        if work_space_id:
+            ws_filter = 'AND work_space_id = %(work_space_id)s'
+            sales_filter = 'AND pres.work_space_id = %(work_space_id)s'
+            params['work_space_id'] = str(work_space_id)
+
+        delete_query = '''
+            DELETE FROM {table} WHERE TRUE {ws_filter};
+        '''.format(table=TABLE_DRUG_SALES_DAILY, ws_filter=ws_filter)
+        insert_query = '''
+            INSERT INTO {table} (work_space_id, pharmacy_id, category_id, drug_id, day, quantity, revenue)
+            {sales_select};
+        '''.format(table=TABLE_DRUG_SALES_DAILY, sales_select=SALES_SELECT.format(filters=sales_filter))
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(delete_query, params)
+                cursor.execute(insert_query, params)
+                count = cursor.rowcount
+        logger.info('[DrugSalesCubeService] rebuilt {} rows'.format(count))
+        return count
+
+    @staticmethod
+    def check(work_space_id=None):
+        """
+        compare the cube with drug_prescriptiondetail
+        :return: [(pharmacy_id, drug_id, day, expected quantity, quantity, expected revenue, revenue)] for every row
+            that differs
+        """
+        sales_filter, ws_filter = '', ''
+        params = {'cancelled': CANCELLED_KEY, 'tolerance': MONEY_TOLERANCE}
+        if work_space_id:
+            sales_filter = 'AND pres.work_space_id = %(work_space_id)s'
+            ws_filter = 'AND work_space_id = %(work_space_id)s'
+            params['work_space_id'] = str(work_space_id)
+        query = '''
+            WITH expected AS (
+                {sales_select}
+            ), actual AS (
+                SELECT pharmacy_id, drug_id, day, quantity, revenue FROM {table} WHERE TRUE {ws_filter}
+            )
+            SELECT pharmacy_id, drug_id, day, COALESCE(expected.quantity, 0), COALESCE(actual.quantity, 0),
+                COALESCE(expected.revenue, 0), COALESCE(actual.revenue, 0)
+            FROM expected
+            FULL OUTER JOIN actual USING (pharmacy_id, drug_id, day)
+            WHERE COALESCE(expected.quantity, 0) <> COALESCE(actual.quantity, 0)
+                OR abs(COALESCE(expected.revenue, 0) - COALESCE(actual.revenue, 0)) > %(tolerance)s;
+        '''.format(sales_select=SALES_SELECT.format(filters=sales_filter), table=TABLE_DRUG_SALES_DAILY,
+                   ws_filter=ws_filter)
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    @property
+    def __build_sub_query(self):
+        columns = ''.join('{}, '.format(DIMENSIONS[item][0]) for item in self.dimensions)
+        filters = ''
+        if self.pharmacy_ids:
+            filters += ' AND pharmacy_id = ANY(%(pharmacy_ids)s::uuid[])'
+        if self.category_ids:
+            filters += ' AND category_id = ANY(%(category_ids)s::uuid[])'
+        if self.drug_ids:
+            filters += ' AND drug_id = ANY(%(drug_ids)s::uuid[])'
+        query = '''
+                SELECT {columns}date_trunc(%(date_unit)s, day::timestamp) AS bucket,
+                    SUM(quantity) AS quantity, SUM(revenue) AS revenue
+                FROM {table}
+                WHERE work_space_id = %(work_space_id)s AND day BETWEEN %(from_day)s AND %(to_day)s {filters}
+                GROUP BY {columns}bucket
+                '''.format(columns=columns, table=TABLE_DRUG_SALES_DAILY, filters=filters)
+        return query
+
+    @property
+    def __build_main_query(self):
+        columns = ''
+        joins = ''
+        for item in self.dimensions:
+            column, name_table = DIMENSIONS[item]
+            columns += 'sub.{column}, {name_table}.name, '.format(column=column, name_table=name_table)
+            joins += ' LEFT JOIN {name_table} ON {name_table}.id = sub.{column}'.format(column=column,
+                                                                                        name_table=name_table)
+        order = ''.join('sub.{}, '.format(DIMENSIONS[item][0]) for item in self.dimensions)
+        query = '''
+                SELECT {columns}to_char(sub.bucket, %(date_fmt)s), sub.quantity, sub.revenue
+                FROM (
+                    {sub_query}
+                ) AS sub
+                {joins}
+                ORDER BY {order}sub.bucket;
+                '''.format(columns=columns, sub_query=self.__build_sub_query, joins=joins, order=order)
+        return query
+
+    @property
+    def __build_params(self):
+        return {
+            'work_space_id': str(self.work_space_id),
+            'date_fmt': SQL_DATE_FORMATS[self.choice],
+            'date_unit': SQL_DATE_TRUNC_UNITS[self.choice],
+            'from_day': PrescriptionDailyStatsService.get_day(self.from_date),
+            'to_day': PrescriptionDailyStatsService.get_day(self.to_date),
+            'pharmacy_ids': [str(item) for item in self.pharmacy_ids or []],
+            'category_ids': [str(item) for item in self.category_ids or []],
+            'drug_ids': [str(item) for item in self.drug_ids or []],
+        }
+
+    def run(self):
+        """
+        :return: [{<dimension>: {id, name}, ..., 'bin', 'quantity', 'revenue'}] ordered by dimensions and bin
+        """
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(self.__build_main_query, self.__build_params)
+                res = cursor.fetchall()
+            except Exception as err:
+                logger.error('[DrugSalesCubeService] {}'.format(err))
+                raise err
+
+        rows = []
+        for ele in res:
+            row = {}
+            for index, item in enumerate(self.dimensions):
+                row[item] = {'id': ele[2 * index], 'name': ele[2 * index + 1]}
+            # -3, -2, -1 -> index of bin name, quantity and revenue
+            row.update({'bin': ele[-3], 'quantity': ele[-2], 'revenue': ele[-1]})
+            rows.append(row)
+        return rows
@@ -0,0 +1,160 @@
+from django.db import connection
+
+from apps.common.logger import logger
+from apps.drug.config import CANCELLED_KEY
+from apps.drug.services.calc_bins_from_range_time import (
+    BIN_CHOICES, SQL_DATE_FORMATS, SQL_DATE_TRUNC_UNITS, get_time_zone)
+
+
+class DrugSalesStatsService:
+    """
+    drug level sales of a work space, computed from drug_prescriptiondetail
+    (revenue = price_at_the_time * quantity, cancelled prescriptions are ignored)
+    """
+
+    def __init__(self, work_space_id, choice, from_date, to_date, pharmacy_id=None, limit=10, tz=None):
+        assert choice in BIN_CHOICES, 'choice must be in [{}]'.format(', '.join(BIN_CHOICES))
+        self.work_space_id = work_space_id
+        self.choice = choice
+        self.from_date = from_date
+        self.to_date = to_date
+        self.pharmacy_id = pharmacy_id
+        self.limit = limit
+        self.tz = get_time_zone(tz)
+
+    @property
+    def __build_sales_query(self):
+        pharmacy_filter = 'AND pres.pharmacy_id = %(pharmacy_id)s' if self.pharmacy_id else ''
+        query = '''
+                SELECT detail.drug_id, pres.created, detail.quantity,
+                    detail.price_at_the_time * detail.quantity AS revenue
+                FROM drug_prescriptiondetail AS detail
+                JOIN drug_prescription AS pres ON pres.id = detail.prescription_id
+                WHERE pres.work_space_id = %(work_space_id)s
+                    AND pres.created BETWEEN %(from_date)s AND %(to_date)s
+                    AND pres.is_removed = FALSE AND pres.status <> %(cancelled)s
+                    AND detail.is_removed = FALSE AND detail.drug_id IS NOT NULL
+                    {pharmacy_filter}
+                '''.format(pharmacy_filter=pharmacy_filter)
+        return query
+
+    @property
+    def __build_top_drugs_query(self):
+        query = '''
+                WITH drug_sales AS (
+                    SELECT sales.drug_id, SUM(sales.quantity) AS quantity, SUM(sales.revenue) AS revenue
+                    FROM (
+                        {sales_query}
+                    ) AS sales
+                    GROUP BY sales.drug_id
+                ), ranked AS (
+                    SELECT drug_id, quantity, revenue,
+                        row_number() OVER (ORDER BY quantity DESC, drug_id) AS rank_quantity,
+                        row_number() OVER (ORDER BY revenue DESC, drug_id) AS rank_revenue
+                    FROM drug_sales
+                )
+                SELECT ranked.drug_id, drug_drug.name, drug_category.id, drug_category.name,
+                    ranked.quantity, ranked.revenue, ranked.rank_quantity, ranked.rank_revenue
+                FROM ranked
+                JOIN drug_drug ON drug_drug.id = ranked.drug_id
+                LEFT JOIN drug_category ON drug_category.id = drug_drug.category_id
+                WHERE ranked.rank_quantity <= %(limit)s OR ranked.rank_revenue <= %(limit)s
+                LIMIT 2 * %(limit)s;
+                '''.format(sales_query=self.__build_sales_query)
+        return query
+
+    @property
+    def __build_category_query(self):
+        query = '''
+                SELECT drug_category.id, drug_category.name, SUM(sales.quantity), SUM(sales.revenue) AS revenue
+                FROM (
+                    {sales_query}
+                ) AS sales
+                JOIN drug_drug ON drug_drug.id = sales.drug_id
+                LEFT JOIN drug_category ON drug_category.id = drug_drug.category_id
+                GROUP BY drug_category.id, drug_category.name
+                ORDER BY revenue DESC;
+                '''.format(sales_query=self.__build_sales_query)
+        return query
+
+    @property
+    def __build_series_query(self):
+        query = '''
+                SELECT sub.drug_id, to_char(sub.bucket, %(date_fmt)s), sub.revenue
+                FROM (
+                    SELECT sales.drug_id, date_trunc(%(date_unit)s, sales.created AT TIME ZONE %(tz)s) AS bucket,
+                        SUM(sales.revenue) AS revenue
+                    FROM (
+                        {sales_query}
+                    ) AS sales
+                    WHERE sales.drug_id = ANY(%(drug_ids)s::uuid[])
+                    GROUP BY sales.drug_id, bucket
+                ) AS sub
+                ORDER BY sub.drug_id, sub.bucket;
+                '''.format(sales_query=self.__build_sales_query)
+        return query
+
+    def __build_params(self, **kwargs):
+        params = {
+            'work_space_id': str(self.work_space_id),
+            'pharmacy_id': str(self.pharmacy_id) if self.pharmacy_id else None,
+            'from_date': self.from_date,
+            'to_date': self.to_date,
+            'cancelled': CANCELLED_KEY,
+            'limit': self.limit,
+            'date_fmt': SQL_DATE_FORMATS[self.choice],
+            'date_unit': SQL_DATE_TRUNC_UNITS[self.choice],
+            'tz': self.tz.zone,
+        }
+        params.update(kwargs)
+        return params
+
+    def __fetch(self, query, params):
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            except Exception as err:
+                logger.error('[DrugSalesStatsService] {}'.format(err))
+                raise err
+
+    def get_top_drugs(self):
+        """
+        top `limit` drugs by quantity and by revenue, in one grouped query
+        :return: (top by quantity, top by revenue)
+        """
+        res = self.__fetch(self.__build_top_drugs_query, self.__build_params())
+        top_quantity, top_revenue = [], []
+        for drug_id, name, category_id, category_name, quantity, revenue, rank_quantity, rank_revenue in res:
+            item = {
+                'id': drug_id,
+                'name': name,
+                'category': {'id': category_id, 'name': category_name},
+                'quantity': quantity,
+                'revenue': revenue
+            }
+            if rank_quantity <= self.limit:
+                top_quantity.append((rank_quantity, item))
+            if rank_revenue <= self.limit:
+                top_revenue.append((rank_revenue, item))
+        return [item for _, item in sorted(top_quantity, key=lambda x: x[0])], \
+               [item for _, item in sorted(top_revenue, key=lambda x: x[0])]
+
+    def get_category_revenue(self):
+        res = self.__fetch(self.__build_category_query, self.__build_params())
+        return [{
+            'id': category_id,
+            'name': name,
+            'quantity': quantity,
+            'revenue': revenue
+        } for category_id, name, quantity, revenue in res]
+
+    def get_drug_series(self, drug_ids):
+        """
+        revenue by time bin of the given drugs
+        :return: [(drug_id, bin label, revenue)] ordered by drug and bin
+        """
+        if not drug_ids:
+            return []
+        params = self.__build_params(drug_ids=[str(item) for item in drug_ids])
+        return self.__fetch(self.__build_series_query, params)
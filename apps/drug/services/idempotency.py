@@ -0,0 +1,109 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.common.logger import logger
+
+TABLE_IDEMPOTENCY_KEY = 'drug_idempotencykey'
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# first key of the two-int advisory locks taken on an idempotency key, see PRESCRIPTION_LOCK_NAMESPACE
+IDEMPOTENCY_LOCK_NAMESPACE = 1002
+
+
+class IdempotencyService:
+    """
+    store the response of a write sent with an Idempotency-Key and replay it to the retries of the same request,
+    concurrent requests with the same key are serialized by a transaction level advisory lock
+    """
+
+    def __init__(self, work_space_id, key):
+        self.work_space_id = work_space_id
+        self.key = key
+
+    @staticmethod
+    def hash_request(method, path, data):
+        """
+        fingerprint of a request, a key sent again with another request is rejected
+        """
+        payload = json.dumps([method, path, data], sort_keys=True, cls=DjangoJSONEncoder)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def lock(self):
+        """
+        held until the end of the current transaction, a retry waits for the first request to commit
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s));',
+                           [IDEMPOTENCY_LOCK_NAMESPACE, '{}:{}'.format(self.work_space_id, self.key)])
+
+    def get(self):
+        """
+        :return: (request_hash, status_code, response_body) of the stored response, None when there is none or it
+            has expired
+        """
+        query = '''
+            SELECT request_hash, status_code, response_body FROM {table}
+            WHERE work_space_id = %s AND key = %s AND expires_at > now();
+        '''.format(table=TABLE_IDEMPOTENCY_KEY)
+        with connection.cursor() as cursor:
+            cursor.execute(query, [str(self.work_space_id), self.key])
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        request_hash, status_code, response_body = row
+        # psycopg2 returns jsonb already decoded
+        if isinstance(response_body, str):
+            response_body = json.loads(response_body)
+        return request_hash, status_code, response_body
+
+    def save(self, request_hash, status_code, response_body):
+        """
+        store a response, an expired one with the same key is replaced
+        """
+        query = '''
+            INSERT INTO {table} (work_space_id, key, request_hash, status_code, response_body, created, expires_at)
+            VALUES (%(work_space_id)s, %(key)s, %(request_hash)s, %(status_code)s, %(response_body)s, now(),
+                %(expires_at)s)
+            ON CONFLICT (work_space_id, key) DO UPDATE
+            SET request_hash = EXCLUDED.request_hash, status_code = EXCLUDED.status_code,
+                response_body = EXCLUDED.response_body, created = EXCLUDED.created, expires_at = EXCLUDED.expires_at;
+        '''.format(table=TABLE_IDEMPOTENCY_KEY)
+        params = {
+            'work_space_id': str(self.work_space_id),
+            'key': self.key,
+            'request_hash': request_hash,
+            'status_code': status_code,
+            'response_body': json.dumps(response_body, cls=DjangoJSONEncoder),
+            'expires_at': timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+
+    @staticmethod
+    def purge(batch_size=1000) -> int:
+        """
+        delete the expired keys, one transaction per batch so the table is never locked for long
+        :return: number of keys deleted
+        """
+        query = '''
+            DELETE FROM {table}
+            WHERE id IN (SELECT id FROM {table} WHERE expires_at <= now() LIMIT %s);
+        '''.format(table=TABLE_IDEMPOTENCY_KEY)
+        total = 0
+        while True:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(query, [batch_size])
+                    count = cursor.rowcount
+            total += count
+            if count < batch_size:
+                break
+        logger.info('[IdempotencyService] purged {} expired keys'.format(total))
+        return total
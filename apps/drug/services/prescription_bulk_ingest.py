@@ -0,0 +1,202 @@
+import io
+import uuid
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.common.logger import logger
+from apps.drug.config import CANCELLED_KEY
+from apps.drug.services.audit_log import (
+    audit_actor_id, ENTITY_PRESCRIPTION, ENTITY_PRESCRIPTION_DETAIL, ACTION_CREATED)
+from apps.drug.services.drug_sales_cube import TABLE_DRUG_SALES_DAILY
+from apps.drug.services.prescription_daily_stats import TABLE_DAILY_STATS
+from apps.drug.services.stats_cache import bump_pharmacy_version, bump_work_space_version
+
+STAGING_PRESCRIPTION = 'staging_prescription'
+STAGING_DETAIL = 'staging_prescription_detail'
+
+
+# COPY text format escapes
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.translate(COPY_ESCAPES)
+    # uuid, numbers and datetimes never need escaping
+    return str(value)
+
+
+def _copy_buffer(rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+class PrescriptionBulkIngestService:
+    """
+    load a validated batch of prescriptions with COPY into temporary staging tables, then move them with set based
+    INSERT ... SELECT; totals, daily stats, the sales cube and the audit log are computed in SQL. Model signals are
+    not sent.
+    """
+
+    def __init__(self, work_space_id):
+        self.work_space_id = work_space_id
+
+    @property
+    def __build_staging_queries(self):
+        return [
+            '''
+            CREATE TEMPORARY TABLE {table} (
+                id uuid, pharmacy_id uuid, status varchar(11), note text, name varchar(20), created timestamptz
+            ) ON COMMIT DROP;
+            '''.format(table=STAGING_PRESCRIPTION),
+            '''
+            CREATE TEMPORARY TABLE {table} (
+                id uuid, prescription_id uuid, drug_id uuid, quantity integer, price_at_the_time double precision
+            ) ON COMMIT DROP;
+            '''.format(table=STAGING_DETAIL),
+        ]
+
+    @property
+    def __build_insert_queries(self):
+        prescription_query = '''
+            INSERT INTO drug_prescription
+                (id, created, modified, is_removed, work_space_id, pharmacy_id, status, note, name, total_price,
+                 version)
+            SELECT pres.id, pres.created, now(), FALSE, %(work_space_id)s, pres.pharmacy_id, pres.status, pres.note,
+                pres.name, COALESCE(totals.total_price, 0), 1
+            FROM {staging_prescription} AS pres
+            LEFT JOIN (
+                SELECT prescription_id, SUM(price_at_the_time * quantity) AS total_price
+                FROM {staging_detail}
+                GROUP BY prescription_id
+            ) AS totals ON totals.prescription_id = pres.id;
+        '''
+        detail_query = '''
+            INSERT INTO drug_prescriptiondetail
+                (id, created, modified, is_removed, prescription_id, drug_id, quantity, price_at_the_time)
+            SELECT detail.id, now(), now(), FALSE, detail.prescription_id, detail.drug_id, detail.quantity,
+                detail.price_at_the_time
+            FROM {staging_detail} AS detail;
+        '''
+        daily_stats_query = '''
+            INSERT INTO {daily_stats} (work_space_id, pharmacy_id, day, status, number_prescription, total_price)
+            SELECT work_space_id, pharmacy_id, (created AT TIME ZONE 'UTC')::date AS day, status,
+                COUNT(*), COALESCE(SUM(total_price), 0)
+            FROM drug_prescription
+            WHERE id IN (SELECT id FROM {staging_prescription})
+            GROUP BY work_space_id, pharmacy_id, day, status
+            ON CONFLICT (work_space_id, pharmacy_id, day, status) DO UPDATE
+            SET number_prescription = {daily_stats}.number_prescription + EXCLUDED.number_prescription,
+                total_price = {daily_stats}.total_price + EXCLUDED.total_price;
+        '''
+        # the new prescriptions only add sales, their quantity and revenue are added to the existing cube rows
+        cube_query = '''
+            INSERT INTO {cube} (work_space_id, pharmacy_id, category_id, drug_id, day, quantity, revenue)
+            SELECT %(work_space_id)s, pres.pharmacy_id, drug_drug.category_id, detail.drug_id,
+                (pres.created AT TIME ZONE 'UTC')::date AS day, SUM(detail.quantity),
+                SUM(detail.price_at_the_time * detail.quantity)
+            FROM {staging_detail} AS detail
+            JOIN {staging_prescription} AS pres ON pres.id = detail.prescription_id
+            JOIN drug_drug ON drug_drug.id = detail.drug_id
+            WHERE pres.status <> %(cancelled)s
+            GROUP BY pres.pharmacy_id, drug_drug.category_id, detail.drug_id, day
+            ON CONFLICT (pharmacy_id, drug_id, day) DO UPDATE
+            SET quantity = {cube}.quantity + EXCLUDED.quantity, revenue = {cube}.revenue + EXCLUDED.revenue;
+        '''
+        tables = {
+            'staging_prescription': STAGING_PRESCRIPTION,
+            'staging_detail': STAGING_DETAIL,
+            'daily_stats': TABLE_DAILY_STATS,
+            'cube': TABLE_DRUG_SALES_DAILY,
+        }
+        return [query.format(**tables) for query in [prescription_query, detail_query, daily_stats_query,
+                                                     cube_query]]
+
+    @property
+    def __build_audit_queries(self):
+        # same changes as the events of PrescriptionDrugContentSerializer.create, written in the batch transaction
+        # instead of through audit_log_buffer whose queue a single batch could overflow
+        prescription_query = '''
+            INSERT INTO drug_auditlog (created, actor_id, entity, entity_id, action, changes)
+            SELECT %(now)s, %(actor_id)s, %(entity_prescription)s, pres.id, %(action)s,
+                jsonb_build_object('pharmacy', pres.pharmacy_id, 'status', pres.status,
+                                   'total_price', pres.total_price)
+            FROM drug_prescription AS pres
+            WHERE pres.id IN (SELECT id FROM {staging_prescription});
+        '''
+        detail_query = '''
+            INSERT INTO drug_auditlog (created, actor_id, entity, entity_id, action, changes)
+            SELECT %(now)s, %(actor_id)s, %(entity_detail)s, detail.id, %(action)s,
+                jsonb_build_object('prescription', detail.prescription_id, 'drug', detail.drug_id,
+                                   'quantity', detail.quantity, 'price_at_the_time', detail.price_at_the_time)
+            FROM {staging_detail} AS detail;
+        '''
+        tables = {
+            'staging_prescription': STAGING_PRESCRIPTION,
+            'staging_detail': STAGING_DETAIL,
+        }
+        return [query.format(**tables) for query in [prescription_query, detail_query]]
+
+    def ingest(self, prescriptions, actor=None):
+        """
+        :param prescriptions: [{pharmacy, status, note, name, created, list_prescription_detail:
+            [{drug, quantity, price_at_the_time}]}] already validated, see BulkPrescriptionSerializer
+        :param actor: user who sent the batch, None for the system
+        :return: ids of the created prescriptions, in the order of the batch, and the number of details
+        """
+        now = timezone.now()
+        prescription_rows = []
+        detail_rows = []
+        for item in prescriptions:
+            prescription_id = uuid.uuid4()
+            prescription_rows.append((prescription_id, item['pharmacy'], item['status'], item.get('note'),
+                                      item.get('name'), item.get('created') or now))
+            for detail in item['list_prescription_detail']:
+                detail_rows.append((uuid.uuid4(), prescription_id, detail['drug'], detail['quantity'],
+                                    detail['price_at_the_time']))
+
+        params = {
+            'work_space_id': str(self.work_space_id),
+            'cancelled': CANCELLED_KEY,
+            'now': now,
+            'actor_id': audit_actor_id(actor),
+            'entity_prescription': ENTITY_PRESCRIPTION,
+            'entity_detail': ENTITY_PRESCRIPTION_DETAIL,
+            'action': ACTION_CREATED,
+        }
+        queries = self.__build_insert_queries
+        if settings.AUDIT_LOG_ENABLED:
+            queries += self.__build_audit_queries
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for query in self.__build_staging_queries:
+                    cursor.execute(query)
+                cursor.copy_expert('COPY {} FROM STDIN'.format(STAGING_PRESCRIPTION),
+                                   _copy_buffer(prescription_rows))
+                cursor.copy_expert('COPY {} FROM STDIN'.format(STAGING_DETAIL), _copy_buffer(detail_rows))
+                for query in queries:
+                    cursor.execute(query, params)
+                # ON COMMIT DROP would keep them until the end of an outer transaction, e.g. ATOMIC_REQUESTS
+                cursor.execute('DROP TABLE {}, {};'.format(STAGING_PRESCRIPTION, STAGING_DETAIL))
+
+            work_space_id = self.work_space_id
+            pharmacy_ids = {row[1] for row in prescription_rows}
+
+            def bump():
+                bump_work_space_version(work_space_id)
+                for pharmacy_id in pharmacy_ids:
+                    bump_pharmacy_version(pharmacy_id)
+
+            transaction.on_commit(bump)
+
+        logger.info('[PrescriptionBulkIngestService] {} prescriptions, {} details'.format(
+            len(prescription_rows), len(detail_rows)))
+        return {'ids': [row[0] for row in prescription_rows], 'number_detail': len(detail_rows)}
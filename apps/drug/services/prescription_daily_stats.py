@@ -0,0 +1,161 @@
+from datetime import timezone
+
+from django.db import connection, transaction
+
+from apps.common.logger import logger
+
+TABLE_DAILY_STATS = 'drug_prescriptiondailystats'
+
+# total prices are floats updated by deltas, ignore rounding noise when checking them
+MONEY_TOLERANCE = 0.01
+
+
+class PrescriptionDailyStatsService:
+
+    @staticmethod
+    def get_day(dt):
+        """
+        day bucket of a prescription, prescriptions are bucketed by their UTC creation date
+        """
+        return dt.astimezone(timezone.utc).date()
+
+    @classmethod
+    def apply_changes(cls, prescription, created=False):
+        """
+        apply the difference between the saved and the current state of a prescription to the daily stats
+        :param prescription: instance just saved, its tracker still holds the previous values
+        :param created: True when the prescription has just been inserted
+        :return:
+        """
+        tracker = prescription.tracker
+        day = cls.get_day(prescription.created)
+
+        old_key, old_price = None, 0
+        if not created and not tracker.previous('is_removed'):
+            old_key = (prescription.work_space_id, tracker.previous('pharmacy'), day, tracker.previous('status'))
+            old_price = tracker.previous('total_price') or 0
+
+        new_key, new_price = None, 0
+        if not prescription.is_removed:
+            new_key = (prescription.work_space_id, prescription.pharmacy_id, day, prescription.status)
+            new_price = prescription.total_price or 0
+
+        deltas = []
+        if old_key == new_key:
+            if new_key is not None and new_price != old_price:
+                deltas.append((new_key, 0, new_price - old_price))
+        else:
+            if old_key is not None:
+                deltas.append((old_key, -1, -old_price))
+            if new_key is not None:
+                deltas.append((new_key, 1, new_price))
+
+        if deltas:
+            cls.apply_deltas(deltas)
+
+    @classmethod
+    def remove_prescriptions(cls, rows):
+        """
+        take prescriptions out of the daily stats, used when they are soft deleted without a save()
+        :param rows: [(work_space_id, pharmacy_id, created, status, total_price)] of prescriptions not removed yet
+        """
+        deltas = {}
+        for work_space_id, pharmacy_id, created, status, total_price in rows:
+            key = (work_space_id, pharmacy_id, cls.get_day(created), status)
+            number_prescription, price = deltas.get(key, (0, 0))
+            deltas[key] = (number_prescription - 1, price - (total_price or 0))
+        if deltas:
+            cls.apply_deltas([(key, number_prescription, price)
+                              for key, (number_prescription, price) in deltas.items()])
+
+    @staticmethod
+    def apply_deltas(deltas):
+        """
+        upsert a list of ((work_space_id, pharmacy_id, day, status), number_prescription, total_price) deltas
+        """
+        query = '''
+            INSERT INTO {table} (work_space_id, pharmacy_id, day, status, number_prescription, total_price)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (work_space_id, pharmacy_id, day, status) DO UPDATE
+            SET number_prescription = {table}.number_prescription + EXCLUDED.number_prescription,
+                total_price = {table}.total_price + EXCLUDED.total_price;
+        '''.format(table=TABLE_DAILY_STATS)
+        params = [(*key, number_prescription, total_price) for key, number_prescription, total_price in deltas]
+        with connection.cursor() as cursor:
+            cursor.executemany(query, params)
+
+    @staticmethod
+    def rebuild(work_space_id=None) -> int:
+        """
+        recompute the daily stats from drug_prescription, for one work space or for all of them
+        :param work_space_id:
+        :return: number of stats rows written
+        """
+        ws_filter = ''
+        params = []
+        if work_space_id:
+            ws_filter = 'AND work_space_id = %s'
+            params = [str(work_space_id)]
+
+        delete_query = '''
+            DELETE FROM {table} WHERE TRUE {ws_filter};
+        '''.format(table=TABLE_DAILY_STATS, ws_filter=ws_filter)
+        insert_query = '''
+            INSERT INTO {table} (work_space_id, pharmacy_id, day, status, number_prescription, total_price)
+            SELECT work_space_id, pharmacy_id, (created AT TIME ZONE 'UTC')::date AS day, status,
+                COUNT(*), COALESCE(SUM(total_price), 0)
+            FROM drug_prescription
+            WHERE is_removed = FALSE {ws_filter}
+            GROUP BY work_space_id, pharmacy_id, day, status;
+        '''.format(table=TABLE_DAILY_STATS, ws_filter=ws_filter)
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(delete_query, params)
+                cursor.execute(insert_query, params)
+                count = cursor.rowcount
+        logger.info('[PrescriptionDailyStatsService] rebuilt {} rows'.format(count))
+        return count
+
+    @staticmethod
+    def check(work_space_id=None):
+        """
+        compare the daily stats with drug_prescription
+        :param work_space_id:
+        :return: [(work_space_id, pharmacy_id, day, status, expected number, number, expected price, price)]
+            for every key that differs
+        """
+        ws_filter = ''
+        params = {}
+        if work_space_id:
+            ws_filter = 'AND work_space_id = %(work_space_id)s'
+            params = {'work_space_id': str(work_space_id)}
+
+        query = '''
+            WITH expected AS (
+                SELECT work_space_id, pharmacy_id, (created AT TIME ZONE 'UTC')::date AS day, status,
+                    COUNT(*) AS number_prescription, COALESCE(SUM(total_price), 0) AS total_price
+                FROM drug_prescription
+                WHERE is_removed = FALSE {ws_filter}
+                GROUP BY work_space_id, pharmacy_id, day, status
+            ), actual AS (
+                SELECT work_space_id, pharmacy_id, day, status, number_prescription, total_price
+                FROM {table}
+                WHERE TRUE {ws_filter}
+            )
+            SELECT COALESCE(expected.work_space_id, actual.work_space_id),
+                COALESCE(expected.pharmacy_id, actual.pharmacy_id),
+                COALESCE(expected.day, actual.day),
+                COALESCE(expected.status, actual.status),
+                COALESCE(expected.number_prescription, 0), COALESCE(actual.number_prescription, 0),
+                COALESCE(expected.total_price, 0), COALESCE(actual.total_price, 0)
+            FROM expected
+            FULL OUTER JOIN actual USING (work_space_id, pharmacy_id, day, status)
+            WHERE COALESCE(expected.number_prescription, 0) <> COALESCE(actual.number_prescription, 0)
+                OR abs(COALESCE(expected.total_price, 0) - COALESCE(actual.total_price, 0)) > %(tolerance)s;
+        '''.format(table=TABLE_DAILY_STATS, ws_filter=ws_filter)
+        params.update({'tolerance': MONEY_TOLERANCE})
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
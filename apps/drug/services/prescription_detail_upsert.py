@@ -0,0 +1,93 @@
+import uuid
+
+from django.db import connection, transaction
+
+from apps.common.logger import logger
+
+TABLE_PRESCRIPTION_DETAIL = 'drug_prescriptiondetail'
+
+# first key of the two-int advisory locks taken on a prescription, keeps them apart from other lock users
+PRESCRIPTION_LOCK_NAMESPACE = 1001
+
+
+class PrescriptionDetailUpsertService:
+    """
+    write the whole desired detail set of a prescription with one INSERT ... ON CONFLICT and one soft delete,
+    concurrent syncs of the same prescription are serialized by a transaction level advisory lock
+    """
+
+    def __init__(self, prescription_id):
+        self.prescription_id = prescription_id
+
+    @property
+    def __build_upsert_query(self):
+        # unchanged rows are not rewritten, only the inserted and updated ones are returned
+        query = '''
+            INSERT INTO {table} AS detail
+                (id, created, modified, is_removed, prescription_id, drug_id, quantity, price_at_the_time)
+            SELECT new.id, now(), now(), FALSE, %(prescription_id)s, new.drug_id, new.quantity, new.price_at_the_time
+            FROM unnest(%(ids)s::uuid[], %(drug_ids)s::uuid[], %(quantities)s::integer[],
+                        %(prices)s::double precision[]) AS new(id, drug_id, quantity, price_at_the_time)
+            ON CONFLICT (prescription_id, drug_id) DO UPDATE
+            SET quantity = EXCLUDED.quantity, price_at_the_time = EXCLUDED.price_at_the_time,
+                is_removed = FALSE, modified = EXCLUDED.modified
+            WHERE (detail.quantity, detail.price_at_the_time, detail.is_removed)
+                IS DISTINCT FROM (EXCLUDED.quantity, EXCLUDED.price_at_the_time, FALSE)
+            RETURNING detail.id, detail.drug_id, detail.xmax = 0;
+        '''.format(table=TABLE_PRESCRIPTION_DETAIL)
+        return query
+
+    @property
+    def __build_soft_delete_query(self):
+        # a NULL in the array would make the comparison NULL for every row, and nothing would be deleted
+        query = '''
+            UPDATE {table} SET is_removed = TRUE, modified = now()
+            WHERE prescription_id = %(prescription_id)s AND is_removed = FALSE
+                AND (drug_id IS NULL OR NOT (drug_id = ANY(array_remove(%(drug_ids)s::uuid[], NULL))))
+            RETURNING id;
+        '''.format(table=TABLE_PRESCRIPTION_DETAIL)
+        return query
+
+    def sync(self, details, lock=True):
+        """
+        :param details: PrescriptionDetail objects of the prescription, the desired state
+        :param lock: False when the caller already serializes the syncs of the prescription, e.g. with its version
+        :return: same shape as custom_bulk_sync, unchanged rows are only counted. Like custom_bulk_sync, the
+            created and updated details get the id of their row.
+        """
+        # no key to upsert a detail without drug on, the serializers reject them
+        details = [item for item in details if item.drug_id]
+        params = {
+            'prescription_id': str(self.prescription_id),
+            'ids': [str(uuid.uuid4()) for _ in details],
+            'drug_ids': [str(item.drug_id) for item in details],
+            'quantities': [item.quantity for item in details],
+            'prices': [item.price_at_the_time for item in details],
+        }
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                if lock:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s));',
+                                   [PRESCRIPTION_LOCK_NAMESPACE, str(self.prescription_id)])
+                cursor.execute(self.__build_upsert_query, params)
+                written = cursor.fetchall()
+                cursor.execute(self.__build_soft_delete_query, params)
+                deleted = [row[0] for row in cursor.fetchall()]
+
+        by_drug = {item.drug_id: item for item in details}
+        for detail_id, drug_id, _ in written:
+            if drug_id in by_drug:
+                by_drug[drug_id].id = detail_id
+
+        ids = {
+            'created': [detail_id for detail_id, _, inserted in written if inserted],
+            'updated': [detail_id for detail_id, _, inserted in written if not inserted],
+            'deleted': deleted,
+        }
+        stats = {key: len(value) for key, value in ids.items()}
+        stats['unchanged'] = len(details) - len(written)
+
+        logger.debug('[PrescriptionDetailUpsertService] {}: {} created, {} updated, {} deleted, {} unchanged.'.format(
+            self.prescription_id, stats['created'], stats['updated'], stats['deleted'], stats['unchanged']))
+        return {'stats': stats, 'ids': ids}
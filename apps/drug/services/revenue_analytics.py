@@ -0,0 +1,96 @@
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+DEFAULT_MOVING_AVERAGE_WINDOWS = [7, 30]
+PERCENTILE_BANDS = [25, 50, 75]
+
+
+def _to_list(arr):
+    # NaN is not valid JSON
+    return [None if value != value else value for value in arr.tolist()]
+
+
+class RevenueAnalyticsService:
+    """
+    derived series over the (pharmacy x bin) revenue matrix, every computation is vectorized on the whole matrix
+    """
+
+    def __init__(self, res_stats, bins: [str]):
+        """
+        :param res_stats: rows of CalculatePriceByTimeUnitForPharmacies (pharmacy_id, name, bin, value)
+            ordered by pharmacy
+        :param bins: labels of CalculateBinsFromRangeTimeService
+        """
+        self.bins = bins
+        bin_index = {label: index for index, label in enumerate(bins)}
+
+        self.pharmacies = []
+        counts = []
+        col_indexes = []
+        values = []
+        for pharmacy_id, group in groupby(res_stats, key=itemgetter(0)):
+            group = list(group)
+            self.pharmacies.append((pharmacy_id, group[0][1]))
+            counts.append(len(group))
+            # 2, 3 -> index of bin name and value, -1 for a bin outside of the labels
+            col_indexes.extend([bin_index.get(ele[2], -1) for ele in group])
+            values.extend([ele[3] or 0 for ele in group])
+
+        row_indexes = np.repeat(np.arange(len(self.pharmacies)), counts)
+        col_indexes = np.array(col_indexes, dtype=np.int64)
+        known = col_indexes >= 0
+
+        self.matrix = np.zeros((len(self.pharmacies), len(bins)), dtype=np.float64)
+        self.matrix[row_indexes[known], col_indexes[known]] = np.array(values, dtype=np.float64)[known]
+
+    def moving_average(self, window: int):
+        """
+        trailing mean over `window` bins, the first bins average what is available
+        """
+        cumsum = np.zeros((self.matrix.shape[0], self.matrix.shape[1] + 1), dtype=np.float64)
+        np.cumsum(self.matrix, axis=1, out=cumsum[:, 1:])
+        ends = np.arange(1, self.matrix.shape[1] + 1)
+        starts = np.maximum(ends - window, 0)
+        return (cumsum[:, ends] - cumsum[:, starts]) / (ends - starts)
+
+    def growth_rate(self):
+        """
+        period over period growth, NaN for the first bin and when the previous bin is 0
+        """
+        growth = np.full(self.matrix.shape, np.nan, dtype=np.float64)
+        previous = self.matrix[:, :-1]
+        np.divide(self.matrix[:, 1:] - previous, previous, out=growth[:, 1:], where=previous != 0)
+        return growth
+
+    def percentile_bands(self, percentiles=None):
+        """
+        percentiles of the pharmacies revenue for each bin
+        """
+        percentiles = percentiles or PERCENTILE_BANDS
+        if not self.pharmacies:
+            return {f'p{item}': [0] * len(self.bins) for item in percentiles}
+        bands = np.percentile(self.matrix, percentiles, axis=0)
+        return {f'p{item}': band.tolist() for item, band in zip(percentiles, bands)}
+
+    def run(self, windows=None):
+        windows = windows or DEFAULT_MOVING_AVERAGE_WINDOWS
+        moving_averages = {window: self.moving_average(window) for window in windows}
+        growth = self.growth_rate()
+
+        rows = []
+        for index, (pharmacy_id, name) in enumerate(self.pharmacies):
+            rows.append({
+                'id': pharmacy_id,
+                'name': name,
+                'data': self.matrix[index].tolist(),
+                'moving_average': {str(window): values[index].tolist() for window, values in moving_averages.items()},
+                'growth': _to_list(growth[index])
+            })
+
+        return {
+            'labels': self.bins,
+            'rows': rows,
+            'bands': self.percentile_bands()
+        }
@@ -1,9 +1,19 @@
 import operator
+import re
 from functools import reduce
 
 from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, F, Value
+
+from apps.drug.services.unaccent import f_unaccent
+
+# stored tsvector column of Drug and Prescription, weighted per the rank configs below and maintained by a trigger,
+# see migrations 0010 and 0013 (accent folded)
+SEARCH_VECTOR_FIELD = 'search_vector'
+
+# lexemes of a keyword, anything else (tsquery operators, quotes, ...) is dropped
+KEYWORD_TOKEN_RE = re.compile(r'\w+')
 
 CONFIG_DRUG_RANK = [
     {
@@ -32,14 +42,56 @@ class PostgresFulltextSearch:
     model_objects_manager: models.Manager = None
     fields_config: [] = None
 
-    def __init__(self, model_objects_manager: models.Manager, fields_config, natural_sorting_field: str = 'id'):
+    def __init__(self, model_objects_manager: models.Manager, fields_config, natural_sorting_field: str = 'id',
+                 vector_field: str = None):
+        """
+        :param vector_field: stored tsvector column built from fields_config, matched and ranked instead of
+            computing the vector of every row
+        """
         self.model_objects_manager = model_objects_manager
         self.natural_sorting_field = natural_sorting_field
         self.fields_config = fields_config
+        self.vector_field = vector_field
 
     def search(self, keyword, q_list):
+        if self.vector_field:
+            search_query = self.build_prefix_query(keyword)
+            if search_query is not None:
+                return self.__search_stored__(search_query, SearchQuery(self.unaccent(keyword)), q_list)
         return self.__search__(keyword, q_list)
 
+    @staticmethod
+    def build_prefix_query(keyword):
+        """
+        every word of the keyword as a prefix, 'para 500' -> 'para:* & 500:*', so a partly typed name still matches
+        :return: None when the keyword has no word
+        """
+        tokens = KEYWORD_TOKEN_RE.findall(keyword)
+        if not tokens:
+            return None
+        return SearchQuery(PostgresFulltextSearch.unaccent(' & '.join('{}:*'.format(token) for token in tokens)),
+                           search_type='raw')
+
+    @staticmethod
+    def unaccent(keyword):
+        """
+        the keyword folded by the database like the searched vectors, 'giảm đau' matches 'giam dau' and the reverse
+        """
+        return f_unaccent(Value(keyword))
+
+    def __search_stored__(self, search_query, exact_query, q_list):
+        """
+        match with the GIN index of the stored vector, or with the q_list conditions so a keyword inside a word
+        ('cetamol', a part of a key) is still found, they should be index backed too (f_unaccent__icontains and the
+        trigram indexes). Only the matching rows are ranked, whole words first, substring only matches last
+        """
+        condition = Q(**{self.vector_field: search_query})
+        if q_list:
+            condition = reduce(operator.or_, q_list, condition)
+        return self.model_objects_manager.filter(condition).annotate(
+            rank=SearchRank(F(self.vector_field), search_query | exact_query)
+        ).order_by('-rank', '-{}'.format(self.natural_sorting_field))
+
     def __search__(self, keyword, q_list):
         """
         fulltext search based on SearchQuery and SearchVector and ranking on it
@@ -48,14 +100,16 @@ class PostgresFulltextSearch:
         """
         look_up_filter = []
         first_field = self.fields_config[0]
-        combined_search_vector = SearchVector(first_field.get('field_name'), weight=first_field.get('weight'))
+        combined_search_vector = SearchVector(f_unaccent(first_field.get('field_name')),
+                                              weight=first_field.get('weight'))
         for index, field_config in enumerate(self.fields_config):
             look_up_filter.append(Q('{}__icontains={}'.format(field_config.get('field_name'), keyword)))
             if index == 0:
                 continue
-            combined_search_vector += SearchVector(field_config.get('field_name'), weight=field_config.get('weight'))
+            combined_search_vector += SearchVector(f_unaccent(field_config.get('field_name')),
+                                                   weight=field_config.get('weight'))
 
-        search_query = SearchQuery(keyword)
+        search_query = SearchQuery(self.unaccent(keyword))
 
         res = self.model_objects_manager.filter(reduce(operator.or_, q_list)).annotate(
             rank=SearchRank(combined_search_vector, search_query)
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.cache import cache
+
+WORK_SPACE_VERSION_KEY = 'stats:work-space:{work_space_id}:version'
+PHARMACY_VERSION_KEY = 'stats:pharmacy:{pharmacy_id}:version'
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def _get_version(key) -> int:
+    version = cache.get(key)
+    if version is None:
+        version = 1
+        cache.add(key, version, timeout=None)
+    return version
+
+
+def _bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, timeout=None)
+
+
+def get_work_space_version(work_space_id) -> int:
+    """
+    version of the cached stats of a work space, bumped whenever one of its prescriptions changes
+    """
+    return _get_version(WORK_SPACE_VERSION_KEY.format(work_space_id=work_space_id))
+
+
+def bump_work_space_version(work_space_id):
+    _bump_version(WORK_SPACE_VERSION_KEY.format(work_space_id=work_space_id))
+
+
+def get_pharmacy_version(pharmacy_id) -> int:
+    """
+    version of the cached stats of a pharmacy, bumped whenever one of its prescriptions changes
+    """
+    return _get_version(PHARMACY_VERSION_KEY.format(pharmacy_id=pharmacy_id))
+
+
+def bump_pharmacy_version(pharmacy_id):
+    _bump_version(PHARMACY_VERSION_KEY.format(pharmacy_id=pharmacy_id))
+
+
+def get_stats_cache_timeout() -> int:
+    return settings.STATS_CACHE_TIMEOUT
+
+
+def get_catalog_version() -> int:
+    """
+    version of the cached drug catalog (drugs, prices), bumped once per bulk price update
+    """
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    _bump_version(CATALOG_VERSION_KEY)
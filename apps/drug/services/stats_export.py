@@ -0,0 +1,51 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+EXPORT_CSV = 'csv'
+EXPORT_NDJSON = 'ndjson'
+
+EXPORT_FORMATS = [EXPORT_CSV, EXPORT_NDJSON]
+
+EXPORT_CONTENT_TYPES = {
+    EXPORT_CSV: 'text/csv',
+    EXPORT_NDJSON: 'application/x-ndjson',
+}
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class _EchoBuffer:
+    """
+    file-like object handing back what csv.writer writes instead of storing it
+    """
+
+    def write(self, value):
+        return value
+
+
+class StreamExportService:
+
+    def __init__(self, export_format, header: [str]):
+        assert export_format in EXPORT_FORMATS, 'export_format must be in [{}]'.format(', '.join(EXPORT_FORMATS))
+        self.export_format = export_format
+        self.header = header
+
+    @property
+    def content_type(self):
+        return EXPORT_CONTENT_TYPES[self.export_format]
+
+    def stream(self, rows):
+        """
+        encode rows one by one, the header goes out before the first row is read
+        :param rows: iterable of tuples ordered as the header
+        """
+        if self.export_format == EXPORT_CSV:
+            writer = csv.writer(_EchoBuffer())
+            yield writer.writerow(self.header)
+            for row in rows:
+                yield writer.writerow(row)
+        else:
+            for row in rows:
+                yield json.dumps(dict(zip(self.header, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
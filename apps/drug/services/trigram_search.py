@@ -0,0 +1,61 @@
+import operator
+from functools import reduce
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.db.models import Q, TextField, Value
+from django.db.models.functions import Cast, Greatest, Upper
+
+from apps.drug.services.unaccent import f_unaccent, UNACCENT_FUNCTION
+
+FUZZY_TRUE_VALUES = ['true', '1']
+
+
+def is_fuzzy(query_params) -> bool:
+    return (query_params.get('fuzzy') or '').lower() in FUZZY_TRUE_VALUES
+
+
+class TrigramSearch:
+    """
+    accent insensitive substring and typo tolerant search over text columns, both served by the GIN trigram indexes
+    on UPPER(f_unaccent(column::text)), see migration 0013
+    """
+
+    def __init__(self, queryset, field_names: [str], natural_sorting_field: str = 'id', threshold: float = None):
+        self.queryset = queryset
+        self.field_names = field_names
+        self.natural_sorting_field = natural_sorting_field
+        self.threshold = settings.TRIGRAM_SIMILARITY_THRESHOLD if threshold is None else threshold
+
+    def contains(self, keyword):
+        """
+        UPPER(f_unaccent(column)) LIKE '%' || UPPER(f_unaccent('keyword')) || '%' on any of the columns, the index
+        looks up the trigrams of the folded keyword
+        """
+        q_list = [Q(**{'{}__{}__icontains'.format(name, UNACCENT_FUNCTION): keyword}) for name in self.field_names]
+        return self.queryset.filter(reduce(operator.or_, q_list)).order_by('-{}'.format(self.natural_sorting_field))
+
+    def fuzzy(self, keyword):
+        """
+        rows with a column similar to the keyword (similarity >= threshold), the most similar first
+        """
+        keyword = Upper(f_unaccent(Value(keyword)))
+        upper_fields = {'{}_upper'.format(name): Upper(f_unaccent(Cast(name, TextField())))
+                        for name in self.field_names}
+        similarities = [TrigramSimilarity(name, keyword) for name in upper_fields]
+        similarity = similarities[0] if len(similarities) == 1 else Greatest(*similarities)
+        # `%` is the operator the index answers, it compares with pg_trgm.similarity_threshold
+        q_list = [Q(**{'{}__trigram_similar'.format(name): keyword}) for name in upper_fields]
+
+        self.__set_threshold()
+        return self.queryset.annotate(**upper_fields).filter(reduce(operator.or_, q_list)).annotate(
+            similarity=similarity
+        ).order_by('-similarity', '-{}'.format(self.natural_sorting_field))
+
+    def __set_threshold(self):
+        # transaction local (SET LOCAL), it lasts until the end of the request transaction (ATOMIC_REQUESTS) where
+        # the queryset is evaluated, and never leaks to the next request of a pooled connection. Outside of a
+        # transaction, evaluate the queryset in transaction.atomic() or the default threshold applies
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true);", [str(self.threshold)])
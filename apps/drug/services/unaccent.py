@@ -0,0 +1,25 @@
+from django.db.models import CharField, Func, TextField, Transform
+
+# immutable wrapper of unaccent() created by migration 0013, unaccent() itself is only stable so no index can be
+# built on it
+UNACCENT_FUNCTION = 'f_unaccent'
+
+
+def f_unaccent(expression):
+    """
+    f_unaccent(expression) as text, for annotations and search vectors, filters use the f_unaccent lookup below
+    """
+    return Func(expression, function=UNACCENT_FUNCTION, output_field=TextField())
+
+
+@CharField.register_lookup
+@TextField.register_lookup
+class FUnaccent(Transform):
+    """
+    accent folding with f_unaccent, 'giảm đau' -> 'giam dau'. Bilateral, `name__f_unaccent__icontains='giảm'`
+    folds both the column and the keyword: UPPER(f_unaccent(name)::text) LIKE '%' || UPPER(f_unaccent('giảm')) || '%',
+    the expression of the trigram indexes of migration 0013
+    """
+    bilateral = True
+    lookup_name = UNACCENT_FUNCTION
+    function = UNACCENT_FUNCTION
@@ -1,18 +1,53 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver, Signal
 
-from apps.drug.models import Prescription
-from apps.drug.services.calc_prescription_price_record import CalculatePrescriptionPriceRecordService
+from apps.drug.models import Drug, Prescription
+from apps.drug.services.drug_autocomplete import drug_autocomplete_index
+from apps.drug.services.drug_sales_cube import DrugSalesCubeService
+from apps.drug.services.prescription_daily_stats import PrescriptionDailyStatsService
+from apps.drug.services.stats_cache import bump_work_space_version, bump_pharmacy_version, bump_catalog_version
 
+# opt-in hook sent once a prescription and its details are saved, total_price is already up to date
 signal_update_or_create_prescription = Signal(providing_args=['prescription_id'])
 
 
-@receiver(signal_update_or_create_prescription)
-def bulk_sync_pharmacy_prescription(**kwargs):
-    try:
-        prescription_id = kwargs.get('prescription_id')
-        ins = Prescription.objects.get(pk=prescription_id)
-        total_price = CalculatePrescriptionPriceRecordService.calc_total_price_prescription(prescription_id)
-        ins.total_price = total_price if total_price else 0
-        ins.save()
-    except Exception as err:
-        print('signal_update_or_create_prescription SIGNAL: %s' % err)
+@receiver(post_save, sender=Prescription)
+def sync_prescription_daily_stats(sender, instance, created, **kwargs):
+    # runs inside the transaction of the save, so the stats never drift from drug_prescription
+    PrescriptionDailyStatsService.apply_changes(instance, created=created)
+
+
+@receiver(post_save, sender=Prescription)
+def refresh_drug_sales_cube(sender, instance, created, **kwargs):
+    # the changes of the details are applied by the sync, see PrescriptionDrugContentSerializer
+    DrugSalesCubeService.apply_changes(instance, created=created)
+
+
+@receiver(post_save, sender=Drug)
+def sync_drug_sales_cube_category(sender, instance, **kwargs):
+    DrugSalesCubeService.sync_drug_category(instance.id, instance.category_id)
+
+
+@receiver(post_save, sender=Drug)
+@receiver(post_delete, sender=Drug)
+def invalidate_drug_catalog(sender, instance, **kwargs):
+    # the catalog caches see the new version, the autocomplete index of this process checks on its next search
+    def bump():
+        bump_catalog_version()
+        drug_autocomplete_index.invalidate()
+
+    transaction.on_commit(bump)
+
+
+@receiver(post_save, sender=Prescription)
+def invalidate_prescription_stats_cache(sender, instance, **kwargs):
+    work_space_id = instance.work_space_id
+    pharmacy_ids = {instance.pharmacy_id, instance.tracker.previous('pharmacy')} - {None}
+
+    def bump():
+        bump_work_space_version(work_space_id)
+        for pharmacy_id in pharmacy_ids:
+            bump_pharmacy_version(pharmacy_id)
+
+    transaction.on_commit(bump)
@@ -1,3 +1,871 @@
-from django.test import TestCase
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from apps.drug.models import (
+    WorkSpace, UserWorkSpace, Pharmacy, Prescription, PrescriptionDetail, Drug, Category, IdempotencyKey,
+    DrugSalesDaily, AuditLog)
+from apps.drug.services.audit_log import AuditLogBuffer, audit_event, audit_log_buffer
+from apps.drug.services.calc_bins_from_range_time import BIN_HOURS
+from apps.drug.services.calc_total_price_time_unit import (
+    CalculatePriceByTimeUnitForPharmacy, CalculatePriceByTimeUnitForPharmacies)
+from apps.drug.services.drug_bulk_price import DrugBulkPriceService
+from apps.drug.services.drug_autocomplete import DrugAutocompleteIndex, normalize, get_terms
+from apps.drug.services.drug_sales_cube import DrugSalesCubeService
+from apps.drug.services.idempotency import IdempotencyService
+from apps.drug.services.prescription_daily_stats import PrescriptionDailyStatsService
+from apps.drug.services.prescription_detail_upsert import PrescriptionDetailUpsertService
+from apps.drug.services.search import PostgresFulltextSearch, CONFIG_DRUG_RANK, SEARCH_VECTOR_FIELD
+from apps.drug.services.stats_cache import get_catalog_version
+from apps.drug.services.trigram_search import TrigramSearch
+
+
+class BaseWorkSpaceTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='pharmacist')
+        cls.work_space = WorkSpace.objects.create(name='work space', owner=cls.user)
+        UserWorkSpace.objects.create(user=cls.user, work_space=cls.work_space)
+        cls.pharmacy = Pharmacy.objects.create(work_space=cls.work_space, name='pharmacy', address='address',
+                                               phone='0123456789')
+
+
+class PrescriptionStatsIndexTest(BaseWorkSpaceTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(PrescriptionStatsIndexTest, cls).setUpTestData()
+        for index in range(20):
+            Prescription.objects.create(work_space=cls.work_space, pharmacy=cls.pharmacy, total_price=index)
+
+    def explain(self, handler):
+        with CaptureQueriesContext(connection) as queries:
+            handler.run()
+        query = queries.captured_queries[-1]['sql']
+        with connection.cursor() as cursor:
+            # the test table is tiny, make sure the planner does not prefer a sequential scan for that reason only
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN {}'.format(query))
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test_pharmacy_live_bins_use_pharmacy_created_index(self):
+        to_date = timezone.now()
+        handler = CalculatePriceByTimeUnitForPharmacy(self.pharmacy.id, BIN_HOURS, to_date - timedelta(hours=48),
+                                                      to_date)
+        plan = self.explain(handler)
+        self.assertIn('drug_pres_pharmacy_created_idx', plan)
+        self.assertNotIn('Seq Scan on drug_prescription', plan)
+
+    def test_pharmacies_live_bins_use_pharmacy_created_index(self):
+        to_date = timezone.now()
+        handler = CalculatePriceByTimeUnitForPharmacies([self.pharmacy.id], BIN_HOURS,
+                                                        to_date - timedelta(hours=48), to_date)
+        plan = self.explain(handler)
+        self.assertIn('drug_pres_pharmacy_created_idx', plan)
+        self.assertNotIn('Seq Scan on drug_prescription', plan)
+
+
+class PharmacyPrescriptionStatisticTest(BaseWorkSpaceTestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('pharmacy-prescription-stats', kwargs={'work_space_id': self.work_space.id,
+                                                                  'pk': self.pharmacy.id})
+
+    def test_unknown_time_zone_is_rejected(self):
+        response = self.client.get(self.url, {'type': 'DAYS', 'time_zone': 'Asia/Atlantis'})
+        self.assertEqual(response.status_code, 400)
+
+        for params in [{'type': 'DAYS', 'time_zone': 'Asia/Ho_Chi_Minh'}, {'type': 'DAYS'}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['stats'], {'labels': [], 'data': []})
+
+
+class TrigramSearchIndexTest(BaseWorkSpaceTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(TrigramSearchIndexTest, cls).setUpTestData()
+        cls.category = Category.objects.create(name='giảm đau, hạ sốt')
+        for name in ['Paracetamol 500mg', 'Ibuprofen 400mg', 'Amoxicillin 250mg', 'Omeprazole 20mg']:
+            Drug.objects.create(name=name, key=name[:4].upper(), category=cls.category)
+
+    @staticmethod
+    def explain(query_set):
+        with connection.cursor() as cursor:
+            # the test table is tiny, make sure the planner does not prefer a sequential scan for that reason only
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return query_set.explain()
+
+    def test_drug_icontains_uses_trigram_indexes(self):
+        plan = self.explain(TrigramSearch(Drug.objects.all(), ['name', 'key']).contains('cetam'))
+        self.assertIn('drug_drug_name_unaccent_trgm', plan)
+        self.assertIn('drug_drug_key_unaccent_trgm', plan)
+        self.assertNotIn('Seq Scan on drug_drug', plan)
+
+    def test_category_icontains_uses_trigram_index(self):
+        plan = self.explain(Category.objects.filter(name__f_unaccent__icontains='dau'))
+        self.assertIn('drug_category_name_unaccent_trgm', plan)
+        self.assertNotIn('Seq Scan on drug_category', plan)
+
+    def test_pharmacy_icontains_uses_trigram_index(self):
+        plan = self.explain(Pharmacy.objects.filter(name__f_unaccent__icontains='pharm'))
+        self.assertIn('drug_pharmacy_name_unaccent_trgm', plan)
+        self.assertNotIn('Seq Scan on drug_pharmacy', plan)
+
+    def test_fuzzy_uses_trigram_index_and_ranks_by_similarity(self):
+        query_set = TrigramSearch(Drug.objects.all(), ['name', 'key'], 'modified').fuzzy('paracetmol')
+        self.assertIn('drug_drug_name_unaccent_trgm', self.explain(query_set))
+        self.assertEqual(query_set.first().name, 'Paracetamol 500mg')
+        self.assertGreater(query_set.first().similarity, 0.3)
+
+    def test_contains_ignores_diacritics(self):
+        for keyword in ['giam dau', 'GIẢM ĐAU', 'ha sot']:
+            self.assertEqual(list(TrigramSearch(Category.objects.all(), ['name']).contains(keyword)), [self.category])
+
+    def test_fulltext_search_ignores_diacritics(self):
+        Drug.objects.create(name='Thuốc giảm đau', key='TGD', category=self.category)
+        search_handler = PostgresFulltextSearch(Drug.objects.all(), CONFIG_DRUG_RANK, vector_field=SEARCH_VECTOR_FIELD)
+        for keyword in ['giam dau', 'thuoc giảm', 'Giảm Đau']:
+            self.assertEqual([drug.name for drug in search_handler.search(keyword, [])], ['Thuốc giảm đau'])
+
+    def test_fulltext_search_keeps_the_substring_matches(self):
+        search_handler = PostgresFulltextSearch(Drug.objects.filter(category=self.category), CONFIG_DRUG_RANK,
+                                                vector_field=SEARCH_VECTOR_FIELD)
+        for keyword, name in [('cetamol', 'Paracetamol 500mg'), ('xici', 'Amoxicillin 250mg')]:
+            q_list = [Q(key__f_unaccent__icontains=keyword), Q(name__f_unaccent__icontains=keyword)]
+            self.assertEqual([drug.name for drug in search_handler.search(keyword, q_list)], [name])
+        # whole word matches are ranked before the substring only ones
+        Drug.objects.create(name='Cetamol', key='CETA', category=self.category)
+        q_list = [Q(key__f_unaccent__icontains='cetamol'), Q(name__f_unaccent__icontains='cetamol')]
+        self.assertEqual([drug.name for drug in search_handler.search('cetamol', q_list)],
+                         ['Cetamol', 'Paracetamol 500mg'])
+
+
+class PrescriptionTotalPriceTest(BaseWorkSpaceTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(PrescriptionTotalPriceTest, cls).setUpTestData()
+        cls.drugs = [Drug.objects.create(name='drug {}'.format(index), price=10) for index in range(3)]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @staticmethod
+    def prescription_queries(queries):
+        # ORM statements on drug_prescription and raw reads of the details, the sales cube reads are not counted
+        return [item['sql'] for item in queries.captured_queries if '"drug_prescription"' in item['sql']
+                or item['sql'].strip().startswith('SELECT') and 'drug_prescriptiondetail AS' in item['sql']
+                and 'JOIN drug_drug' not in item['sql']]
+
+    def test_create_writes_the_total_once(self):
+        url = reverse('list-create-prescription', kwargs={'work_space_id': self.work_space.id})
+        data = {
+            'pharmacy': str(self.pharmacy.id),
+            'status': 'DONE',
+            'list_prescription_detail': [{'drug': str(drug.id), 'quantity': index + 1, 'price_at_the_time': 10}
+                                         for index, drug in enumerate(self.drugs)]
+        }
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_price'], 60)
+        self.assertEqual(Prescription.objects.get(pk=response.data['id']).total_price, 60)
+
+        # the INSERT and a single column UPDATE, no reload of the prescription nor SUM over its details
+        # (was INSERT, SELECT prescription, SELECT SUM details and a full row UPDATE)
+        statements = self.prescription_queries(queries)
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('INSERT INTO "drug_prescription"'))
+        self.assertTrue(statements[1].startswith('UPDATE "drug_prescription" SET "modified" = '))
+        self.assertNotIn('"status"', statements[1])
+
+    def test_update_details_saves_the_total_with_the_prescription(self):
+        prescription = Prescription.objects.create(work_space=self.work_space, pharmacy=self.pharmacy)
+        url = reverse('update-prescription-drug-detail', kwargs={'work_space_id': self.work_space.id,
+                                                                 'pk': prescription.id})
+        data = {'list_prescription_detail': [{'drug': str(self.drugs[0].id), 'quantity': 7, 'price_at_the_time': 3}]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, data, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_price'], 21)
+        statements = [' '.join(item['sql'].split()) for item in queries.captured_queries
+                      if not item['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+        expected = [
+            # the view: work space, membership, prescription and the drugs of the details
+            'SELECT "drug_workspace"',
+            'SELECT "drug_userworkspace"',
+            'SELECT "drug_prescription"',
+            'SELECT "drug_drug"',
+            # compare and swap of the version
+            'UPDATE "drug_prescription" SET "version" = 2 WHERE',
+            # sales of the details before the sync, the sync and the sales cube deltas
+            'SELECT detail.drug_id, SUM(detail.quantity)',
+            'INSERT INTO drug_prescriptiondetail',
+            'UPDATE drug_prescriptiondetail SET is_removed = TRUE',
+            'INSERT INTO drug_drugsalesdaily',
+            # the changed columns only, no reload nor SUM of the details
+            'UPDATE "drug_prescription" SET "modified" = ',
+            'INSERT INTO drug_prescriptiondailystats',
+        ]
+        self.assertEqual(len(statements), len(expected), statements)
+        for statement, start in zip(statements, expected):
+            self.assertIn(start, statement)
+        self.assertIn('"total_price" = 21.0, "version" = 2 WHERE', statements[9])
+        self.assertNotIn('"status"', statements[9])
+
+    def test_update_saves_the_changed_fields_only(self):
+        prescription = Prescription.objects.create(work_space=self.work_space, pharmacy=self.pharmacy, note='note')
+        url = reverse('update-prescription-drug-detail', kwargs={'work_space_id': self.work_space.id,
+                                                                 'pk': prescription.id})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, {'status': 'DONE', 'note': 'note'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        statement = [item['sql'] for item in queries.captured_queries
+                     if item['sql'].startswith('UPDATE "drug_prescription" SET "modified"')][0]
+        self.assertIn('"status" = \'DONE\', "version" = 2 WHERE', statement)
+        self.assertNotIn('"note"', statement)
+        self.assertNotIn('"total_price"', statement)
+        self.assertEqual(Prescription.objects.get(pk=prescription.pk).status, 'DONE')
+
+    def test_update_removes_the_details_left_out(self):
+        prescription = Prescription.objects.create(work_space=self.work_space, pharmacy=self.pharmacy)
+        for drug in self.drugs:
+            PrescriptionDetail.objects.create(prescription=prescription, drug=drug, quantity=1, price_at_the_time=10)
+        url = reverse('update-prescription-drug-detail', kwargs={'work_space_id': self.work_space.id,
+                                                                 'pk': prescription.id})
+        data = {'list_prescription_detail': [{'drug': str(self.drugs[0].id), 'quantity': 2, 'price_at_the_time': 10}]}
+        response = self.client.patch(url, data, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_price'], 20)
+        self.assertEqual(list(PrescriptionDetail.objects.filter(prescription=prescription)
+                              .values_list('drug_id', 'quantity')), [(self.drugs[0].id, 2)])
+
+    def test_sync_removes_stale_details_whatever_the_drugs_sent(self):
+        prescription = Prescription.objects.create(work_space=self.work_space, pharmacy=self.pharmacy)
+        for drug in self.drugs:
+            PrescriptionDetail.objects.create(prescription=prescription, drug=drug, quantity=1, price_at_the_time=10)
+        # a detail without drug is not written and does not keep the stale details alive
+        details = [PrescriptionDetail(prescription=prescription, drug=self.drugs[0], quantity=1, price_at_the_time=10),
+                   PrescriptionDetail(prescription=prescription, drug=None, quantity=1, price_at_the_time=10)]
+        result = PrescriptionDetailUpsertService(prescription.id).sync(details)
+
+        self.assertEqual(result['stats']['deleted'], 2)
+        self.assertEqual(list(PrescriptionDetail.objects.filter(prescription=prescription)
+                              .values_list('drug_id', flat=True)), [self.drugs[0].id])
+
+    def test_create_without_details(self):
+        url = reverse('list-create-prescription', kwargs={'work_space_id': self.work_space.id})
+        response = self.client.post(url, {'pharmacy': str(self.pharmacy.id), 'list_prescription_detail': []},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_price'], 0)
+
+    def test_details_without_drug_or_with_a_repeated_drug_are_rejected(self):
+        url = reverse('list-create-prescription', kwargs={'work_space_id': self.work_space.id})
+        drug_id = str(self.drugs[0].id)
+        for details in [[{'drug': None, 'quantity': 1}],
+                        [{'drug': drug_id, 'quantity': 1}, {'drug': drug_id, 'quantity': 2}]]:
+            response = self.client.post(url, {'pharmacy': str(self.pharmacy.id), 'list_prescription_detail': details},
+                                        format='json')
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Prescription.objects.filter(work_space=self.work_space).exists())
+
+
+class DrugSalesCubeTest(BaseWorkSpaceTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(DrugSalesCubeTest, cls).setUpTestData()
+        cls.other_pharmacy = Pharmacy.objects.create(work_space=cls.work_space, name='other pharmacy',
+                                                     address='address', phone='0123456789')
+        cls.drugs = [Drug.objects.create(name='drug {}'.format(index), price=10) for index in range(3)]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create(self, details):
+        url = reverse('list-create-prescription', kwargs={'work_space_id': self.work_space.id})
+        response = self.client.post(url, {'pharmacy': str(self.pharmacy.id), 'status': 'DONE',
+                                          'list_prescription_detail': details}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return Prescription.objects.get(pk=response.data['id'])
+
+    def patch(self, prescription, data):
+        url = reverse('update-prescription-drug-detail', kwargs={'work_space_id': self.work_space.id,
+                                                                 'pk': prescription.id})
+        self.assertEqual(self.client.patch(url, data, format='json').status_code, 200)
+
+    def assertCubeIsCurrent(self):
+        self.assertEqual(DrugSalesCubeService.check(self.work_space.id), [])
+
+    def test_prescription_writes_apply_deltas(self):
+        first = self.create([{'drug': str(self.drugs[0].id), 'quantity': 2},
+                             {'drug': str(self.drugs[1].id), 'quantity': 1}])
+        second = self.create([{'drug': str(self.drugs[0].id), 'quantity': 3}])
+        self.assertCubeIsCurrent()
+        self.assertEqual(DrugSalesDaily.objects.get(pharmacy=self.pharmacy, drug=self.drugs[0]).quantity, 5)
+
+        # a quantity changed, a line removed and a line added
+        details = [{'drug': str(self.drugs[0].id), 'quantity': 4}, {'drug': str(self.drugs[2].id), 'quantity': 1}]
+        self.patch(first, {'list_prescription_detail': details})
+        self.assertCubeIsCurrent()
+        self.assertFalse(DrugSalesDaily.objects.filter(drug=self.drugs[1]).exists())
+
+        # the details and the pharmacy in the same request
+        self.patch(second, {'pharmacy': str(self.other_pharmacy.id),
+                            'list_prescription_detail': [{'drug': str(self.drugs[1].id), 'quantity': 2}]})
+        self.assertCubeIsCurrent()
+
+        # fetched again, the tracker of the instance would still hold the pharmacy it was created with
+        second = Prescription.objects.get(pk=second.pk)
+        second.status = 'CANCELLED'
+        second.save()
+        self.assertCubeIsCurrent()
+        self.assertFalse(DrugSalesDaily.objects.filter(pharmacy=self.other_pharmacy).exists())
+        second.status = 'DONE'
+        second.save()
+        self.assertCubeIsCurrent()
+
+        second.delete()
+        self.assertCubeIsCurrent()
+        # the prescriptions removed, not the ones already removed
+        self.assertEqual(Prescription.objects.filter(work_space=self.work_space).delete(), 1)
+        self.assertCubeIsCurrent()
+        self.assertFalse(DrugSalesDaily.objects.filter(work_space=self.work_space).exists())
+
+    def test_all_objects_delete_is_the_soft_delete(self):
+        prescription = self.create([{'drug': str(self.drugs[0].id), 'quantity': 2}])
+        self.assertEqual(Prescription.all_objects.filter(pk=prescription.pk).delete(), 1)
+        self.assertEqual(Prescription.all_objects.filter(pk=prescription.pk).delete(), 0)
+
+        self.assertTrue(Prescription.all_objects.get(pk=prescription.pk).is_removed)
+        self.assertCubeIsCurrent()
+        self.assertEqual(PrescriptionDailyStatsService.check(self.work_space.id), [])
+        self.assertFalse(DrugSalesDaily.objects.filter(work_space=self.work_space).exists())
+
+    def test_detail_sync_reads_only_its_prescription(self):
+        self.create([{'drug': str(self.drugs[0].id), 'quantity': 2}])
+        prescription = self.create([{'drug': str(self.drugs[0].id), 'quantity': 1}])
+        with CaptureQueriesContext(connection) as queries:
+            self.patch(prescription, {'list_prescription_detail': [{'drug': str(self.drugs[0].id), 'quantity': 5}]})
+        # the cube rows get deltas, the (pharmacy, day) slice is never aggregated again
+        self.assertFalse([item['sql'] for item in queries.captured_queries
+                          if 'JOIN drug_prescription AS pres' in item['sql']])
+        self.assertEqual(DrugSalesDaily.objects.get(pharmacy=self.pharmacy, drug=self.drugs[0]).quantity, 7)
+        self.assertCubeIsCurrent()
+
+
+class KeysetPaginationTest(BaseWorkSpaceTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(KeysetPaginationTest, cls).setUpTestData()
+        # several prescriptions per timestamp, the id breaks the ties
+        created = timezone.now()
+        for index in range(25):
+            prescription = Prescription.objects.create(work_space=cls.work_space, pharmacy=cls.pharmacy)
+            Prescription.objects.filter(pk=prescription.pk).update(created=created - timedelta(minutes=index // 4))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('list-create-prescription', kwargs={'work_space_id': self.work_space.id})
+
+    def test_pages_follow_the_listing_order(self):
+        expected = [str(pk) for pk in Prescription.objects.filter(work_space=self.work_space)
+                    .order_by('-created', '-id').values_list('id', flat=True)]
+        pages = [self.client.get(self.url, {'pagination': 'cursor', 'limit': 10})]
+        while pages[-1].data['next']:
+            pages.append(self.client.get(pages[-1].data['next']))
+
+        self.assertEqual([len(page.data['results']) for page in pages], [10, 10, 5])
+        self.assertNotIn('count', pages[0].data)
+        self.assertEqual([item['id'] for page in pages for item in page.data['results']], expected)
+        previous = self.client.get(pages[-1].data['previous'])
+        self.assertEqual(previous.data['results'], pages[1].data['results'])
+
+    def test_page_numbers_stay_the_default(self):
+        response = self.client.get(self.url, {'limit': 10, 'page': 3})
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_ranked_search_cannot_be_paginated_by_key(self):
+        response = self.client.get(self.url, {'pagination': 'cursor', 'keyword': 'done'})
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotencyTest(BaseWorkSpaceTestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('list-create-prescription', kwargs={'work_space_id': self.work_space.id})
+        self.data = {'pharmacy': str(self.pharmacy.id), 'status': 'DONE', 'list_prescription_detail': []}
+
+    def test_retry_replays_the_first_response(self):
+        first = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+        retry = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', first)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['id'], first.data['id'])
+        self.assertEqual(Prescription.objects.filter(work_space=self.work_space).count(), 1)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY='order-1')
+        response = self.client.post(self.url, dict(self.data, status='CANCELLED'), format='json',
+                                    HTTP_IDEMPOTENCY_KEY='order-1')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Prescription.objects.filter(work_space=self.work_space).count(), 1)
+
+    def test_purge_deletes_the_expired_keys_in_batches(self):
+        now = timezone.now()
+        for index in range(5):
+            IdempotencyKey.objects.create(work_space=self.work_space, key='expired {}'.format(index), request_hash='',
+                                          status_code=201, expires_at=now - timedelta(minutes=1))
+        IdempotencyKey.objects.create(work_space=self.work_space, key='live', request_hash='', status_code=201,
+                                      expires_at=now + timedelta(hours=1))
+        with CaptureQueriesContext(connection) as queries:
+            count = IdempotencyService.purge(batch_size=2)
+
+        self.assertEqual(count, 5)
+        # 2 + 2 + 1 rows
+        self.assertEqual(len([item for item in queries.captured_queries if item['sql'].strip().startswith('DELETE')]),
+                         3)
+        self.assertEqual(list(IdempotencyKey.objects.filter(work_space=self.work_space).values_list('key', flat=True)),
+                         ['live'])
+
+
+class AuditLogTest(BaseWorkSpaceTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(AuditLogTest, cls).setUpTestData()
+        cls.drugs = [Drug.objects.create(name='drug {}'.format(index), price=10) for index in range(2)]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_bulk_ingest_writes_its_audit_rows_in_its_transaction(self):
+        url = reverse('bulk-create-prescription', kwargs={'work_space_id': self.work_space.id})
+        data = {'list_prescription': [
+            {'pharmacy': str(self.pharmacy.id), 'status': 'DONE', 'list_prescription_detail': [
+                {'drug': str(drug.id), 'quantity': 2} for drug in self.drugs]},
+            {'pharmacy': str(self.pharmacy.id), 'status': 'CANCELLED', 'list_prescription_detail': [
+                {'drug': str(self.drugs[0].id), 'quantity': 1, 'price_at_the_time': 4}]},
+        ]}
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        # written by the batch itself, not queued to the in process buffer on commit
+        first_id, second_id = response.data['ids']
+        logs = AuditLog.objects.filter(Q(entity_id__in=response.data['ids'])
+                                       | Q(changes__prescription__in=[str(first_id), str(second_id)]))
+        self.assertEqual(logs.count(), 5)
+        self.assertEqual(set(logs.values_list('actor_id', 'action')), {(self.user.id, 'created')})
+        self.assertEqual(logs.get(entity_id=first_id).changes, {
+            'pharmacy': str(self.pharmacy.id), 'status': 'DONE', 'total_price': 40})
+        self.assertEqual(logs.get(entity_id=second_id).changes, {
+            'pharmacy': str(self.pharmacy.id), 'status': 'CANCELLED', 'total_price': 4})
+        detail = PrescriptionDetail.objects.get(prescription_id=second_id)
+        self.assertEqual(logs.get(entity='prescription_detail', entity_id=detail.id).changes, {
+            'prescription': str(second_id), 'drug': str(self.drugs[0].id), 'quantity': 1, 'price_at_the_time': 4})
+
+    def test_prescription_writes_record_their_events(self):
+        url = reverse('list-create-prescription', kwargs={'work_space_id': self.work_space.id})
+        data = {'pharmacy': str(self.pharmacy.id), 'status': 'DONE',
+                'list_prescription_detail': [{'drug': str(self.drugs[0].id), 'quantity': 2}]}
+        with mock.patch.object(audit_log_buffer, 'record') as record:
+            response = self.client.post(url, data, format='json')
+        prescription_id = uuid.UUID(response.data['id'])
+        detail = PrescriptionDetail.objects.get(prescription_id=prescription_id)
+        events = record.call_args[0][0]
+        self.assertEqual([(event['entity'], event['entity_id'], event['action'], event['actor_id'])
+                          for event in events],
+                         [('prescription', prescription_id, 'created', self.user.id),
+                          ('prescription_detail', detail.id, 'created', self.user.id)])
+        self.assertEqual(events[0]['changes'], {'pharmacy': self.pharmacy.id, 'status': 'DONE', 'total_price': 20})
+        self.assertEqual(events[1]['changes'], {'prescription': prescription_id, 'drug': self.drugs[0].id,
+                                                'quantity': 2, 'price_at_the_time': 10})
+
+        url = reverse('update-prescription-drug-detail', kwargs={'work_space_id': self.work_space.id,
+                                                                 'pk': prescription_id})
+        data = {'status': 'CANCELLED', 'list_prescription_detail': [{'drug': str(self.drugs[1].id), 'quantity': 1}]}
+        with mock.patch.object(audit_log_buffer, 'record') as record:
+            self.client.patch(url, data, format='json')
+        new_detail = PrescriptionDetail.objects.get(prescription_id=prescription_id)
+        events = record.call_args[0][0]
+        # the prescription first, then the details written and the ones removed by the sync
+        self.assertEqual([(event['entity'], event['entity_id'], event['action']) for event in events],
+                         [('prescription', prescription_id, 'updated'),
+                          ('prescription_detail', new_detail.id, 'created'),
+                          ('prescription_detail', detail.id, 'deleted')])
+        self.assertEqual(events[0]['changes'], {'status': ['DONE', 'CANCELLED'], 'total_price': [20, 10]})
+
+
+class AuditLogBufferTest(TransactionTestCase):
+    """
+    the buffer is used from the test thread only, its background thread is never started
+    """
+
+    def buffer(self, max_size=10, batch_size=2):
+        buffer = AuditLogBuffer(max_size=max_size, batch_size=batch_size, flush_interval=1)
+        patcher = mock.patch.object(buffer, '_AuditLogBuffer__ensure_worker')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return buffer
+
+    @staticmethod
+    def events(number, entity='drug'):
+        return [audit_event(entity, uuid.uuid4(), 'updated', {'price': [1, 2]}) for _ in range(number)]
+
+    def test_record_queues_the_events_once_committed(self):
+        buffer = self.buffer()
+        with transaction.atomic():
+            buffer.record(self.events(2))
+            self.assertEqual(buffer.queue.qsize(), 0)
+        self.assertEqual(buffer.queue.qsize(), 2)
+
+        try:
+            with transaction.atomic():
+                buffer.record(self.events(3))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(buffer.queue.qsize(), 2)
+
+    def test_full_queue_drops_and_counts_the_events(self):
+        buffer = self.buffer(max_size=3)
+        buffer.put(self.events(5))
+        buffer.put(self.events(1))
+        self.assertEqual(buffer.stats(), {'queue_depth': 3, 'dropped': 3, 'flushed': 0, 'failed': 0})
+
+    def test_flush_writes_in_batches(self):
+        buffer = self.buffer(batch_size=2)
+        events = self.events(5)
+        buffer.put(events)
+        with CaptureQueriesContext(connection) as queries:
+            buffer.flush()
+
+        # 2 + 2 + 1 events
+        self.assertEqual(len([item for item in queries.captured_queries
+                              if item['sql'].startswith('INSERT INTO "drug_auditlog"')]), 3)
+        self.assertEqual(buffer.stats(), {'queue_depth': 0, 'dropped': 0, 'flushed': 5, 'failed': 0})
+        self.assertEqual(AuditLog.objects.filter(entity_id__in=[event['entity_id'] for event in events]).count(), 5)
+
+    def test_failed_batch_is_counted_and_the_next_one_written(self):
+        buffer = self.buffer(batch_size=2)
+        # longer than the entity column
+        buffer.put(self.events(2, entity='x' * 30))
+        buffer.flush()
+        self.assertEqual(buffer.stats(), {'queue_depth': 0, 'dropped': 0, 'flushed': 0, 'failed': 2})
+        # closed after the error, the next batch does not reuse a connection that may be broken
+        self.assertIsNone(connection.connection)
+
+        events = self.events(1)
+        buffer.put(events)
+        buffer.flush()
+        self.assertEqual(buffer.stats(), {'queue_depth': 0, 'dropped': 0, 'flushed': 1, 'failed': 2})
+        self.assertTrue(AuditLog.objects.filter(entity_id=events[0]['entity_id']).exists())
+
+
+class DrugBulkPriceTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='pharmacist')
+        cls.category = Category.objects.create(name='bulk price')
+        cls.drugs = [Drug.objects.create(name='drug {}'.format(index), key='BP{}'.format(index), price=price,
+                                         category=cls.category)
+                     for index, price in enumerate([19.99, 8, 0.01])]
+
+    def prices(self):
+        return [Drug.objects.get(pk=drug.pk).price for drug in self.drugs]
+
+    def apply(self, handler, *args):
+        with mock.patch.object(audit_log_buffer, 'record') as record:
+            res = handler(*args)
+        events = record.call_args[0][0] if record.called else []
+        return res, {event['entity_id']: event['changes']['price'] for event in events}
+
+    def test_percentage_is_rounded_to_two_decimals(self):
+        handler = DrugBulkPriceService(actor=self.user)
+        modified = Drug.objects.get(pk=self.drugs[2].pk).modified
+
+        res, audited = self.apply(handler.apply_percentage, self.category.id, 7)
+        # 21.3893, 8.56 and 0.0107, the last one is left unchanged by the rounding
+        self.assertEqual(res, {'updated': 2})
+        self.assertEqual(self.prices(), [21.39, 8.56, 0.01])
+        self.assertEqual(audited, {self.drugs[0].id: [19.99, 21.39], self.drugs[1].id: [8, 8.56]})
+
+        res, audited = self.apply(handler.apply_percentage, self.category.id, -12.5)
+        # 18.71625, 7.49 and 0.00875
+        self.assertEqual(res, {'updated': 2})
+        self.assertEqual(self.prices(), [18.72, 7.49, 0.01])
+        self.assertEqual(audited, {self.drugs[0].id: [21.39, 18.72], self.drugs[1].id: [8.56, 7.49]})
+        # neither written nor audited
+        self.assertEqual(Drug.objects.get(pk=self.drugs[2].pk).modified, modified)
+
+    def test_price_list_keeps_the_last_price_of_a_key(self):
+        handler = DrugBulkPriceService(actor=self.user)
+        modified = Drug.objects.get(pk=self.drugs[1].pk).modified
+
+        res, audited = self.apply(handler.apply_price_list, [('BP0', 5), ('MISSING', 3), ('BP0', 6), ('BP1', 8),
+                                                             ('BP2', 0.02), ('OTHER', 1)])
+        self.assertEqual(res['updated'], 2)
+        self.assertEqual(sorted(res['not_found']), ['MISSING', 'OTHER'])
+        self.assertEqual(self.prices(), [6, 8, 0.02])
+        self.assertEqual(audited, {self.drugs[0].id: [19.99, 6], self.drugs[2].id: [0.01, 0.02]})
+        # the same price is neither written nor audited
+        self.assertEqual(Drug.objects.get(pk=self.drugs[1].pk).modified, modified)
+
+    def test_nothing_changed_is_not_audited(self):
+        handler = DrugBulkPriceService(actor=self.user)
+        res, audited = self.apply(handler.apply_percentage, self.category.id, 0)
+        self.assertEqual(res, {'updated': 0})
+        self.assertEqual(audited, {})
+
+
+class DrugBulkPriceCommitTest(TransactionTestCase):
+
+    def test_catalog_version_is_bumped_once_on_commit(self):
+        category = Category.objects.create(name='bulk price')
+        drugs = [Drug.objects.create(name='drug {}'.format(index), key='BPC{}'.format(index), price=10,
+                                     category=category)
+                 for index in range(3)]
+        handler = DrugBulkPriceService()
+        version = get_catalog_version()
+
+        try:
+            with transaction.atomic():
+                handler.apply_percentage(category.id, 10)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(get_catalog_version(), version)
+
+        with transaction.atomic():
+            handler.apply_percentage(category.id, 10)
+            self.assertEqual(get_catalog_version(), version)
+        # once for the three drugs
+        self.assertEqual(get_catalog_version(), version + 1)
+
+        # no price changed
+        handler.apply_price_list([(drug.key, 11) for drug in drugs])
+        self.assertEqual(get_catalog_version(), version + 1)
+        handler.apply_price_list([(drug.key, 12) for drug in drugs])
+        self.assertEqual(get_catalog_version(), version + 2)
+
+
+class DrugAutocompleteIndexTest(TestCase):
+
+    @staticmethod
+    def search(index, keyword):
+        return [drug[1] for drug in index.search(keyword)]
+
+    def test_normalize(self):
+        self.assertEqual(normalize('  Thuốc  ĐAU đầu '), 'thuoc dau dau')
+        self.assertEqual(normalize('Paracetamol 500MG'), 'paracetamol 500mg')
+        self.assertEqual(normalize(None), '')
+
+    def test_get_terms(self):
+        self.assertEqual(get_terms('Thuốc Giảm Đau', 'TGD-1'), ['dau', 'giam dau', 'tgd-1', 'thuoc giam dau'])
+        self.assertEqual(get_terms('Aspirin', None), ['aspirin'])
+        self.assertEqual(get_terms('', ''), [])
+
+    def test_refresh_applies_the_changed_drugs(self):
+        Drug.objects.create(name='Zyrtec 10mg', key='ZYR10', price=5)
+        renamed = Drug.objects.create(name='Zyrtec Đặc Biệt', key='ZYR20', price=6)
+        removed = Drug.objects.create(name='Zyrtec Cũ', key='ZYR30', price=7)
+        index = DrugAutocompleteIndex()
+        self.assertEqual(self.search(index, 'zyrtec'), ['Zyrtec 10mg', 'Zyrtec Cũ', 'Zyrtec Đặc Biệt'])
+        built_at = index._built_at
+
+        renamed.name = 'Zyrtec Mới'
+        renamed.save()
+        removed.delete()
+        Drug.objects.create(name='Zyrtec Plus', key='ZYR40', price=8)
+        # what the save signal does once the transaction commits, never in a TestCase
+        index.invalidate()
+
+        self.assertEqual(self.search(index, 'zyrtec'), ['Zyrtec 10mg', 'Zyrtec Mới', 'Zyrtec Plus'])
+        self.assertEqual(self.search(index, 'biet'), [])
+        self.assertEqual(self.search(index, 'zyr30'), [])
+        self.assertEqual(self.search(index, 'moi'), ['Zyrtec Mới'])
+        # edited in place, not built again
+        self.assertEqual(index._built_at, built_at)
+
+    def test_refresh_swaps_a_new_price_in_place(self):
+        drugs = [Drug.objects.create(name='Zyrtec {} Zforte'.format(index), key='ZYF{}'.format(index), price=5)
+                 for index in range(5)]
+        index = DrugAutocompleteIndex()
+        self.assertEqual(len(index.search('zforte')), 5)
+        terms = index._state[0]
+
+        drugs[2].price = 9
+        drugs[2].save()
+        index.invalidate()
+
+        # found by each of its terms with the new price, the terms are the same list
+        for keyword in ['zyrtec 2', 'zyf2']:
+            self.assertEqual([drug[2] for drug in index.search(keyword)], [9])
+        self.assertEqual(sorted(drug[2] for drug in index.search('zforte')), [5, 5, 5, 5, 9])
+        self.assertIs(index._state[0], terms)
+
+        # the entries of a common term stay ordered by drug id
+        drugs[3].name = 'Zyrtec Mới Zforte'
+        drugs[3].save()
+        drugs[4].delete()
+        index.invalidate()
+
+        found = index.search('zforte')
+        self.assertEqual(len(found), 4)
+        self.assertEqual([drug[0] for drug in found], sorted(drug[0] for drug in found))
+        self.assertEqual([drug[1] for drug in index.search('zyrtec moi')], ['Zyrtec Mới Zforte'])
+
+    def test_refresh_sees_the_drugs_saved_by_another_process(self):
+        drug = Drug.objects.create(name='Zyrtec Zmono', key='ZYM1', price=5)
+        index = DrugAutocompleteIndex()
+        self.assertEqual(len(index.search('zmono')), 1)
+
+        # neither the signal of this process nor a cache shared with the other one
+        Drug.objects.filter(pk=drug.pk).update(name='Zyrtec Zduo', modified=timezone.now())
+        with override_settings(DRUG_AUTOCOMPLETE_CHECK_INTERVAL=0):
+            self.assertEqual([item[1] for item in index.search('zduo')], ['Zyrtec Zduo'])
+        self.assertEqual(index.search('zmono'), [])
+
+
+class PrescriptionVersionConcurrencyTest(TransactionTestCase):
+    """
+    runs against the real database with committed transactions, each thread has its own connection
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='pharmacist')
+        work_space = WorkSpace.objects.create(name='work space', owner=self.user)
+        UserWorkSpace.objects.create(user=self.user, work_space=work_space)
+        pharmacy = Pharmacy.objects.create(work_space=work_space, name='pharmacy', address='address',
+                                           phone='0123456789')
+        self.drugs = [Drug.objects.create(name='drug {}'.format(index), price=10) for index in range(4)]
+        self.prescription = Prescription.objects.create(work_space=work_space, pharmacy=pharmacy)
+        self.url = reverse('update-prescription-drug-detail', kwargs={'work_space_id': work_space.id,
+                                                                      'pk': self.prescription.id})
+
+    def patch(self, drug, version=None):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        headers = {'HTTP_IF_MATCH': '"{}"'.format(version)} if version is not None else {}
+        data = {'list_prescription_detail': [{'drug': str(drug.id), 'quantity': 2}]}
+        return client.patch(self.url, data, format='json', **headers)
+
+    def test_outdated_version_is_rejected(self):
+        response = self.patch(self.drugs[0], version=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"2"')
+
+        response = self.patch(self.drugs[1], version=1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Prescription.objects.get(pk=self.prescription.pk).version, 2)
+        self.assertEqual(list(PrescriptionDetail.objects.filter(prescription=self.prescription)
+                              .values_list('drug_id', flat=True)), [self.drugs[0].id])
+
+    def test_concurrent_edits_of_the_same_version(self):
+        barrier = threading.Barrier(len(self.drugs))
+        status_codes = []
+
+        def edit(drug):
+            try:
+                barrier.wait()
+                status_codes.append(self.patch(drug, version=1).status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=edit, args=(drug,)) for drug in self.drugs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # exactly one edit wins, the others get a conflict instead of overwriting it
+        self.assertEqual(sorted(status_codes), [200] + [409] * (len(self.drugs) - 1))
+        prescription = Prescription.objects.get(pk=self.prescription.pk)
+        self.assertEqual(prescription.version, 2)
+        details = PrescriptionDetail.objects.filter(prescription=prescription)
+        self.assertEqual(details.count(), 1)
+        self.assertEqual(prescription.total_price, 20)
+
+    def test_concurrent_edits_of_the_same_sales_slice(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = reverse('list-create-prescription', kwargs={'work_space_id': self.prescription.work_space_id})
+        response = client.post(url, {'pharmacy': str(self.prescription.pharmacy_id), 'list_prescription_detail': [
+            {'drug': str(self.drugs[1].id), 'quantity': 2}]}, format='json')
+        other = Prescription.objects.get(pk=response.data['id'])
+        first_done, commit_first = threading.Event(), threading.Event()
+
+        def patch(prescription, drug):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            url = reverse('update-prescription-drug-detail', kwargs={'work_space_id': prescription.work_space_id,
+                                                                     'pk': prescription.id})
+            data = {'list_prescription_detail': [{'drug': str(drug.id), 'quantity': 2}]}
+            self.assertEqual(client.patch(url, data, format='json').status_code, 200)
+
+        def edit_first():
+            try:
+                # the first edit keeps its transaction open until the second one waits for its cube row
+                with transaction.atomic():
+                    patch(self.prescription, self.drugs[0])
+                    first_done.set()
+                    commit_first.wait(5)
+            finally:
+                first_done.set()
+                connections.close_all()
+
+        def edit_other():
+            try:
+                first_done.wait(5)
+                # same total, the other prescription moves its sales to the drug of the first edit
+                patch(other, self.drugs[0])
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=edit_first), threading.Thread(target=edit_other)]
+        for thread in threads:
+            thread.start()
+        first_done.wait(5)
+        time.sleep(0.5)
+        commit_first.set()
+        for thread in threads:
+            thread.join()
+
+        # each edit added its own delta, the second one did not write totals computed without the first
+        self.assertEqual(DrugSalesDaily.objects.get(drug=self.drugs[0]).quantity, 4)
+        self.assertFalse(DrugSalesDaily.objects.filter(drug=self.drugs[1]).exists())
+        self.assertEqual(DrugSalesCubeService.check(self.prescription.work_space_id), [])
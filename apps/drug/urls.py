@@ -4,9 +4,12 @@ from apps.drug.views import (
     ListCreateDrugView, RetrieveUpdateDestroyDrugView, ListCreateDrugCategoryView, ListCreatePharmacyView,
     ListCreatePrescriptionView, RetrieveUpdateCategoryView, RetrieveUpdatePharmacyView, BulkCreateActionDrugView,
     PrescriptionDrugContentDetailView, PrescriptionDrugContentUpdateView,
-    RetrieveDestroyPrescriptionView, SendMailPrescriptionView, GetPrescriptionPdfView)
+    RetrieveDestroyPrescriptionView, SendMailPrescriptionView, GetPrescriptionPdfView, BulkCreatePrescriptionView,
+    BulkUpdateDrugPriceView, DrugAutocompleteView)
+from apps.drug.views_export import ExportPrescriptionView, ExportPharmaciesPrescriptionStatisticView
 from apps.drug.views_statistic import (
-    PharmacyPrescriptionStatisticView, CommonPrescriptionStatsView, PharmaciesPrescriptionStatisticView)
+    PharmacyPrescriptionStatisticView, CommonPrescriptionStatsView, PharmaciesPrescriptionStatisticView,
+    DrugSalesStatisticView, DrugSalesCubeView)
 
 # urls
 
@@ -17,6 +20,12 @@ urlpatterns = [
     path('drugs/bulk-create-action/',
          BulkCreateActionDrugView.as_view(),
          name='bulk-create-drug'),
+    path('drugs/autocomplete/',
+         DrugAutocompleteView.as_view(),
+         name='autocomplete-drug'),
+    path('drugs/bulk-price/',
+         BulkUpdateDrugPriceView.as_view(),
+         name='bulk-update-drug-price'),
     path('drugs/<uuid:pk>/',
          RetrieveUpdateDestroyDrugView.as_view(),
          name='retrieve-drug'),
@@ -32,6 +41,15 @@ urlpatterns = [
     path('work-spaces/<uuid:work_space_id>/pharmacies/prescription/stats/',
          PharmaciesPrescriptionStatisticView.as_view(),
          name='pharmacies-prescription-stats'),
+    path('work-spaces/<uuid:work_space_id>/pharmacies/prescription/stats/export/',
+         ExportPharmaciesPrescriptionStatisticView.as_view(),
+         name='export-pharmacies-prescription-stats'),
+    path('work-spaces/<uuid:work_space_id>/drugs/stats/',
+         DrugSalesStatisticView.as_view(),
+         name='drug-sales-stats'),
+    path('work-spaces/<uuid:work_space_id>/sales/cube/',
+         DrugSalesCubeView.as_view(),
+         name='drug-sales-cube'),
     path('work-spaces/<uuid:work_space_id>/pharmacies/',
          ListCreatePharmacyView.as_view(),
          name='list-create-pharmacies'),
@@ -43,6 +61,12 @@ urlpatterns = [
          name='pharmacy-prescription-stats'),
     path('work-spaces/<uuid:work_space_id>/prescription/', ListCreatePrescriptionView.as_view(),
          name='list-create-prescription'),
+    path('work-spaces/<uuid:work_space_id>/prescription/bulk/',
+         BulkCreatePrescriptionView.as_view(),
+         name='bulk-create-prescription'),
+    path('work-spaces/<uuid:work_space_id>/prescription/export/',
+         ExportPrescriptionView.as_view(),
+         name='export-prescription'),
     path('work-spaces/<uuid:work_space_id>/prescription/<uuid:pk>/',
          RetrieveDestroyPrescriptionView.as_view(),
          name='retrieve-update-destroy-prescription'),
@@ -1,24 +1,32 @@
 from abc import ABC
 from datetime import datetime
 
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpResponse
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework import generics
+from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated, AllowAny, SAFE_METHODS
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from apps.common.exceptions import InvalidFilterException
+from apps.common.exceptions import InvalidFilterException, IdempotencyKeyReusedException
+from apps.common.pagination import (
+    KeysetPagination, is_keyset_pagination, KEYSET_PAGINATION_PARAM, KEYSET_PAGINATION_VALUE)
 from apps.drug.models import Drug, Category, Pharmacy, Prescription, PrescriptionDetail, WorkSpace, UserWorkSpace
 from apps.drug.serializers import (
     DrugSerializer, DrugCategorySerializer, PharmacySerializer, PrescriptionDetailSerializer,
     SendMailPrescriptionSerializer, BulkCreateDrugSerializer, PharmacyDetailSerializer,
     PrescriptionUpdateDetailSerializer, PrescriptionDrugContentSerializer, DrugDetailSerializer,
-    PrescriptionDrugContentDetailSerializer)
+    PrescriptionDrugContentDetailSerializer, BulkPrescriptionSerializer, BulkDrugPriceSerializer)
+from apps.drug.services.drug_autocomplete import (
+    drug_autocomplete_index, AUTOCOMPLETE_DEFAULT_LIMIT, AUTOCOMPLETE_MAX_LIMIT)
+from apps.drug.services.idempotency import IdempotencyService, IDEMPOTENCY_KEY_MAX_LENGTH
 from apps.drug.services.prescription_pdf_generation import PrescriptionPdfGeneration
-from apps.drug.services.search import PostgresFulltextSearch, CONFIG_PRESCRIPTION_RANK, CONFIG_DRUG_RANK
+from apps.drug.services.search import (
+    PostgresFulltextSearch, CONFIG_PRESCRIPTION_RANK, CONFIG_DRUG_RANK, SEARCH_VECTOR_FIELD)
+from apps.drug.services.trigram_search import TrigramSearch, is_fuzzy
 
 
 # Create your views here.
@@ -35,7 +43,64 @@ class WorkSpaceParamView(ABC):
             raise generics.ValidationError(f"Work Space {ws_id} does not exist")
 
 
-class ListCreateDrugView(generics.ListCreateAPIView):
+class IdempotentCreateView(ABC):
+    idempotency_key = openapi.Parameter('Idempotency-Key', in_=openapi.IN_HEADER,
+                                        description="""unique key of the request, its retries get the stored response
+                                        back without creating anything""",
+                                        type=openapi.TYPE_STRING)
+
+    def idempotent(self, work_space, handler):
+        """
+        run handler() once per Idempotency-Key, successful responses are stored and replayed to the retries
+        """
+        request = self.request  # noqa
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return handler()
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise generics.ValidationError(f'Idempotency-Key must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+
+        service = IdempotencyService(work_space.id, key)
+        request_hash = service.hash_request(request.method, request.path, request.data)
+        with transaction.atomic():
+            service.lock()
+            stored = service.get()
+            if stored:
+                stored_hash, status_code, response_body = stored
+                if stored_hash != request_hash:
+                    raise IdempotencyKeyReusedException()
+                return Response(response_body, status=status_code, headers={'Idempotent-Replayed': 'true'})
+
+            response = handler()
+            if status.is_success(response.status_code):
+                service.save(request_hash, response.status_code, response.data)
+        return response
+
+
+class KeysetPaginatedView(ABC):
+    """
+    page numbers by default (admin UI), keyset pagination on the ordering of the listing with ?pagination=cursor,
+    then by following the next / previous links, see KeysetPagination
+    """
+    pagination = openapi.Parameter(KEYSET_PAGINATION_PARAM, in_=openapi.IN_QUERY,
+                                   description="""cursor for keyset pagination, next / previous links instead of
+                                   page numbers and count""",
+                                   type=openapi.TYPE_STRING, enum=[KEYSET_PAGINATION_VALUE])
+    cursor = openapi.Parameter(KeysetPagination.cursor_query_param, in_=openapi.IN_QUERY,
+                               description="""position of the page, from the next / previous links""",
+                               type=openapi.TYPE_STRING)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if is_keyset_pagination(self.request.query_params):  # noqa
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class() if self.pagination_class else None  # noqa
+        return self._paginator
+
+
+class ListCreateDrugView(KeysetPaginatedView, generics.ListCreateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = Drug.objects.all()
 
@@ -48,6 +113,9 @@ class ListCreateDrugView(generics.ListCreateAPIView):
     price_to = openapi.Parameter('price_to', in_=openapi.IN_QUERY,
                                  description="""Price to""",
                                  type=openapi.TYPE_NUMBER)
+    fuzzy = openapi.Parameter('fuzzy', in_=openapi.IN_QUERY,
+                              description="""true to match misspelled keywords, ranked by similarity""",
+                              type=openapi.TYPE_BOOLEAN)
 
     def get_serializer_class(self):
         if self.request.method == "POST":
@@ -70,18 +138,46 @@ class ListCreateDrugView(generics.ListCreateAPIView):
                 query_set = Drug.objects.filter(price__lte=float(price_to))
 
         keyword = self.request.query_params.get('keyword', None)
+        if keyword and is_fuzzy(self.request.query_params):
+            return TrigramSearch(query_set, ['name', 'key'], 'modified').fuzzy(keyword)
         if keyword:
-            q_list = [Q(key__icontains=keyword), Q(name__icontains=keyword)]
-            search_handler = PostgresFulltextSearch(query_set, CONFIG_DRUG_RANK)
+            q_list = [Q(key__f_unaccent__icontains=keyword), Q(name__f_unaccent__icontains=keyword)]
+            search_handler = PostgresFulltextSearch(query_set, CONFIG_DRUG_RANK, vector_field=SEARCH_VECTOR_FIELD)
             return search_handler.search(keyword, q_list)
 
         return query_set.order_by('-modified')
 
-    @swagger_auto_schema(operation_description='Get list drugs', manual_parameters=[keyword, price_from, price_to])
+    @swagger_auto_schema(operation_description='Get list drugs',
+                         manual_parameters=[keyword, price_from, price_to, fuzzy, KeysetPaginatedView.pagination,
+                                            KeysetPaginatedView.cursor])
     def get(self, request, *args, **kwargs):
         return super(ListCreateDrugView, self).get(request, *args, **kwargs)
 
 
+class DrugAutocompleteView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    keyword = openapi.Parameter('keyword', in_=openapi.IN_QUERY,
+                                description="""Beginning of a word of the name or of the key""",
+                                type=openapi.TYPE_STRING)
+    limit = openapi.Parameter('limit', in_=openapi.IN_QUERY,
+                              description=f"""Number of drugs, {AUTOCOMPLETE_DEFAULT_LIMIT} by default,
+                              at most {AUTOCOMPLETE_MAX_LIMIT}""",
+                              type=openapi.TYPE_INTEGER)
+
+    @swagger_auto_schema(operation_description='Autocomplete drugs, served from memory',
+                         manual_parameters=[keyword, limit])
+    def get(self, request, *args, **kwargs):
+        keyword = request.query_params.get('keyword', '')
+        try:
+            limit = int(request.query_params.get('limit', AUTOCOMPLETE_DEFAULT_LIMIT))
+        except ValueError:
+            raise InvalidFilterException('limit must be a number')
+        limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+        res = drug_autocomplete_index.search(keyword, limit)
+        return Response([{'id': drug_id, 'name': name, 'price': price} for drug_id, name, price in res])
+
+
 class RetrieveUpdateDestroyDrugView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = DrugSerializer
     queryset = Drug.objects.all()
@@ -102,14 +198,20 @@ class ListCreateDrugCategoryView(generics.ListCreateAPIView):
                                 description="""Search by name""",
                                 type=openapi.TYPE_STRING)
 
-    @swagger_auto_schema(operation_description='Get list categories', manual_parameters=[keyword])
+    fuzzy = openapi.Parameter('fuzzy', in_=openapi.IN_QUERY,
+                              description="""true to match misspelled keywords, ranked by similarity""",
+                              type=openapi.TYPE_BOOLEAN)
+
+    @swagger_auto_schema(operation_description='Get list categories', manual_parameters=[keyword, fuzzy])
     def get(self, request, *args, **kwargs):
         return super(ListCreateDrugCategoryView, self).get(request, *args, **kwargs)
 
     def get_queryset(self):
         keyword = self.request.query_params.get('keyword', None)
+        if keyword and is_fuzzy(self.request.query_params):
+            return TrigramSearch(Category.objects.all(), ['name'], 'created').fuzzy(keyword)
         if keyword:
-            return Category.objects.filter(name__icontains=keyword).order_by('-created')
+            return Category.objects.filter(name__f_unaccent__icontains=keyword).order_by('-created')
         return Category.objects.all().order_by('-created')
 
 
@@ -126,7 +228,11 @@ class ListCreatePharmacyView(WorkSpaceParamView, generics.ListCreateAPIView):
                                 description="""Search by name""",
                                 type=openapi.TYPE_STRING)
 
-    @swagger_auto_schema(operation_description='Get list pharmacies', manual_parameters=[keyword])
+    fuzzy = openapi.Parameter('fuzzy', in_=openapi.IN_QUERY,
+                              description="""true to match misspelled keywords, ranked by similarity""",
+                              type=openapi.TYPE_BOOLEAN)
+
+    @swagger_auto_schema(operation_description='Get list pharmacies', manual_parameters=[keyword, fuzzy])
     def get(self, request, *args, **kwargs):
         return super(ListCreatePharmacyView, self).get(request, *args, **kwargs)
 
@@ -134,8 +240,10 @@ class ListCreatePharmacyView(WorkSpaceParamView, generics.ListCreateAPIView):
         keyword = self.request.query_params.get('keyword', None)
         ws = self.get_work_space(self.kwargs.get('work_space_id'))
         base_cond = Q(work_space=ws)
+        if keyword and is_fuzzy(self.request.query_params):
+            return TrigramSearch(Pharmacy.objects.filter(base_cond), ['name'], 'created').fuzzy(keyword)
         if keyword:
-            return Pharmacy.objects.filter(base_cond).filter(name__icontains=keyword).order_by('-created')
+            return Pharmacy.objects.filter(base_cond).filter(name__f_unaccent__icontains=keyword).order_by('-created')
         return Pharmacy.objects.filter(base_cond).order_by('-created')
 
     def get_serializer_class(self):
@@ -161,7 +269,8 @@ class RetrieveUpdatePharmacyView(WorkSpaceParamView, generics.RetrieveUpdateAPIV
             raise generics.ValidationError(f'pharmacy {self.kwargs.get("pk")} does not exist.')
 
 
-class ListCreatePrescriptionView(WorkSpaceParamView, generics.ListCreateAPIView):
+class ListCreatePrescriptionView(WorkSpaceParamView, IdempotentCreateView, KeysetPaginatedView,
+                                 generics.ListCreateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = Prescription.objects.all()
 
@@ -172,10 +281,16 @@ class ListCreatePrescriptionView(WorkSpaceParamView, generics.ListCreateAPIView)
                                 description="""Search by name""",
                                 type=openapi.TYPE_STRING)
 
-    @swagger_auto_schema(operation_description='Get list prescription', manual_parameters=[date, keyword])
+    @swagger_auto_schema(operation_description='Get list prescription',
+                         manual_parameters=[date, keyword, KeysetPaginatedView.pagination, KeysetPaginatedView.cursor])
     def get(self, request, *args, **kwargs):
         return super(ListCreatePrescriptionView, self).get(request, *args, **kwargs)
 
+    @swagger_auto_schema(manual_parameters=[IdempotentCreateView.idempotency_key])
+    def post(self, request, *args, **kwargs):
+        ws = self.get_work_space(self.kwargs.get("work_space_id"))
+        return self.idempotent(ws, lambda: super(ListCreatePrescriptionView, self).post(request, *args, **kwargs))
+
     def get_queryset(self):
         ws = self.get_work_space(self.kwargs.get("work_space_id"))
 
@@ -198,7 +313,9 @@ class ListCreatePrescriptionView(WorkSpaceParamView, generics.ListCreateAPIView)
             )
 
         if keyword:
-            search_handler = PostgresFulltextSearch(query_set, CONFIG_PRESCRIPTION_RANK, 'created')
+            search_handler = PostgresFulltextSearch(query_set, CONFIG_PRESCRIPTION_RANK, 'created',
+                                                    vector_field=SEARCH_VECTOR_FIELD)
+            # not index backed, only the prescriptions of the work space (and of the date) are scanned for them
             q_list = [Q(name__icontains=keyword), Q(status__icontains=keyword)]
             return search_handler.search(keyword, q_list)
 
@@ -227,11 +344,15 @@ class RetrieveDestroyPrescriptionView(WorkSpaceParamView, generics.RetrieveDestr
             raise generics.ValidationError(f"Prescription {self.kwargs.get('pk')} does not exist")
 
 
-class PrescriptionDrugContentDetailView(WorkSpaceParamView, generics.ListAPIView):
+class PrescriptionDrugContentDetailView(WorkSpaceParamView, KeysetPaginatedView, generics.ListAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = PrescriptionDrugContentDetailSerializer
     queryset = Prescription.objects.all()
 
+    @swagger_auto_schema(manual_parameters=[KeysetPaginatedView.pagination, KeysetPaginatedView.cursor])
+    def get(self, request, *args, **kwargs):
+        return super(PrescriptionDrugContentDetailView, self).get(request, *args, **kwargs)
+
     def get_queryset(self):
         pk = self.kwargs.get('pk', None)
 
@@ -259,9 +380,34 @@ class PrescriptionDrugContentUpdateView(WorkSpaceParamView, generics.UpdateAPIVi
     permission_classes = (IsAuthenticated,)
     queryset = Prescription.objects.all()
 
+    if_match = openapi.Parameter('If-Match', in_=openapi.IN_HEADER,
+                                 description="""version of the prescription the edit is based on, 409 when outdated""",
+                                 type=openapi.TYPE_STRING)
+
+    @swagger_auto_schema(manual_parameters=[if_match])
+    def put(self, request, *args, **kwargs):
+        return self.update(request, *args, **kwargs)
+
+    @swagger_auto_schema(manual_parameters=[if_match])
     def patch(self, request, *args, **kwargs):
         return self.partial_update(request, *args, **kwargs)
 
+    def update(self, request, *args, **kwargs):
+        response = super(PrescriptionDrugContentUpdateView, self).update(request, *args, **kwargs)
+        response['ETag'] = '"{}"'.format(response.data['version'])
+        return response
+
+    def get_serializer_context(self):
+        context = super(PrescriptionDrugContentUpdateView, self).get_serializer_context()
+        if_match = self.request.headers.get('If-Match')
+        if if_match:
+            try:
+                # "3" or W/"3"
+                context['expected_version'] = int(if_match.replace('W/', '').strip('" '))
+            except ValueError:
+                raise generics.ValidationError(f'If-Match {if_match} is not a prescription version')
+        return context
+
     def get_object(self):
         ws = self.get_work_space(self.kwargs.get("work_space_id"))
         try:
@@ -270,6 +416,23 @@ class PrescriptionDrugContentUpdateView(WorkSpaceParamView, generics.UpdateAPIVi
             raise generics.ValidationError(f"Prescription {self.kwargs.get('pk')} does not exist.")
 
 
+class BulkCreatePrescriptionView(WorkSpaceParamView, IdempotentCreateView, APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(request_body=BulkPrescriptionSerializer,
+                         manual_parameters=[IdempotentCreateView.idempotency_key])
+    def post(self, request, *args, **kwargs):
+        ws = self.get_work_space(self.kwargs.get("work_space_id"))
+        return self.idempotent(ws, lambda: self.ingest(ws))
+
+    def ingest(self, ws):
+        serializer = BulkPrescriptionSerializer(data=self.request.data,
+                                                context={'work_space': ws, 'request': self.request})
+        serializer.is_valid(raise_exception=True)
+        res = serializer.ingest()
+        return Response(res, status=status.HTTP_201_CREATED)
+
+
 class BulkCreateActionDrugView(APIView):
     permission_classes = (IsAuthenticated,)
 
@@ -281,6 +444,16 @@ class BulkCreateActionDrugView(APIView):
         return Response(res)
 
 
+class BulkUpdateDrugPriceView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(request_body=BulkDrugPriceSerializer)
+    def post(self, request, *args, **kwargs):
+        serializer = BulkDrugPriceSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.apply())
+
+
 class SendMailPrescriptionView(APIView):
     permission_classes = (AllowAny,)
 
@@ -0,0 +1,51 @@
+from django.http import StreamingHttpResponse
+from drf_yasg.utils import swagger_auto_schema
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+
+from apps.drug.serializers_export import (
+    ExportPrescriptionSerializer, ExportPharmaciesPrescriptionStatisticSerializer,
+    EXPORT_PRESCRIPTION_HEADER, EXPORT_PHARMACIES_STATS_HEADER)
+from apps.drug.services.stats_export import StreamExportService
+from apps.drug.views import WorkSpaceParamView
+
+
+class BaseStreamExportView(WorkSpaceParamView, APIView):
+    permission_classes = (IsAuthenticated,)
+    serializer_class = None
+    header = None
+    file_name = None
+
+    def get(self, request, *args, **kwargs):
+        ws = self.get_work_space(self.kwargs.get("work_space_id"))
+        serializer = self.serializer_class(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        export_format = serializer.validated_data.get('export_format')
+
+        export_handler = StreamExportService(export_format, self.header)
+        response = StreamingHttpResponse(export_handler.stream(serializer.get_rows(ws)),
+                                         content_type=export_handler.content_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.file_name}.{export_format}"'
+        return response
+
+
+class ExportPrescriptionView(BaseStreamExportView):
+    serializer_class = ExportPrescriptionSerializer
+    header = EXPORT_PRESCRIPTION_HEADER
+    file_name = 'prescriptions'
+
+    @swagger_auto_schema(operation_description='Stream prescriptions as csv or ndjson',
+                         query_serializer=ExportPrescriptionSerializer)
+    def get(self, request, *args, **kwargs):
+        return super(ExportPrescriptionView, self).get(request, *args, **kwargs)
+
+
+class ExportPharmaciesPrescriptionStatisticView(BaseStreamExportView):
+    serializer_class = ExportPharmaciesPrescriptionStatisticSerializer
+    header = EXPORT_PHARMACIES_STATS_HEADER
+    file_name = 'pharmacies-stats'
+
+    @swagger_auto_schema(operation_description='Stream pharmacies prescription stats as csv or ndjson',
+                         query_serializer=ExportPharmaciesPrescriptionStatisticSerializer)
+    def get(self, request, *args, **kwargs):
+        return super(ExportPharmaciesPrescriptionStatisticView, self).get(request, *args, **kwargs)
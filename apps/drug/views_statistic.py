@@ -8,7 +8,8 @@ from rest_framework.views import APIView
 
 from apps.drug.models import Pharmacy
 from apps.drug.serializers_statistic import (
-    PharmacyPrescriptionStatisticSerializer, PharmaciesPrescriptionStatisticSerializer)
+    PharmacyPrescriptionStatisticSerializer, PharmaciesPrescriptionStatisticSerializer, DrugSalesStatisticSerializer,
+    DrugSalesCubeSerializer)
 from apps.drug.services.common_prescription_stats import CommonPrescriptionStatsService
 from apps.drug.views import WorkSpaceParamView
 
@@ -19,10 +20,13 @@ class PharmacyPrescriptionStatisticView(WorkSpaceParamView, generics.RetrieveAPI
     queryset = Pharmacy.objects.all()
 
     type = openapi.Parameter('type', in_=openapi.IN_QUERY,
-                             description="""date time type [DAYS, MONTHS, YEARS]""",
+                             description="""date time type [HOURS, DAYS, WEEKS, MONTHS, QUARTERS, YEARS]""",
                              type=openapi.TYPE_STRING)
+    time_zone = openapi.Parameter('time_zone', in_=openapi.IN_QUERY,
+                                  description="""time zone of the bins, e.g. Asia/Ho_Chi_Minh (default UTC)""",
+                                  type=openapi.TYPE_STRING)
 
-    @swagger_auto_schema(operation_description='GET Pharmacy Prescription Stats', manual_parameters=[type])
+    @swagger_auto_schema(operation_description='GET Pharmacy Prescription Stats', manual_parameters=[type, time_zone])
     def get(self, request, *args, **kwargs):
         return super(PharmacyPrescriptionStatisticView, self).get(request, *args, **kwargs)
 
@@ -47,6 +51,32 @@ class PharmaciesPrescriptionStatisticView(WorkSpaceParamView, APIView):
         return Response(res)
 
 
+class DrugSalesStatisticView(WorkSpaceParamView, APIView):
+    serializer_class = DrugSalesStatisticSerializer
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(request_body=DrugSalesStatisticSerializer)
+    def post(self, request, *args, **kwargs):
+        ws = self.get_work_space(self.kwargs.get("work_space_id"))
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        res = serializer.get_stats(ws)
+        return Response(res)
+
+
+class DrugSalesCubeView(WorkSpaceParamView, APIView):
+    serializer_class = DrugSalesCubeSerializer
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(request_body=DrugSalesCubeSerializer)
+    def post(self, request, *args, **kwargs):
+        ws = self.get_work_space(self.kwargs.get("work_space_id"))
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        res = serializer.get_stats(ws)
+        return Response(res)
+
+
 class CommonPrescriptionStatsView(WorkSpaceParamView, APIView):
     permission_classes = (IsAuthenticated,)
 
@@ -61,15 +91,5 @@ class CommonPrescriptionStatsView(WorkSpaceParamView, APIView):
         if not date:
             raise ValidationError('date is required', status.HTTP_400_BAD_REQUEST)
 
-        handler = CommonPrescriptionStatsService(ws, date)
-
-        total_pres_works = handler.get_total_number_prescription()
-        total_pres_cancelled = handler.get_total_number_prescription_cancelled()
-        total_pres_done = handler.get_total_number_prescription_done()
-        money = handler.get_total_money_prescription()
-        return Response({
-            'total_pres_works': total_pres_works,
-            'total_pres_done': total_pres_done,
-            'total_pres_cancelled': total_pres_cancelled,
-            'money': money
-        })
+        handler = CommonPrescriptionStatsService(ws, date, use_cache=True)
+        return Response(handler.compute())
@@ -102,6 +102,34 @@ DATABASES = {
 }
 DATABASES['default']['ATOMIC_REQUESTS'] = True
 
+# Cache
+# use a shared backend (e.g. redis/memcached) in production so stats invalidation reaches every process
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+STATS_CACHE_TIMEOUT = env.int('STATS_CACHE_TIMEOUT', default=30)
+
+# write prescription details with INSERT ... ON CONFLICT under an advisory lock instead of custom_bulk_sync
+PRESCRIPTION_DETAIL_UPSERT = env.bool('PRESCRIPTION_DETAIL_UPSERT', default=True)
+
+# seconds the response of a request sent with an Idempotency-Key is replayed to its retries
+IDEMPOTENCY_KEY_TTL = env.int('IDEMPOTENCY_KEY_TTL', default=24 * 60 * 60)
+
+# minimum similarity (0..1) of a fuzzy (fuzzy=true) drug, category or pharmacy search, see TrigramSearch
+TRIGRAM_SIMILARITY_THRESHOLD = env.float('TRIGRAM_SIMILARITY_THRESHOLD', default=0.3)
+
+# seconds between two checks of the catalog version by the in process drug autocomplete index, and between two full
+# builds of it (hard deleted drugs are only dropped by a build)
+DRUG_AUTOCOMPLETE_CHECK_INTERVAL = env.float('DRUG_AUTOCOMPLETE_CHECK_INTERVAL', default=1.0)
+DRUG_AUTOCOMPLETE_REBUILD_INTERVAL = env.float('DRUG_AUTOCOMPLETE_REBUILD_INTERVAL', default=60 * 60)
+
+# audit events are queued in process and written in batches by a background thread, see AuditLogBuffer
+AUDIT_LOG_ENABLED = env.bool('AUDIT_LOG_ENABLED', default=True)
+AUDIT_LOG_QUEUE_SIZE = env.int('AUDIT_LOG_QUEUE_SIZE', default=10000)
+AUDIT_LOG_BATCH_SIZE = env.int('AUDIT_LOG_BATCH_SIZE', default=500)
+AUDIT_LOG_FLUSH_INTERVAL = env.float('AUDIT_LOG_FLUSH_INTERVAL', default=1.0)
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 